@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 """Test the operation of two bridges on the SUT"""
 
-import time
 import unittest2
 import xmlrunner
 
+import broker
 import params
 import sut
 import traffic
@@ -69,27 +69,38 @@ class two_bridges_4_ports_test(unittest2.TestCase):
         self.config = CONFIG
         self.maxDiff = None
 
+    def _snapshotStats(self):
+        """Snapshot the Ethtool statistics of all the ports of the SUT,
+           in one go"""
+        return self.sut.snapshotStats([self.config.SUT_LAN0,
+                                       self.config.SUT_LAN1,
+                                       self.config.SUT_LAN2,
+                                       self.config.SUT_LAN3],
+                                      kinds=('ethtool',))
+
     def test_01_create_bridge(self):
         """Create the bridge"""
-        # Ensure all the interfaces are up
-        self.sut.up(self.config.SUT_MASTER)
-        self.sut.up(self.config.SUT_LAN0)
-        self.sut.up(self.config.SUT_LAN1)
-        self.sut.up(self.config.SUT_LAN2)
-        self.sut.up(self.config.SUT_LAN3)
-
-        self.sut.addBridge('br1')
-        self.sut.up('br1')
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN0)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN1)
-
-        self.sut.addBridge('br2')
-        self.sut.up('br2')
-        self.sut.addBridgeInterface('br2', self.config.SUT_LAN2)
-        self.sut.addBridgeInterface('br2', self.config.SUT_LAN3)
-
-        # Wait the forwarding delay of the bridge
-        time.sleep(10)
+        with self.sut.batch():
+            # Ensure all the interfaces are up
+            self.sut.up(self.config.SUT_MASTER)
+            self.sut.up(self.config.SUT_LAN0)
+            self.sut.up(self.config.SUT_LAN1)
+            self.sut.up(self.config.SUT_LAN2)
+            self.sut.up(self.config.SUT_LAN3)
+
+            self.sut.addBridge('br1')
+            self.sut.up('br1')
+            self.sut.addBridgeInterface('br1', self.config.SUT_LAN0)
+            self.sut.addBridgeInterface('br1', self.config.SUT_LAN1)
+
+            self.sut.addBridge('br2')
+            self.sut.up('br2')
+            self.sut.addBridgeInterface('br2', self.config.SUT_LAN2)
+            self.sut.addBridgeInterface('br2', self.config.SUT_LAN3)
+
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br1')
+        self.sut.waitBridgeForwarding('br2')
 
         self.traffic.addInterface(self.config.HOST_LAN0)
         self.traffic.addInterface(self.config.HOST_LAN1)
@@ -104,10 +115,7 @@ class two_bridges_4_ports_test(unittest2.TestCase):
     def test_03_bridged_unicast_lan0(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan0 is the source"""
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN0,
                                   self.config.HOST_LAN1, 10, 10)
@@ -136,15 +144,20 @@ class two_bridges_4_ports_test(unittest2.TestCase):
         self.assertEqual(stats_lan2, zero_stats)
         self.assertEqual(stats_lan3, zero_stats)
 
+        after = self._snapshotStats()
+
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN0,
-                                        ethtool_stats_lan0,
-                                        ethtool_rx_30, self)
+                                        before,
+                                        ethtool_rx_30, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN2,
-                                        ethtool_stats_lan2,
-                                        ethtool_zero, self)
+                                        before,
+                                        ethtool_zero, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN3,
-                                        ethtool_stats_lan3,
-                                        ethtool_zero, self)
+                                        before,
+                                        ethtool_zero, self,
+                                        after=after)
 
     def test_04_bridged_unicast_lan1(self):
         """Send traffic between bridged ports, and ensure they come out the
@@ -281,10 +294,7 @@ class two_bridges_4_ports_test(unittest2.TestCase):
     def test_11_bridged_unicast_lan0_ipv6(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan0 is the source"""
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
+        before = self._snapshotStats()
 
         self.traffic.addUDPv6Stream(self.config.HOST_LAN0,
                                     self.config.HOST_LAN1, 10, 10)
@@ -313,15 +323,20 @@ class two_bridges_4_ports_test(unittest2.TestCase):
         self.assertEqual(stats_lan2, zero_stats)
         self.assertEqual(stats_lan3, zero_stats)
 
+        after = self._snapshotStats()
+
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN0,
-                                        ethtool_stats_lan0,
-                                        ethtool_rx_30, self)
+                                        before,
+                                        ethtool_rx_30, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN2,
-                                        ethtool_stats_lan2,
-                                        ethtool_zero, self)
+                                        before,
+                                        ethtool_zero, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN3,
-                                        ethtool_stats_lan3,
-                                        ethtool_zero, self)
+                                        before,
+                                        ethtool_zero, self,
+                                        after=after)
 
     def test_12_bridged_unicast_lan1_ipv6(self):
         """Send traffic between bridged ports, and ensure they come out the
@@ -409,11 +424,12 @@ class two_bridges_4_ports_test(unittest2.TestCase):
 
 if __name__ == '__main__':
     args = params.params()
+    BROKER = broker.connect(args.broker) if args.broker else None
     CONFIG = params.readConfig(args.config)
-    SUT = sut.SUT(hostname=CONFIG.hostname, key=CONFIG.key,
-                  mgmt=CONFIG.SUT_MGMT)
+    SUT = sut.fromConfig(CONFIG, BROKER)
     SUT.cleanSystem()
-    TRAFFIC = traffic.Traffic()
+    TRAFFIC = traffic.Traffic(broker=BROKER,
+                              capture=traffic.capturePolicy(args))
 
     if args.xml:
         testRunner = xmlrunner.XMLTestRunner(output='test-reports',
@@ -422,4 +438,5 @@ if __name__ == '__main__':
         testRunner = unittest2.TextTestRunner(failfast=args.failfast,
                                               verbosity=args.verbose)
 
-    unittest2.main(buffer=False, testRunner=testRunner, exit=False)
+    unittest2.main(buffer=False, testRunner=params.HookedRunner(testRunner),
+                   exit=False)
@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 """Test the operation of two bridges spanning chips on the SUT"""
 
-import time
 import unittest2
 import xmlrunner
 
+import broker
 import params
 import sut
 import traffic
@@ -103,46 +103,61 @@ class Bridge_bridge_test(unittest2.TestCase):
         self.vlan_filtering = VLAN_FILTERING
         self.hw_cross_chip = HW_CROSS_CHIP
 
+    def _snapshotStats(self):
+        """Snapshot the statistics of the master and all the ports of
+           the SUT, in one go"""
+        return self.sut.snapshotStats([self.config.SUT_MASTER,
+                                       self.config.SUT_LAN0,
+                                       self.config.SUT_LAN1,
+                                       self.config.SUT_LAN2,
+                                       self.config.SUT_LAN3,
+                                       self.config.SUT_LAN4,
+                                       self.config.SUT_LAN5,
+                                       self.config.SUT_LAN6,
+                                       self.config.SUT_OPTICAL3])
+
     def test_01_create_bridges(self):
         """Create the bridge"""
-        # Ensure all the interfaces are up
-        self.sut.up(self.config.SUT_MASTER)
-        self.sut.up(self.config.SUT_LAN0)
-        self.sut.up(self.config.SUT_LAN1)
-        self.sut.up(self.config.SUT_LAN2)
-        self.sut.up(self.config.SUT_LAN3)
-        self.sut.up(self.config.SUT_LAN4)
-        self.sut.up(self.config.SUT_LAN5)
-        self.sut.up(self.config.SUT_LAN6)
-        self.sut.up(self.config.SUT_LAN7)
-        self.sut.up(self.config.SUT_LAN8)
-        self.sut.up(self.config.SUT_OPTICAL3)
-        self.sut.up(self.config.SUT_OPTICAL4)
-
-        self.sut.addBridge('br1')
-        self.sut.up('br1')
-
-        if self.vlan_filtering:
-            self.sut.bridgeEnableVlanFiltering('br1')
-
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN1)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN2)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN3)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN4)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN6)
-
-        self.sut.addBridge('br2')
-
-        if self.vlan_filtering:
-            self.sut.bridgeEnableVlanFiltering('br2')
-
-        self.sut.up('br2')
-        self.sut.addBridgeInterface('br2', self.config.SUT_LAN0)
-        self.sut.addBridgeInterface('br2', self.config.SUT_LAN5)
-        self.sut.addBridgeInterface('br2', self.config.SUT_OPTICAL3)
-
-        # Wait the forwarding delay of the bridge
-        time.sleep(10)
+        with self.sut.batch():
+            # Ensure all the interfaces are up
+            self.sut.up(self.config.SUT_MASTER)
+            self.sut.up(self.config.SUT_LAN0)
+            self.sut.up(self.config.SUT_LAN1)
+            self.sut.up(self.config.SUT_LAN2)
+            self.sut.up(self.config.SUT_LAN3)
+            self.sut.up(self.config.SUT_LAN4)
+            self.sut.up(self.config.SUT_LAN5)
+            self.sut.up(self.config.SUT_LAN6)
+            self.sut.up(self.config.SUT_LAN7)
+            self.sut.up(self.config.SUT_LAN8)
+            self.sut.up(self.config.SUT_OPTICAL3)
+            self.sut.up(self.config.SUT_OPTICAL4)
+
+            self.sut.addBridge('br1')
+            self.sut.up('br1')
+
+            if self.vlan_filtering:
+                self.sut.bridgeEnableVlanFiltering('br1')
+
+            self.sut.addBridgeInterface('br1', self.config.SUT_LAN1)
+            self.sut.addBridgeInterface('br1', self.config.SUT_LAN2)
+            self.sut.addBridgeInterface('br1', self.config.SUT_LAN3)
+            self.sut.addBridgeInterface('br1', self.config.SUT_LAN4)
+            self.sut.addBridgeInterface('br1', self.config.SUT_LAN6)
+
+            self.sut.addBridge('br2')
+
+            if self.vlan_filtering:
+                self.sut.bridgeEnableVlanFiltering('br2')
+
+            self.sut.up('br2')
+            self.sut.addBridgeInterface('br2', self.config.SUT_LAN0)
+            self.sut.addBridgeInterface('br2', self.config.SUT_LAN5)
+            self.sut.addBridgeInterface('br2', self.config.SUT_OPTICAL3)
+
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br1')
+        self.sut.waitBridgeForwarding('br2')
 
         self.traffic.addInterface(self.config.HOST_LAN0)
         self.traffic.addInterface(self.config.HOST_LAN1)
@@ -162,16 +177,7 @@ class Bridge_bridge_test(unittest2.TestCase):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan1 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN1,
                                   self.config.HOST_LAN2, 100, 100)
@@ -202,39 +208,50 @@ class Bridge_bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, RX_100_STATS)
         self.assertEqual(stats_optical3, ZERO_STATS)
 
+        after = self._snapshotStats()
+
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_300, self)
+                                      before,
+                                      CLASS_TX_RX_300, self,
+                                      after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN0,
-                                        ethtool_stats_lan0,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN1,
-                                        ethtool_stats_lan1,
-                                        ETHTOOL_RX_400, self)
+                                        before,
+                                        ETHTOOL_RX_400, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN2,
-                                        ethtool_stats_lan2,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN3,
-                                        ethtool_stats_lan3,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN4,
-                                        ethtool_stats_lan4,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN5,
-                                        ethtool_stats_lan5,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN6,
-                                        ethtool_stats_lan6,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_OPTICAL3,
-                                        ethtool_stats_optical3,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
 
     def test_03_bridged_unicast_lan2(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan2 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN2,
                                   self.config.HOST_LAN1, 100, 100)
@@ -264,15 +281,18 @@ class Bridge_bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, RX_100_STATS)
         self.assertEqual(stats_optical3, ZERO_STATS)
 
+        after = self._snapshotStats()
+
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_300, self)
+                                      before,
+                                      CLASS_TX_RX_300, self,
+                                      after=after)
 
     def test_04_bridged_unicast_lan3(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan3 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN3,
                                   self.config.HOST_LAN1, 100, 100)
@@ -302,15 +322,18 @@ class Bridge_bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, RX_100_STATS)
         self.assertEqual(stats_optical3, ZERO_STATS)
 
+        after = self._snapshotStats()
+
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_100, self)
+                                      before,
+                                      CLASS_TX_RX_100, self,
+                                      after=after)
 
     def test_05_bridged_unicast_lan4(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan4 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN4,
                                   self.config.HOST_LAN1, 100, 100)
@@ -340,15 +363,18 @@ class Bridge_bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, RX_100_STATS)
         self.assertEqual(stats_optical3, ZERO_STATS)
 
+        after = self._snapshotStats()
+
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_100, self)
+                                      before,
+                                      CLASS_TX_RX_100, self,
+                                      after=after)
 
     def test_06_bridged_unicast_lan6(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan6 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN6,
                                   self.config.HOST_LAN1, 100, 100)
@@ -378,29 +404,24 @@ class Bridge_bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, TX_400_STATS)
         self.assertEqual(stats_optical3, ZERO_STATS)
 
+        after = self._snapshotStats()
+
         if self.hw_cross_chip:
             self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                          class_stats_master,
-                                          CLASS_TX_RX_0, self)
+                                          before,
+                                          CLASS_TX_RX_0, self,
+                                          after=after)
         else:
             self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                          class_stats_master,
-                                          CLASS_TX_RX_400, self)
+                                          before,
+                                          CLASS_TX_RX_400, self,
+                                          after=after)
 
     def test_07_bridged_unicast_lan0(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan0 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN0,
                                   self.config.HOST_LAN5, 100, 100)
@@ -426,48 +447,50 @@ class Bridge_bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, ZERO_STATS)
         self.assertEqual(stats_optical3, RX_100_STATS)
 
+        after = self._snapshotStats()
+
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_200, self)
+                                      before,
+                                      CLASS_TX_RX_200, self,
+                                      after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN0,
-                                        ethtool_stats_lan0,
-                                        ETHTOOL_RX_200, self)
+                                        before,
+                                        ETHTOOL_RX_200, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN1,
-                                        ethtool_stats_lan1,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN2,
-                                        ethtool_stats_lan2,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN3,
-                                        ethtool_stats_lan3,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN4,
-                                        ethtool_stats_lan4,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN5,
-                                        ethtool_stats_lan5,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN6,
-                                        ethtool_stats_lan6,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_OPTICAL3,
-                                        ethtool_stats_optical3,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
 
     def test_08_bridged_unicast_lan0(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan5 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN5,
                                   self.config.HOST_LAN0, 100, 100)
@@ -493,48 +516,50 @@ class Bridge_bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, ZERO_STATS)
         self.assertEqual(stats_optical3, RX_100_STATS)
 
+        after = self._snapshotStats()
+
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_200, self)
+                                      before,
+                                      CLASS_TX_RX_200, self,
+                                      after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN0,
-                                        ethtool_stats_lan0,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN1,
-                                        ethtool_stats_lan1,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN2,
-                                        ethtool_stats_lan2,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN3,
-                                        ethtool_stats_lan3,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN4,
-                                        ethtool_stats_lan4,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN5,
-                                        ethtool_stats_lan5,
-                                        ETHTOOL_RX_200, self)
+                                        before,
+                                        ETHTOOL_RX_200, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN6,
-                                        ethtool_stats_lan6,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_OPTICAL3,
-                                        ethtool_stats_optical3,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
 
     def test_09_bridged_unicast_lan0(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. optical3 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_OPTICAL3,
                                   self.config.HOST_LAN0, 100, 100)
@@ -560,33 +585,44 @@ class Bridge_bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, ZERO_STATS)
         self.assertEqual(stats_optical3, TX_200_STATS)
 
+        after = self._snapshotStats()
+
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_200, self)
+                                      before,
+                                      CLASS_TX_RX_200, self,
+                                      after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN0,
-                                        ethtool_stats_lan0,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN1,
-                                        ethtool_stats_lan1,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN2,
-                                        ethtool_stats_lan2,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN3,
-                                        ethtool_stats_lan3,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN4,
-                                        ethtool_stats_lan4,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN5,
-                                        ethtool_stats_lan5,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN6,
-                                        ethtool_stats_lan6,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_OPTICAL3,
-                                        ethtool_stats_optical3,
-                                        ETHTOOL_RX_200, self)
+                                        before,
+                                        ETHTOOL_RX_200, self,
+                                        after=after)
 
     def test_10_bridged_broadcast_lan0(self):
         """Send traffic between bridged ports, and ensure they come out the
@@ -760,15 +796,7 @@ class Bridge_bridge_test(unittest2.TestCase):
         """Send traffic between ports in different bridges. The traffic is
            expected to be blocked"""
 
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN0,
                                   self.config.HOST_LAN1, 100, 100)
@@ -806,30 +834,40 @@ class Bridge_bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, TX_100_STATS)
         self.assertEqual(stats_optical3, TX_100_STATS)
 
+        after = self._snapshotStats()
+
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN0,
-                                        ethtool_stats_lan0,
-                                        ETHTOOL_RX_100, self)
+                                        before,
+                                        ETHTOOL_RX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN1,
-                                        ethtool_stats_lan1,
-                                        ETHTOOL_RX_100, self)
+                                        before,
+                                        ETHTOOL_RX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN2,
-                                        ethtool_stats_lan2,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN3,
-                                        ethtool_stats_lan3,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN4,
-                                        ethtool_stats_lan4,
-                                        ETHTOOL_RX_100, self)
+                                        before,
+                                        ETHTOOL_RX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN5,
-                                        ethtool_stats_lan5,
-                                        ETHTOOL_RX_100, self)
+                                        before,
+                                        ETHTOOL_RX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN6,
-                                        ethtool_stats_lan6,
-                                        ETHTOOL_RX_100, self)
+                                        before,
+                                        ETHTOOL_RX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_OPTICAL3,
-                                        ethtool_stats_optical3,
-                                        ETHTOOL_RX_100, self)
+                                        before,
+                                        ETHTOOL_RX_100, self,
+                                        after=after)
 
     def test_99_delete_bridge(self):
         """Destroy the bridge"""
@@ -860,11 +898,12 @@ class Bridge_bridge_test(unittest2.TestCase):
 
 if __name__ == '__main__':
     ARGS = params.params()
+    BROKER = broker.connect(ARGS.broker) if ARGS.broker else None
     CONFIG = params.readConfig(ARGS.config, fourPorts=False)
-    SUT = sut.SUT(hostname=CONFIG.hostname, key=CONFIG.key,
-                  mgmt=CONFIG.SUT_MGMT)
+    SUT = sut.fromConfig(CONFIG, BROKER)
     SUT.cleanSystem()
-    TRAFFIC = traffic.Traffic()
+    TRAFFIC = traffic.Traffic(broker=BROKER,
+                              capture=traffic.capturePolicy(ARGS))
 
     if ARGS.xml:
         TESTRUNNER = xmlrunner.XMLTestRunner(output='test-reports',
@@ -878,4 +917,5 @@ if __name__ == '__main__':
     if ARGS.hwcrosschip:
         HW_CROSS_CHIP = True
 
-    unittest2.main(buffer=False, testRunner=TESTRUNNER, exit=False)
+    unittest2.main(buffer=False, testRunner=params.HookedRunner(TESTRUNNER),
+                   exit=False)
@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 """Test the operation of a bridge on the SUT"""
 
-import time
 import unittest2
 import xmlrunner
 
+import broker
 import params
 import sut
 import traffic
@@ -78,33 +78,45 @@ class Bridge_test(unittest2.TestCase):
         self.vlan_filtering = VLAN_FILTERING
         self.hostname = CONFIG.hostname
 
+    def _snapshotStats(self):
+        """Snapshot the statistics of the master and all the ports of
+           the SUT, in one go"""
+        return self.sut.snapshotStats([self.config.SUT_MASTER,
+                                       self.config.SUT_LAN0,
+                                       self.config.SUT_LAN1,
+                                       self.config.SUT_LAN2,
+                                       self.config.SUT_LAN3,
+                                       self.config.SUT_LAN4,
+                                       self.config.SUT_LAN5,
+                                       self.config.SUT_LAN6,
+                                       self.config.SUT_OPTICAL3])
+
     def test_01_create_bridge(self):
         """Create the bridge"""
-        # Ensure all the interfaces are up
-        self.sut.up(self.config.SUT_MASTER)
-        self.sut.up(self.config.SUT_LAN0)
-        self.sut.up(self.config.SUT_LAN1)
-        self.sut.up(self.config.SUT_LAN2)
-        self.sut.up(self.config.SUT_LAN3)
-        self.sut.up(self.config.SUT_LAN4)
-        self.sut.up(self.config.SUT_LAN5)
-        self.sut.up(self.config.SUT_LAN6)
-        self.sut.up(self.config.SUT_OPTICAL3)
-
-        self.sut.addBridge('br1')
-
-        if self.vlan_filtering:
-            self.sut.bridgeEnableVlanFiltering('br1')
-
-        self.sut.up('br1')
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN1)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN2)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN3)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN4)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN6)
-
-        # Wait the forwarding delay of the bridge
-        time.sleep(10)
+        self.sut.applyTopology({
+            'up': [self.config.SUT_MASTER,
+                   self.config.SUT_LAN0,
+                   self.config.SUT_LAN1,
+                   self.config.SUT_LAN2,
+                   self.config.SUT_LAN3,
+                   self.config.SUT_LAN4,
+                   self.config.SUT_LAN5,
+                   self.config.SUT_LAN6,
+                   self.config.SUT_OPTICAL3],
+            'bridges': {
+                'br1': {
+                    'interfaces': [self.config.SUT_LAN1,
+                                   self.config.SUT_LAN2,
+                                   self.config.SUT_LAN3,
+                                   self.config.SUT_LAN4,
+                                   self.config.SUT_LAN6],
+                    'vlan_filtering': self.vlan_filtering,
+                },
+            },
+        })
+
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br1')
 
         self.traffic.addInterface(self.config.HOST_LAN0)
         self.traffic.addInterface(self.config.HOST_LAN1)
@@ -125,15 +137,7 @@ class Bridge_test(unittest2.TestCase):
            traffic on these ports, and make sure there is no traffic
            sent out other ports"""
 
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN5,
                                   self.config.HOST_LAN0, 50, 50)
@@ -165,48 +169,49 @@ class Bridge_test(unittest2.TestCase):
             self.assertEqual(stats_lan6, ZERO_STATS)
             self.assertEqual(stats_optical3, TX_100_STATS)
 
+        after = self._snapshotStats()
+
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN0,
-                                        ethtool_stats_lan0,
-                                        ETHTOOL_RX_0_BROADCAST_50, self)
+                                        before,
+                                        ETHTOOL_RX_0_BROADCAST_50, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN1,
-                                        ethtool_stats_lan1,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN2,
-                                        ethtool_stats_lan2,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN3,
-                                        ethtool_stats_lan3,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN4,
-                                        ethtool_stats_lan4,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN5,
-                                        ethtool_stats_lan5,
-                                        ETHTOOL_RX_50_BROADCAST_50, self)
+                                        before,
+                                        ETHTOOL_RX_50_BROADCAST_50, self,
+                                        after=after)
         if 'zii-devel-b' not in self.hostname:
             # The third switch does not have the hardware needed to properly
             # support cross chip bridges. Packets leak.
             self.sut.checkEthtoolStatsRange(self.config.SUT_LAN6,
-                                            ethtool_stats_lan6,
-                                            ETHTOOL_ZERO, self)
+                                            before,
+                                            ETHTOOL_ZERO, self,
+                                            after=after)
             self.sut.checkEthtoolStatsRange(self.config.SUT_OPTICAL3,
-                                            ethtool_stats_optical3,
-                                            ETHTOOL_RX_50_BROADCAST_50, self)
+                                            before,
+                                            ETHTOOL_RX_50_BROADCAST_50, self,
+                                            after=after)
 
     def test_03_bridged_unicast_lan1(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan1 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN1,
                                   self.config.HOST_LAN2, 100, 100)
@@ -237,40 +242,51 @@ class Bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, RX_100_STATS)
         self.assertEqual(stats_optical3, ZERO_STATS)
 
+        after = self._snapshotStats()
+
         # All frames should be hardware bridge
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_0, self)
+                                      before,
+                                      CLASS_TX_RX_0, self,
+                                      after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN0,
-                                        ethtool_stats_lan0,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN1,
-                                        ethtool_stats_lan1,
-                                        ETHTOOL_RX_400, self)
+                                        before,
+                                        ETHTOOL_RX_400, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN2,
-                                        ethtool_stats_lan2,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN3,
-                                        ethtool_stats_lan3,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN4,
-                                        ethtool_stats_lan4,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN5,
-                                        ethtool_stats_lan5,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN6,
-                                        ethtool_stats_lan6,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_OPTICAL3,
-                                        ethtool_stats_optical3,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
 
     def test_04_bridged_unicast_lan2(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan2 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN2,
                                   self.config.HOST_LAN1, 100, 100)
@@ -300,16 +316,19 @@ class Bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, RX_100_STATS)
         self.assertEqual(stats_optical3, ZERO_STATS)
 
+        after = self._snapshotStats()
+
         # All frames should be hardware bridge
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_0, self)
+                                      before,
+                                      CLASS_TX_RX_0, self,
+                                      after=after)
 
     def test_05_bridged_unicast_lan3(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan3 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN3,
                                   self.config.HOST_LAN1, 100, 100)
@@ -339,16 +358,19 @@ class Bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, RX_100_STATS)
         self.assertEqual(stats_optical3, ZERO_STATS)
 
+        after = self._snapshotStats()
+
         # All frames should be hardware bridge
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_0, self)
+                                      before,
+                                      CLASS_TX_RX_0, self,
+                                      after=after)
 
     def test_06_bridged_unicast_lan4(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan4 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
+        before = self._snapshotStats()
 
         self.traffic.addUDPStream(self.config.HOST_LAN4,
                                   self.config.HOST_LAN1, 100, 100)
@@ -378,10 +400,13 @@ class Bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, RX_100_STATS)
         self.assertEqual(stats_optical3, ZERO_STATS)
 
+        after = self._snapshotStats()
+
         # All frames should be hardware bridge
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_0, self)
+                                      before,
+                                      CLASS_TX_RX_0, self,
+                                      after=after)
 
     def test_07_bridged_unicast_lan6(self):
         """Send traffic between bridged ports, and ensure they come out the
@@ -592,15 +617,7 @@ class Bridge_test(unittest2.TestCase):
            traffic on these ports, and make sure there is no traffic
            sent out other ports"""
 
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        before = self._snapshotStats()
 
         self.traffic.addUDPv6Stream(self.config.HOST_LAN5,
                                     self.config.HOST_LAN0, 50, 50)
@@ -629,48 +646,49 @@ class Bridge_test(unittest2.TestCase):
             self.assertEqual(stats_lan6, ZERO_STATS)
             self.assertEqual(stats_optical3, TX_50_STATS)
 
+        after = self._snapshotStats()
+
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN0,
-                                        ethtool_stats_lan0,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN1,
-                                        ethtool_stats_lan1,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN2,
-                                        ethtool_stats_lan2,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN3,
-                                        ethtool_stats_lan3,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN4,
-                                        ethtool_stats_lan4,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN5,
-                                        ethtool_stats_lan5,
-                                        ETHTOOL_RX_50, self)
+                                        before,
+                                        ETHTOOL_RX_50, self,
+                                        after=after)
         if 'zii-devel-b' not in self.hostname:
             # The third switch does not have the hardware needed to properly
             # support cross chip bridges. Packets leak.
             self.sut.checkEthtoolStatsRange(self.config.SUT_LAN6,
-                                            ethtool_stats_lan6,
-                                            ETHTOOL_ZERO, self)
+                                            before,
+                                            ETHTOOL_ZERO, self,
+                                            after=after)
             self.sut.checkEthtoolStatsRange(self.config.SUT_OPTICAL3,
-                                            ethtool_stats_optical3,
-                                            ETHTOOL_RX_50, self)
+                                            before,
+                                            ETHTOOL_RX_50, self,
+                                            after=after)
 
     def test_15_bridged_unicast_lan1_ipv6(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan1 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        before = self._snapshotStats()
 
         self.traffic.addUDPv6Stream(self.config.HOST_LAN1,
                                     self.config.HOST_LAN2, 100, 100)
@@ -701,40 +719,51 @@ class Bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, RX_100_STATS)
         self.assertEqual(stats_optical3, ZERO_STATS)
 
+        after = self._snapshotStats()
+
         # All frames should be hardware bridge
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_0, self)
+                                      before,
+                                      CLASS_TX_RX_0, self,
+                                      after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN0,
-                                        ethtool_stats_lan0,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN1,
-                                        ethtool_stats_lan1,
-                                        ETHTOOL_RX_400, self)
+                                        before,
+                                        ETHTOOL_RX_400, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN2,
-                                        ethtool_stats_lan2,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN3,
-                                        ethtool_stats_lan3,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN4,
-                                        ethtool_stats_lan4,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN5,
-                                        ethtool_stats_lan5,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_LAN6,
-                                        ethtool_stats_lan6,
-                                        ETHTOOL_TX_100, self)
+                                        before,
+                                        ETHTOOL_TX_100, self,
+                                        after=after)
         self.sut.checkEthtoolStatsRange(self.config.SUT_OPTICAL3,
-                                        ethtool_stats_optical3,
-                                        ETHTOOL_ZERO, self)
+                                        before,
+                                        ETHTOOL_ZERO, self,
+                                        after=after)
 
     def test_16_bridged_unicast_lan2_ipv6(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan2 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
+        before = self._snapshotStats()
 
         self.traffic.addUDPv6Stream(self.config.HOST_LAN2,
                                     self.config.HOST_LAN1, 100, 100)
@@ -764,16 +793,19 @@ class Bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, RX_100_STATS)
         self.assertEqual(stats_optical3, ZERO_STATS)
 
+        after = self._snapshotStats()
+
         # All frames should be hardware bridge
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_0, self)
+                                      before,
+                                      CLASS_TX_RX_0, self,
+                                      after=after)
 
     def test_17_bridged_unicast_lan3_ipv6(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan3 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
+        before = self._snapshotStats()
 
         self.traffic.addUDPv6Stream(self.config.HOST_LAN3,
                                     self.config.HOST_LAN1, 100, 100)
@@ -803,16 +835,19 @@ class Bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, RX_100_STATS)
         self.assertEqual(stats_optical3, ZERO_STATS)
 
+        after = self._snapshotStats()
+
         # All frames should be hardware bridge
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_0, self)
+                                      before,
+                                      CLASS_TX_RX_0, self,
+                                      after=after)
 
     def test_18_bridged_unicast_lan4_ipv6(self):
         """Send traffic between bridged ports, and ensure they come out the
            expected ports. lan4 is the source"""
 
-        class_stats_master = self.sut.getClassStats(self.config.SUT_MASTER)
+        before = self._snapshotStats()
 
         self.traffic.addUDPv6Stream(self.config.HOST_LAN4,
                                     self.config.HOST_LAN1, 100, 100)
@@ -842,10 +877,13 @@ class Bridge_test(unittest2.TestCase):
         self.assertEqual(stats_lan6, RX_100_STATS)
         self.assertEqual(stats_optical3, ZERO_STATS)
 
+        after = self._snapshotStats()
+
         # All frames should be hardware bridge
         self.sut.checkClassStatsRange(self.config.SUT_MASTER,
-                                      class_stats_master,
-                                      CLASS_TX_RX_0, self)
+                                      before,
+                                      CLASS_TX_RX_0, self,
+                                      after=after)
 
     def test_19_bridged_unicast_lan6_ipv6(self):
         """Send traffic between bridged ports, and ensure they come out the
@@ -960,11 +998,12 @@ class Bridge_test(unittest2.TestCase):
 
 if __name__ == '__main__':
     ARGS = params.params()
+    BROKER = broker.connect(ARGS.broker) if ARGS.broker else None
     CONFIG = params.readConfig(ARGS.config, fourPorts=False)
-    SUT = sut.SUT(hostname=CONFIG.hostname, key=CONFIG.key,
-                  mgmt=CONFIG.SUT_MGMT)
+    SUT = sut.fromConfig(CONFIG, BROKER)
     SUT.cleanSystem()
-    TRAFFIC = traffic.Traffic()
+    TRAFFIC = traffic.Traffic(broker=BROKER,
+                              capture=traffic.capturePolicy(ARGS))
 
     if ARGS.xml:
         TESTRUNNER = xmlrunner.XMLTestRunner(output='test-reports',
@@ -975,4 +1014,5 @@ if __name__ == '__main__':
     if ARGS.vlanfiltering:
         VLAN_FILTERING = True
 
-    unittest2.main(buffer=False, testRunner=TESTRUNNER, exit=False)
+    unittest2.main(buffer=False, testRunner=params.HookedRunner(TESTRUNNER),
+                   exit=False)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""Broker which keeps the SSH sessions to the SUTs, and the connection
+   to the drone, open between test scripts. Start it with
+
+   ./broker.py --socket /tmp/dsa-tests-broker/socket
+
+   and pass --broker /tmp/dsa-tests-broker/socket to the tests. They then
+   attach to the broker over the Unix socket, rather than each making
+   its own SSH and drone connections.
+
+   Anybody who can connect can run commands on the SUTs as root. So the
+   socket is made in a directory only its user can access, and clients
+   must know the authentication key. This is taken from the
+   DSA_TESTS_BROKER_KEY environment variable if set. Otherwise the
+   broker makes a random key, and writes it to the file authkey in the
+   directory of the socket, for the clients to read."""
+import argparse
+import functools
+import os
+import stat
+import threading
+from multiprocessing.managers import BaseManager
+import paramiko
+from ostinato.core import DroneProxy
+
+import sut
+
+SOCKET = '/tmp/dsa-tests-broker/socket'
+AUTHKEY_ENV = 'DSA_TESTS_BROKER_KEY'
+AUTHKEY_FILE = 'authkey'
+
+
+class SUTSession(object):
+    """An SSH connection to a SUT, with a persistent shell, shared by
+       all the clients of the broker. Requests are serialised."""
+
+    def __init__(self, hostname, key):
+        self.hostname = hostname
+        self.key = key
+        self.lock = threading.Lock()
+        self.sshClient = None
+        self.sftpClient = None
+        self.shell = None
+
+    def _connect(self):
+        """(Re)connect to the SUT, if not connected"""
+        if self.sshClient:
+            transport = self.sshClient.get_transport()
+            if transport and transport.is_active() and \
+               not self.shell.channel.closed:
+                return
+            self.sshClient.close()
+        self.sshClient = paramiko.SSHClient()
+        self.sshClient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.sshClient.connect(self.hostname, username='root',
+                               key_filename=self.key)
+        self.sftpClient = self.sshClient.open_sftp()
+        self.shell = sut.RemoteShell(self.sshClient.get_transport())
+
+    def execute(self, command):
+        """Execute a command in the shell. Return a tuple of
+           (stdout, stderr, exit code)"""
+        with self.lock:
+            self._connect()
+            return self.shell.execute(command)
+
+    def put(self, src, dst):
+        """Copy the src file to the SUT"""
+        with self.lock:
+            self._connect()
+            self.sftpClient.put(src, dst)
+
+
+class DroneSession(object):
+    """A connection to the drone, shared by all the clients of the
+       broker. The port list and configuration are only read once."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.drone = None
+        self.port_id_list = None
+        self.port_config_list = None
+
+    def _connect(self):
+        """Connect to the drone, if not connected"""
+        if self.drone:
+            return
+        self.drone = DroneProxy('127.0.0.1')
+        self.drone.connect()
+        self.port_id_list = self.drone.getPortIdList()
+        self.port_config_list = self.drone.getPortConfig(self.port_id_list)
+
+    def ports(self):
+        """Return a tuple of the port id list and the port configuration"""
+        with self.lock:
+            self._connect()
+            return self.port_id_list, self.port_config_list
+
+    def reset(self):
+        """Delete any streams left behind by a previous client"""
+        with self.lock:
+            self._connect()
+            for port_id in self.port_id_list.port_id:
+                stream_id_list = self.drone.getStreamIdList(port_id)
+                if stream_id_list.stream_id:
+                    self.drone.deleteStream(stream_id_list)
+
+    def call(self, method, *args):
+        """Call a DroneProxy method"""
+        with self.lock:
+            self._connect()
+            return getattr(self.drone, method)(*args)
+
+
+class SharedDrone(object):
+    """Stands in for a DroneProxy in the client, passing the calls to
+       the DroneSession in the broker. Capture files are saved by the
+       client, so they end up in its working directory."""
+
+    def __init__(self, session):
+        self.session = session
+        self.session.reset()
+
+    def connect(self):
+        """The broker is already connected"""
+        pass
+
+    def disconnect(self):
+        """The broker stays connected"""
+        pass
+
+    def getPortIdList(self):
+        """Return the port id list read by the broker"""
+        port_id_list, _ = self.session.ports()
+        return port_id_list
+
+    def getPortConfig(self, _port_id_list):
+        """Return the port configuration read by the broker"""
+        _, port_config_list = self.session.ports()
+        return port_config_list
+
+    def saveCaptureBuffer(self, buff, filename):
+        """Save a capture buffer into a file"""
+        with open(filename, 'wb') as capture:
+            capture.write(buff)
+
+    def __getattr__(self, name):
+        return functools.partial(self.session.call, name)
+
+
+SUT_SESSIONS = {}
+SUT_SESSIONS_LOCK = threading.Lock()
+DRONE_SESSION = DroneSession()
+
+
+def _sutSession(hostname, key):
+    """Return the session for the SUT, creating it if needed"""
+    with SUT_SESSIONS_LOCK:
+        if hostname not in SUT_SESSIONS:
+            SUT_SESSIONS[hostname] = SUTSession(hostname, key)
+        return SUT_SESSIONS[hostname]
+
+
+def _droneSession():
+    """Return the drone session"""
+    return DRONE_SESSION
+
+
+class BrokerManager(BaseManager):
+    """The broker, and the client's connection to it"""
+
+    def sharedDrone(self):
+        """Return an object which can be used in place of a DroneProxy"""
+        return SharedDrone(self.drone())
+
+
+BrokerManager.register('sut', callable=_sutSession,
+                       exposed=('execute', 'put'))
+BrokerManager.register('drone', callable=_droneSession,
+                       exposed=('ports', 'reset', 'call'))
+
+
+def _authkeyFile(address):
+    """Return the name of the file holding the key of the broker"""
+    return os.path.join(os.path.dirname(os.path.abspath(address)),
+                        AUTHKEY_FILE)
+
+
+def _privateDirectory(directory):
+    """Make the directory, accessible only by us, if it does not exist.
+       Refuse to use one which others can access"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    info = os.stat(directory)
+    if info.st_uid != os.getuid() or \
+       stat.S_IMODE(info.st_mode) & (stat.S_IRWXG | stat.S_IRWXO):
+        raise NameError('{0} must be owned by us with mode 0700'.format(
+            directory))
+
+
+def connect(address=SOCKET):
+    """Attach to a running broker. Return the BrokerManager, whose sut()
+       method returns a proxy for the session to a SUT"""
+    authkey = os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        with open(_authkeyFile(address)) as keyfile:
+            authkey = keyfile.read().strip()
+    manager = BrokerManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager
+
+
+def main():
+    """Run the broker until killed"""
+    parser = argparse.ArgumentParser(description='Run the session broker.')
+    parser.add_argument("--socket", "-s", help="Unix socket to listen on",
+                        default=SOCKET)
+    args = parser.parse_args()
+
+    _privateDirectory(os.path.dirname(os.path.abspath(args.socket)))
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    authkey = os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        authkey = os.urandom(16).encode('hex')
+        keyfile = os.open(_authkeyFile(args.socket),
+                          os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(keyfile, 'w') as keyfile:
+            keyfile.write(authkey + '\n')
+    manager = BrokerManager(address=args.socket, authkey=authkey)
+    server = manager.get_server()
+    os.chmod(args.socket, 0o600)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,8 @@ import subprocess
 import socket
 import struct
 
+import tracing
+
 DEBUG = False
 
 
@@ -29,12 +31,14 @@ class HOST(object):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
                                   socket.IPPROTO_UDP)
 
+    @tracing.traced('host')
     def _check_call(self, command):
         """Call the given command, breaking the string up on spaces.
            Will go horribly wrong for quoted strings etc."""
         args = command.split(' ')
         subprocess.check_call(args)
 
+    @tracing.traced('host')
     def _call(self, command):
         """Call the given command, breaking the string up on spaces.
            Will go horribly wrong for quoted strings etc."""
@@ -42,6 +46,7 @@ class HOST(object):
         args = command.split(' ')
         return subprocess.call(args, stdin=None, stdout=null, stderr=null)
 
+    @tracing.traced('host')
     def _communicate(self, command):
         """Execute a command and return a tuple of (stdout, stderr)"""
         args = command.split(' ')
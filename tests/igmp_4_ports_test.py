@@ -5,6 +5,7 @@ import time
 import unittest2
 import xmlrunner
 
+import broker
 import host
 import params
 import sut
@@ -16,6 +17,8 @@ HOST = host
 TRAFFIC = None
 CONFIG = None
 VLAN_FILTERING = False
+# When the host joined the group, to measure how long the SUT took
+JOIN_TIME = None
 CHANNEL = None
 
 ethtool_rx_0_tx_0 = {'in_multicasts': (0, 20),
@@ -42,27 +45,28 @@ class igmp_4_port_test(unittest2.TestCase):
 
     def test_01_setup_sut(self):
         """Create the bridge"""
-        # Ensure all the interfaces are up
-        self.sut.up(self.config.SUT_MASTER)
-        self.sut.up(self.config.SUT_LAN0)
-        self.sut.up(self.config.SUT_LAN1)
-        self.sut.up(self.config.SUT_LAN2)
-        self.sut.up(self.config.SUT_LAN3)
+        with self.sut.batch():
+            # Ensure all the interfaces are up
+            self.sut.up(self.config.SUT_MASTER)
+            self.sut.up(self.config.SUT_LAN0)
+            self.sut.up(self.config.SUT_LAN1)
+            self.sut.up(self.config.SUT_LAN2)
+            self.sut.up(self.config.SUT_LAN3)
 
-        self.sut.addBridge('br1')
-        self.sut.addBridgeIgmpQuerier('br1')
+            self.sut.addBridge('br1')
+            self.sut.addBridgeIgmpQuerier('br1')
 
-        if self.vlan_filtering:
-            self.sut.bridgeEnableVlanFiltering('br1')
+            if self.vlan_filtering:
+                self.sut.bridgeEnableVlanFiltering('br1')
 
-        self.sut.up('br1')
-        self.sut.addAddress('br1', '192.168.58.42/24')
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN0)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN1)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN2)
+            self.sut.up('br1')
+            self.sut.addAddress('br1', '192.168.58.42/24')
+            self.sut.addBridgeInterface('br1', self.config.SUT_LAN0)
+            self.sut.addBridgeInterface('br1', self.config.SUT_LAN1)
+            self.sut.addBridgeInterface('br1', self.config.SUT_LAN2)
 
-        # Wait the forwarding delay of the bridge
-        time.sleep(10)
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br1')
 
     def test_02_setup_host(self):
         """Setup on the host, perform learning"""
@@ -93,12 +97,17 @@ class igmp_4_port_test(unittest2.TestCase):
         """Join a group on LAN1 and LAN2. LAN0 is does not join, so snooping
            should mean it does not receive multicast frames for this group"""
 
+        global JOIN_TIME
+        JOIN_TIME = time.time()
         self.host.join(self.config.HOST_LAN1, '192.168.58.2', '224.42.42.42')
         self.host.join(self.config.HOST_LAN2, '192.168.58.3', '224.42.42.42')
 
-    def test_04_sleep(self):
-        """Sleep for a while to allow IGMP to be exchanged"""
-        time.sleep(10)
+    def test_04_wait_mdb(self):
+        """Wait for the joins to be snooped and installed in the MDB"""
+        self.sut.waitMdb('br1', '224.42.42.42',
+                         [self.config.SUT_LAN1,
+                          self.config.SUT_LAN2],
+                         since=JOIN_TIME)
 
     def test_05_multicast_lan1(self):
         """Send some multicast packets out LAN1. We expect to receive them on
@@ -194,7 +203,7 @@ class igmp_4_port_test(unittest2.TestCase):
         """Have the sut join the group on the bridge interface"""
         global CHANNEL
         CHANNEL = self.sut.start_ssh('join-mcast-group')
-        time.sleep(60)
+        self.sut.waitMdb('br1', '224.42.42.42', ['br1'])
 
     def test_09_multicast_lan1(self):
 
@@ -254,12 +263,13 @@ class igmp_4_port_test(unittest2.TestCase):
 
 if __name__ == '__main__':
     args = params.params()
+    BROKER = broker.connect(args.broker) if args.broker else None
     CONFIG = params.readConfig(args.config)
-    SUT = sut.SUT(hostname=CONFIG.hostname, key=CONFIG.key,
-                  mgmt=CONFIG.SUT_MGMT)
+    SUT = sut.fromConfig(CONFIG, BROKER)
     SUT.cleanSystem()
     HOST = host.HOST()
-    TRAFFIC = traffic.Traffic()
+    TRAFFIC = traffic.Traffic(broker=BROKER,
+                              capture=traffic.capturePolicy(args))
 
     if args.xml:
         testRunner = xmlrunner.XMLTestRunner(output='test-reports',
@@ -270,5 +280,6 @@ if __name__ == '__main__':
     if args.vlanfiltering:
         VLAN_FILTERING = True
 
-    unittest2.main(buffer=False, testRunner=testRunner, exit=False)
+    unittest2.main(buffer=False, testRunner=params.HookedRunner(testRunner),
+                   exit=False)
     HOST.cleanSystem()
@@ -5,6 +5,7 @@ import time
 import unittest2
 import xmlrunner
 
+import broker
 import host
 import params
 import sut
@@ -16,6 +17,8 @@ HOST = host
 TRAFFIC = None
 CONFIG = None
 VLAN_FILTERING = False
+# When the host joined the group, to measure how long the SUT took
+JOIN_TIME = None
 
 ethtool_rx_0_tx_0 = {'in_multicasts': (0, 20),
                      'out_multicasts': (0, 20)}
@@ -40,6 +43,19 @@ class igmp_test(unittest2.TestCase):
         self.vlan_filtering = VLAN_FILTERING
         self.hostname = CONFIG.hostname
 
+    def _getEthtoolStats(self):
+        """Get the ethtool statistics of all the ports at once"""
+        async_sut = sut.AsyncSUT(self.sut)
+        return sut.gather(*[async_sut.getEthtoolStats(interface)
+                            for interface in (self.config.SUT_LAN0,
+                                              self.config.SUT_LAN1,
+                                              self.config.SUT_LAN2,
+                                              self.config.SUT_LAN3,
+                                              self.config.SUT_LAN4,
+                                              self.config.SUT_LAN5,
+                                              self.config.SUT_LAN6,
+                                              self.config.SUT_OPTICAL3)])
+
     def _check_zero(self,
                     ethtool_stats_lan0, ethtool_stats_lan3,
                     ethtool_stats_lan4, ethtool_stats_lan5,
@@ -73,33 +89,32 @@ class igmp_test(unittest2.TestCase):
 
     def test_01_setup_sut(self):
         """Create the bridge"""
-        # Ensure all the interfaces are up
-        self.sut.up(self.config.SUT_MASTER)
-        self.sut.up(self.config.SUT_LAN0)
-        self.sut.up(self.config.SUT_LAN1)
-        self.sut.up(self.config.SUT_LAN2)
-        self.sut.up(self.config.SUT_LAN3)
-        self.sut.up(self.config.SUT_LAN4)
-        self.sut.up(self.config.SUT_LAN5)
-        self.sut.up(self.config.SUT_LAN6)
-        self.sut.up(self.config.SUT_OPTICAL3)
-
-        self.sut.addBridge('br1')
-        self.sut.addBridgeIgmpQuerier('br1')
-
-        if self.vlan_filtering:
-            self.sut.bridgeEnableVlanFiltering('br1')
-
-        self.sut.up('br1')
-        self.sut.addAddress('br1', '192.168.58.42/24')
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN1)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN2)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN3)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN4)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN6)
-
-        # Wait the forwarding delay of the bridge
-        time.sleep(10)
+        self.sut.applyTopology({
+            'up': [self.config.SUT_MASTER,
+                   self.config.SUT_LAN0,
+                   self.config.SUT_LAN1,
+                   self.config.SUT_LAN2,
+                   self.config.SUT_LAN3,
+                   self.config.SUT_LAN4,
+                   self.config.SUT_LAN5,
+                   self.config.SUT_LAN6,
+                   self.config.SUT_OPTICAL3],
+            'bridges': {
+                'br1': {
+                    'interfaces': [self.config.SUT_LAN1,
+                                   self.config.SUT_LAN2,
+                                   self.config.SUT_LAN3,
+                                   self.config.SUT_LAN4,
+                                   self.config.SUT_LAN6],
+                    'vlan_filtering': self.vlan_filtering,
+                    'igmp_querier': True,
+                },
+            },
+            'addresses': {'br1': ['192.168.58.42/24']},
+        })
+
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br1')
 
     def test_02_setup_host(self):
         """Setup on the host, perform learning"""
@@ -148,27 +163,27 @@ class igmp_test(unittest2.TestCase):
            snooping should mean they does not receive multicast frames
            for this group"""
 
+        global JOIN_TIME
+        JOIN_TIME = time.time()
         self.host.join(self.config.HOST_LAN1, '192.168.58.2', '224.42.42.42')
         self.host.join(self.config.HOST_LAN2, '192.168.58.3', '224.42.42.42')
         self.host.join(self.config.HOST_LAN6, '192.168.58.7', '224.42.42.42')
 
-    def test_04_sleep(self):
-        """Sleep for a while to allow IGMP to be exchanged"""
-        time.sleep(10)
+    def test_04_wait_mdb(self):
+        """Wait for the joins to be snooped and installed in the MDB"""
+        self.sut.waitMdb('br1', '224.42.42.42',
+                         [self.config.SUT_LAN1,
+                          self.config.SUT_LAN2,
+                          self.config.SUT_LAN6],
+                         since=JOIN_TIME)
 
     def test_05_multicast_lan0(self):
         """Send some multicast packets out LAN0. We don't expect to receive
            them on any port."""
 
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        (ethtool_stats_lan0, ethtool_stats_lan1, ethtool_stats_lan2,
+         ethtool_stats_lan3, ethtool_stats_lan4, ethtool_stats_lan5,
+         ethtool_stats_lan6, ethtool_stats_optical3) = self._getEthtoolStats()
 
         self.traffic.addUDPMulticastStream(self.config.HOST_LAN0,
                                            '224.42.42.42', 500, 500)
@@ -213,15 +228,9 @@ class igmp_test(unittest2.TestCase):
         """Send some multicast packets out LAN1. We expect to receive them on
            LAN2 and LAN6, but not any other port."""
 
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        (ethtool_stats_lan0, ethtool_stats_lan1, ethtool_stats_lan2,
+         ethtool_stats_lan3, ethtool_stats_lan4, ethtool_stats_lan5,
+         ethtool_stats_lan6, ethtool_stats_optical3) = self._getEthtoolStats()
 
         self.traffic.addUDPMulticastStream(self.config.HOST_LAN1,
                                            '224.42.42.42', 500, 500)
@@ -247,15 +256,9 @@ class igmp_test(unittest2.TestCase):
         """Send some multicast packets out LAN2. We expect to receive them on
            LAN1 and LAN6, but not any other port."""
 
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        (ethtool_stats_lan0, ethtool_stats_lan1, ethtool_stats_lan2,
+         ethtool_stats_lan3, ethtool_stats_lan4, ethtool_stats_lan5,
+         ethtool_stats_lan6, ethtool_stats_optical3) = self._getEthtoolStats()
 
         self.traffic.addUDPMulticastStream(self.config.HOST_LAN2,
                                            '224.42.42.42', 500, 500)
@@ -281,15 +284,9 @@ class igmp_test(unittest2.TestCase):
         """Send some multicast packets out LAN3. We expect to receive them on
            LAN1, LAN2 and LAN6, but not any other port."""
 
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        (ethtool_stats_lan0, ethtool_stats_lan1, ethtool_stats_lan2,
+         ethtool_stats_lan3, ethtool_stats_lan4, ethtool_stats_lan5,
+         ethtool_stats_lan6, ethtool_stats_optical3) = self._getEthtoolStats()
 
         self.traffic.addUDPMulticastStream(self.config.HOST_LAN3,
                                            '224.42.42.42', 500, 500)
@@ -319,15 +316,9 @@ class igmp_test(unittest2.TestCase):
         """Send some multicast packets out LAN4. We expect to receive them on
            LAN1, LAN2 and LAN6, but not any other port."""
 
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        (ethtool_stats_lan0, ethtool_stats_lan1, ethtool_stats_lan2,
+         ethtool_stats_lan3, ethtool_stats_lan4, ethtool_stats_lan5,
+         ethtool_stats_lan6, ethtool_stats_optical3) = self._getEthtoolStats()
 
         self.traffic.addUDPMulticastStream(self.config.HOST_LAN4,
                                            '224.42.42.42', 500, 500)
@@ -357,15 +348,9 @@ class igmp_test(unittest2.TestCase):
         """Send some multicast packets out LAN5. We don't expect to receive
            them on any port."""
 
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        (ethtool_stats_lan0, ethtool_stats_lan1, ethtool_stats_lan2,
+         ethtool_stats_lan3, ethtool_stats_lan4, ethtool_stats_lan5,
+         ethtool_stats_lan6, ethtool_stats_optical3) = self._getEthtoolStats()
 
         self.traffic.addUDPMulticastStream(self.config.HOST_LAN5,
                                            '224.42.42.42', 500, 500)
@@ -410,15 +395,9 @@ class igmp_test(unittest2.TestCase):
         """Send some multicast packets out LAN6. We expect to receive them on
            LAN1 and LAN2, but not any other port."""
 
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        (ethtool_stats_lan0, ethtool_stats_lan1, ethtool_stats_lan2,
+         ethtool_stats_lan3, ethtool_stats_lan4, ethtool_stats_lan5,
+         ethtool_stats_lan6, ethtool_stats_optical3) = self._getEthtoolStats()
 
         self.traffic.addUDPMulticastStream(self.config.HOST_LAN6,
                                            '224.42.42.42', 500, 500)
@@ -444,15 +423,9 @@ class igmp_test(unittest2.TestCase):
         """Send some multicast packets out optical3. We don't expect to receive
            them on any port."""
 
-        ethtool_stats_lan0 = self.sut.getEthtoolStats(self.config.SUT_LAN0)
-        ethtool_stats_lan1 = self.sut.getEthtoolStats(self.config.SUT_LAN1)
-        ethtool_stats_lan2 = self.sut.getEthtoolStats(self.config.SUT_LAN2)
-        ethtool_stats_lan3 = self.sut.getEthtoolStats(self.config.SUT_LAN3)
-        ethtool_stats_lan4 = self.sut.getEthtoolStats(self.config.SUT_LAN4)
-        ethtool_stats_lan5 = self.sut.getEthtoolStats(self.config.SUT_LAN5)
-        ethtool_stats_lan6 = self.sut.getEthtoolStats(self.config.SUT_LAN6)
-        ethtool_stats_optical3 = self.sut.getEthtoolStats(
-            self.config.SUT_OPTICAL3)
+        (ethtool_stats_lan0, ethtool_stats_lan1, ethtool_stats_lan2,
+         ethtool_stats_lan3, ethtool_stats_lan4, ethtool_stats_lan5,
+         ethtool_stats_lan6, ethtool_stats_optical3) = self._getEthtoolStats()
 
         self.traffic.addUDPMulticastStream(self.config.HOST_OPTICAL3,
                                            '224.42.42.42', 500, 500)
@@ -511,12 +484,13 @@ class igmp_test(unittest2.TestCase):
 
 if __name__ == '__main__':
     args = params.params()
+    BROKER = broker.connect(args.broker) if args.broker else None
     CONFIG = params.readConfig(args.config, fourPorts=False)
-    SUT = sut.SUT(hostname=CONFIG.hostname, key=CONFIG.key,
-                  mgmt=CONFIG.SUT_MGMT)
+    SUT = sut.fromConfig(CONFIG, BROKER)
     SUT.cleanSystem()
     HOST = host.HOST()
-    TRAFFIC = traffic.Traffic()
+    TRAFFIC = traffic.Traffic(broker=BROKER,
+                              capture=traffic.capturePolicy(args))
 
     if args.xml:
         testRunner = xmlrunner.XMLTestRunner(output='test-reports',
@@ -527,5 +501,6 @@ if __name__ == '__main__':
     if args.vlanfiltering:
         VLAN_FILTERING = True
 
-    unittest2.main(buffer=False, testRunner=testRunner, exit=False)
+    unittest2.main(buffer=False, testRunner=params.HookedRunner(testRunner),
+                   exit=False)
     HOST.cleanSystem()
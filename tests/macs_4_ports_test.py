@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 """Test lots of MAC addresses on a bridge of four ports"""
 
-import time
+import re
 import netaddr
 import unittest2
 import xmlrunner
 
+import broker
 import params
 import sut
 import traffic
@@ -15,6 +16,7 @@ TRAFFIC = None
 CONFIG = None
 
 MAC_STEP = 7
+KERNEL_EVENT_TIMEOUT = 10
 
 
 class macs_4_ports_test(unittest2.TestCase):
@@ -47,6 +49,7 @@ class macs_4_ports_test(unittest2.TestCase):
            well as the well know multicast addresses, the bridge MAC
            and the expected additional MAC addresses."""
         additional = []
+        macs = set(macs)
 
         eui_base = netaddr.EUI(base)
         int_base = int(eui_base)
@@ -75,30 +78,30 @@ class macs_4_ports_test(unittest2.TestCase):
                 return False
         return True
 
-    def _check_dmesg_contains(self, string):
-        """Check that the output of dmesg contains string"""
-        dmsg = self.sut.getDmsg()
-        for line in dmsg.splitlines():
-            if string in line:
-                return True
-        return False
+    def _check_dmesg_contains(self, cursor, string):
+        """Check that the kernel log since the cursor contains string,
+           waiting for it to be logged if needed"""
+        event = self.sut.waitForKernelEvent(re.escape(string),
+                                            KERNEL_EVENT_TIMEOUT, cursor)
+        return event is not None
 
     def test_01_create_bridge(self):
         """Create the bridge"""
-        # Ensure all the interfaces are up
-        self.sut.up(self.config.SUT_MASTER)
-        self.sut.up(self.config.SUT_LAN0)
-        self.sut.up(self.config.SUT_LAN1)
-        self.sut.up(self.config.SUT_LAN2)
-
-        self.sut.addBridge('br1')
-        self.sut.up('br1')
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN0)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN1)
-        self.sut.addBridgeInterface('br1', self.config.SUT_LAN2)
-
-        # Wait the forwarding delay of the bridge
-        time.sleep(10)
+        with self.sut.batch():
+            # Ensure all the interfaces are up
+            self.sut.up(self.config.SUT_MASTER)
+            self.sut.up(self.config.SUT_LAN0)
+            self.sut.up(self.config.SUT_LAN1)
+            self.sut.up(self.config.SUT_LAN2)
+
+            self.sut.addBridge('br1')
+            self.sut.up('br1')
+            self.sut.addBridgeInterface('br1', self.config.SUT_LAN0)
+            self.sut.addBridgeInterface('br1', self.config.SUT_LAN1)
+            self.sut.addBridgeInterface('br1', self.config.SUT_LAN2)
+
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br1')
 
         self.traffic.addInterface(self.config.HOST_LAN0)
         self.traffic.addInterface(self.config.HOST_LAN1)
@@ -112,9 +115,10 @@ class macs_4_ports_test(unittest2.TestCase):
     def test_03_interface_macs(self):
         """Test the MAC addresses associated with the interfaces has been
            learnt, and on the correct ports"""
-        macs_lan0 = self.sut.getFdb(self.config.SUT_LAN0)
-        macs_lan1 = self.sut.getFdb(self.config.SUT_LAN1)
-        macs_lan2 = self.sut.getFdb(self.config.SUT_LAN2)
+        fdb = self.sut.getFdbTable()
+        macs_lan0 = fdb.macs(self.config.SUT_LAN0, flag='self')
+        macs_lan1 = fdb.macs(self.config.SUT_LAN1, flag='self')
+        macs_lan2 = fdb.macs(self.config.SUT_LAN2, flag='self')
         mac_bridge = self.sut.getMacAddress(self.config.SUT_MASTER)
 
         mac_lan0 = self.traffic.getInterfaceMacAddress(self.config.HOST_LAN0)
@@ -154,9 +158,10 @@ class macs_4_ports_test(unittest2.TestCase):
                                         src_mac, 128, 50, 128, MAC_STEP)
         self.traffic.run()
 
-        macs_lan0 = self.sut.getFdb(self.config.SUT_LAN0)
-        macs_lan1 = self.sut.getFdb(self.config.SUT_LAN1)
-        macs_lan2 = self.sut.getFdb(self.config.SUT_LAN2)
+        fdb = self.sut.getFdbTable()
+        macs_lan0 = fdb.macs(self.config.SUT_LAN0, flag='self')
+        macs_lan1 = fdb.macs(self.config.SUT_LAN1, flag='self')
+        macs_lan2 = fdb.macs(self.config.SUT_LAN2, flag='self')
         mac_bridge = self.sut.getMacAddress(self.config.SUT_MASTER)
 
         mac_lan0 = self.traffic.getInterfaceMacAddress(self.config.HOST_LAN0)
@@ -202,9 +207,10 @@ class macs_4_ports_test(unittest2.TestCase):
                                         src_mac, 340, 100, 340, MAC_STEP)
         self.traffic.run()
 
-        macs_lan0 = self.sut.getFdb(self.config.SUT_LAN0)
-        macs_lan1 = self.sut.getFdb(self.config.SUT_LAN1)
-        macs_lan2 = self.sut.getFdb(self.config.SUT_LAN2)
+        fdb = self.sut.getFdbTable()
+        macs_lan0 = fdb.macs(self.config.SUT_LAN0, flag='self')
+        macs_lan1 = fdb.macs(self.config.SUT_LAN1, flag='self')
+        macs_lan2 = fdb.macs(self.config.SUT_LAN2, flag='self')
         mac_bridge = self.sut.getMacAddress(self.config.SUT_MASTER)
 
         mac_lan0 = self.traffic.getInterfaceMacAddress(self.config.HOST_LAN0)
@@ -249,11 +255,16 @@ class macs_4_ports_test(unittest2.TestCase):
         self.traffic.addUDPMacIncStream(self.config.HOST_LAN2,
                                         self.config.HOST_LAN0,
                                         src_mac, 1024, 100, 1024, MAC_STEP)
+        # Follow the ATU filling up as the addresses are learnt
+        self.sut.startAtuSampler()
         self.traffic.run()
+        sampler = self.sut.stopAtuSampler()
+        sut.dbg_print('ATU fill rate {0}/s'.format(sampler.rate()))
 
-        macs_lan0 = self.sut.getFdb(self.config.SUT_LAN0)
-        macs_lan1 = self.sut.getFdb(self.config.SUT_LAN1)
-        macs_lan2 = self.sut.getFdb(self.config.SUT_LAN2)
+        fdb = self.sut.getFdbTable()
+        macs_lan0 = fdb.macs(self.config.SUT_LAN0, flag='self')
+        macs_lan1 = fdb.macs(self.config.SUT_LAN1, flag='self')
+        macs_lan2 = fdb.macs(self.config.SUT_LAN2, flag='self')
         mac_bridge = self.sut.getMacAddress(self.config.SUT_MASTER)
 
         mac_lan0 = self.traffic.getInterfaceMacAddress(self.config.HOST_LAN0)
@@ -287,27 +298,31 @@ class macs_4_ports_test(unittest2.TestCase):
            This is one more than it can contain, so should trigger a
            full violation"""
 
-        # 6352
-        self.sut.addFdb(self.config.SUT_LAN0, "00:11:20:30:80:00")
-        self.sut.addFdb(self.config.SUT_LAN0, "00:11:20:30:a9:66")
-        self.sut.addFdb(self.config.SUT_LAN0, "00:11:20:30:d5:4c")
-        self.sut.addFdb(self.config.SUT_LAN0, "00:11:20:30:fc:2a")
-        self.sut.addFdb(self.config.SUT_LAN0, "00:11:20:31:3c:17")
-
-        # 6390
-        self.sut.addFdb(self.config.SUT_LAN0, '00:11:20:30:40:00')
-        self.sut.addFdb(self.config.SUT_LAN0, '00:11:20:30:40:c0')
-        self.sut.addFdb(self.config.SUT_LAN0, '00:11:20:30:43:c0')
-        self.sut.addFdb(self.config.SUT_LAN0, '00:11:20:30:69:66')
-        self.sut.addFdb(self.config.SUT_LAN0, '00:11:20:30:6a:a6')
-
-        self.assertTrue(self._check_dmesg_contains('ATU full violation'))
+        cursor = self.sut.getKmsgCursor()
+        lan0 = self.config.SUT_LAN0
+        self.sut.addFdbBulk([
+            # 6352
+            (lan0, '00:11:20:30:80:00'),
+            (lan0, '00:11:20:30:a9:66'),
+            (lan0, '00:11:20:30:d5:4c'),
+            (lan0, '00:11:20:30:fc:2a'),
+            (lan0, '00:11:20:31:3c:17'),
+            # 6390
+            (lan0, '00:11:20:30:40:00'),
+            (lan0, '00:11:20:30:40:c0'),
+            (lan0, '00:11:20:30:43:c0'),
+            (lan0, '00:11:20:30:69:66'),
+            (lan0, '00:11:20:30:6a:a6')])
+
+        self.assertTrue(self._check_dmesg_contains(cursor,
+                                                   'ATU full violation'))
         self.sut.flushFdb()
 
     def test_08_atu_member_violation(self):
         """Add a static FBD entry lan0. Send a packet with the same source
            address from lan2. This should trigger a member violation"""
 
+        cursor = self.sut.getKmsgCursor()
         self.sut.addFdb(self.config.SUT_LAN0, '00:11:20:30:80:00')
 
         src_mac = 0x001120308000
@@ -316,7 +331,8 @@ class macs_4_ports_test(unittest2.TestCase):
                                         src_mac, 1, 50, 1, 0)
         self.traffic.run()
 
-        self.assertTrue(self._check_dmesg_contains('ATU member violation'))
+        self.assertTrue(self._check_dmesg_contains(cursor,
+                                                   'ATU member violation'))
 
         # Flush the Fdb we have added
         self.sut.flushFdb()
@@ -339,11 +355,12 @@ class macs_4_ports_test(unittest2.TestCase):
 
 if __name__ == '__main__':
     ARGS = params.params()
+    BROKER = broker.connect(ARGS.broker) if ARGS.broker else None
     CONFIG = params.readConfig(ARGS.config)
-    SUT = sut.SUT(hostname=CONFIG.hostname, key=CONFIG.key,
-                  mgmt=CONFIG.SUT_MGMT)
+    SUT = sut.fromConfig(CONFIG, BROKER)
     SUT.cleanSystem()
-    TRAFFIC = traffic.Traffic()
+    TRAFFIC = traffic.Traffic(broker=BROKER,
+                              capture=traffic.capturePolicy(ARGS))
 
     if ARGS.xml:
         TESTRUNNER = xmlrunner.XMLTestRunner(output='test-reports',
@@ -352,4 +369,5 @@ if __name__ == '__main__':
         TESTRUNNER = unittest2.TextTestRunner(failfast=ARGS.failfast,
                                               verbosity=ARGS.verbose)
 
-    unittest2.main(buffer=False, testRunner=TESTRUNNER, exit=False)
+    unittest2.main(buffer=False, testRunner=params.HookedRunner(TESTRUNNER),
+                   exit=False)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""A stand in for the System Under Test, using a network namespace on
+   this machine. Each port of the SUT is one end of a veth pair, the
+   other end being the host interface it is cabled to. The master
+   interface is also a veth, whose peer is left unused in the namespace.
+   Bridges are Linux software bridges.
+
+   Select it with the netns option in the sut section of the board
+   configuration, e.g. board-configs/netns.conf. The namespace and
+   interfaces are created when first needed, and left in place for the
+   next test.
+
+   veth interfaces do not count unicast, multicast and broadcast packets
+   separately, as the switch ports do. So this module, run with the
+   names of the ports as arguments, counts the packets on the ports with
+   packet sockets, and writes the counts as a line of JSON each time it
+   reads a line."""
+import json
+import os
+import select
+import signal
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+
+import sut
+
+# The ethtool statistics of a switch port the tests check
+ETHTOOL_STATS = ['rx_packets', 'tx_packets', 'in_unicast', 'out_unicast',
+                 'in_multicasts', 'out_multicasts', 'in_broadcasts',
+                 'out_broadcasts']
+ETH_P_ALL = 0x0003
+PACKET_OUTGOING = 4
+# Only the Ethernet header of each packet is needed
+HEADER_LEN = 14
+COUNTER_RCVBUF = 4 * 1024 * 1024
+BROADCAST = '\xff' * 6
+
+
+class LocalChannel(object):
+    """A command running in the namespace, which looks enough like a
+       paramiko channel for start_ssh() users"""
+
+    def __init__(self, args):
+        # In its own process group, so that close() also kills any
+        # children, which would otherwise keep stdout open
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        preexec_fn=os.setsid)
+        self.closed = False
+
+    def _ready(self, pipe):
+        """Is there data to read from the pipe"""
+        return bool(select.select([pipe], [], [], 0)[0])
+
+    def recv(self, size):
+        """Read from stdout, returning '' at the end"""
+        return os.read(self.process.stdout.fileno(), size)
+
+    def recv_ready(self):
+        """Is there data to read from stdout"""
+        return self._ready(self.process.stdout)
+
+    def recv_stderr(self, size):
+        """Read from stderr, returning '' at the end"""
+        return os.read(self.process.stderr.fileno(), size)
+
+    def recv_stderr_ready(self):
+        """Is there data to read from stderr"""
+        return self._ready(self.process.stderr)
+
+    def exit_status_ready(self):
+        """Has the command exited"""
+        return self.process.poll() is not None
+
+    def sendall(self, data):
+        """Write to stdin"""
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def close(self):
+        """Kill the command"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGTERM)
+        self.process.wait()
+
+
+def _countPacket(counts, header, pkttype):
+    """Count the packet in the ethtool statistics of its port"""
+    if pkttype == PACKET_OUTGOING:
+        direction = 'out_'
+        counts['tx_packets'] += 1
+    else:
+        direction = 'in_'
+        counts['rx_packets'] += 1
+    if header[:6] == BROADCAST:
+        counts[direction + 'broadcasts'] += 1
+    elif ord(header[0]) & 0x01:
+        counts[direction + 'multicasts'] += 1
+    else:
+        counts[direction + 'unicast'] += 1
+
+
+def _drain(sockets, counts):
+    """Count all the packets waiting on the sockets"""
+    for interface, sock in sockets.items():
+        while True:
+            try:
+                header, address = sock.recvfrom(HEADER_LEN)
+            except socket.error:
+                break
+            _countPacket(counts[interface], header, address[2])
+
+
+def countPackets(interfaces):
+    """Count the packets on the interfaces, until stdin is closed. For
+       each line read, the packets waiting are counted, and the counts
+       of all the interfaces written as a line of JSON"""
+    sockets = {}
+    for interface in interfaces:
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                             socket.htons(ETH_P_ALL))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, COUNTER_RCVBUF)
+        sock.bind((interface, ETH_P_ALL))
+        sock.setblocking(0)
+        sockets[interface] = sock
+    counts = dict((interface, dict.fromkeys(ETHTOOL_STATS, 0))
+                  for interface in interfaces)
+    readers = [sys.stdin] + list(sockets.values())
+    while True:
+        ready = select.select(readers, [], [])[0]
+        _drain(sockets, counts)
+        if sys.stdin in ready:
+            if not sys.stdin.readline():
+                return
+            sys.stdout.write(json.dumps(counts) + '\n')
+            sys.stdout.flush()
+
+
+class PacketCounter(object):
+    """The packet counter running in the namespace. It is shared by the
+       copies of the NetnsSUT AsyncSUT makes, so the exchanges with it
+       are serialised"""
+
+    def __init__(self, channel, namespace):
+        self.channel = channel
+        self.namespace = namespace
+        self.output = ''
+        self.lock = threading.Lock()
+
+    def counts(self):
+        """Return the ethtool statistics of all the ports, counted since
+           the counter was started"""
+        with self.lock:
+            self.channel.sendall('\n')
+            while '\n' not in self.output:
+                data = self.channel.recv(4096)
+                if not data:
+                    raise NameError(
+                        'Packet counter in {0} exited: {1}'.format(
+                            self.namespace, self.channel.recv_stderr(4096)))
+                self.output += data
+            line, self.output = self.output.split('\n', 1)
+        return json.loads(line)
+
+    def close(self):
+        """Stop the counter"""
+        self.channel.close()
+
+
+class NetnsSUT(sut.SUT):
+    """A SUT in a network namespace. Commands are executed in the
+       namespace, rather than over SSH, so this needs to run as root"""
+
+    def __init__(self, config, verify=False, agent=False):
+        """Create the namespace if needed, from the configuration"""
+        self.namespace = config.netns
+        self.master = config.SUT_MASTER
+        # The (SUT, host) interface names of each veth pair
+        self.pairs = [(config[key], config['HOST' + key[3:]])
+                      for key in sorted(config)
+                      if key.startswith('SUT_LAN') or
+                      key.startswith('SUT_OPTICAL')]
+        self.created = False
+        self.counter = None
+        sut.SUT.__init__(self, hostname=config.hostname, key=None,
+                         mgmt=config.SUT_MGMT, verify=verify, agent=agent)
+
+    def _ip(self, command, check=True):
+        """Run an ip command on this machine"""
+        args = ['ip'] + command.split(' ')
+        if check:
+            subprocess.check_call(args)
+            return 0
+        with open(os.devnull, 'w') as null:
+            return subprocess.call(args, stdout=null, stderr=null)
+
+    def _hasLink(self, interface):
+        """Does the interface exist in the namespace"""
+        return self._ip('-n {0} link show dev {1}'.format(
+            self.namespace, interface), check=False) == 0
+
+    def _connect(self):
+        """Create the namespace and its interfaces, if not yet made"""
+        if self.created:
+            return
+        if not os.path.exists(os.path.join('/var/run/netns',
+                                           self.namespace)):
+            self._ip('netns add {0}'.format(self.namespace))
+        self._ip('-n {0} link set lo up'.format(self.namespace))
+        if not self._hasLink(self.master):
+            self._ip('-n {0} link add {1} type veth peer name {1}-peer'.
+                     format(self.namespace, self.master))
+        for interface, host in self.pairs:
+            if not self._hasLink(interface):
+                self._ip('link add {0} type veth peer name {1} netns {2}'.
+                         format(host, interface, self.namespace))
+            self._ip('link set {0} up'.format(host))
+        self.created = True
+        # Started now, before AsyncSUT copies the SUT, so that there is
+        # only one counter
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        channel = self.start_ssh('{0} {1} {2}'.format(
+            sys.executable, script,
+            ' '.join(interface for interface, _ in self.pairs)))
+        self.counter = PacketCounter(channel, self.namespace)
+
+    def destroy(self):
+        """Delete the namespace, and with it the veth pairs"""
+        if self.counter:
+            self.counter.close()
+            self.counter = None
+        self._ip('netns del {0}'.format(self.namespace))
+        self.created = False
+
+    def _args(self, command):
+        """The arguments to run the shell command in the namespace"""
+        return ['ip', 'netns', 'exec', self.namespace, 'sh', '-c', command]
+
+    def _execute(self, command):
+        """Execute a command in the namespace. Return a tuple of
+           (stdout, stderr, exit code)"""
+        process = subprocess.Popen(self._args(command),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        results, error = process.communicate()
+        return results, error, process.returncode
+
+    def start_ssh(self, command):
+        """Start a long running command in the namespace. Return a
+           LocalChannel, which can be stopped with stop_ssh()"""
+        self._connect()
+        return LocalChannel(self._args(command))
+
+    def sftpPut(self, src, dst):
+        """Copy the src file. The namespace shares our file system"""
+        shutil.copyfile(src, dst)
+
+    def snapshotStats(self, interfaces, kinds=('ethtool', 'class')):
+        """Collect the statistics of all the interfaces. The ethtool
+           statistics are those counted on the ports"""
+        if 'class' in kinds:
+            snapshot = sut.SUT.snapshotStats(self, interfaces,
+                                             kinds=('class',))
+        else:
+            snapshot = sut.StatsSnapshot()
+        if 'ethtool' in kinds:
+            self._connect()
+            counted = self.counter.counts()
+            for interface in interfaces:
+                if interface not in counted:
+                    raise NameError(
+                        'snapshotStats: {0} is not a port'.format(interface))
+                snapshot.stats['ethtool'][interface] = dict(
+                    (str(key), value)
+                    for key, value in counted[interface].items())
+        return snapshot
+
+    def getEthtoolStats(self, interface):
+        """Get the ethtool statistics counted on the port"""
+        if interface not in self.interfaces:
+            raise NameError(
+                'getEthtoolStats called for unknown interface')
+        return self.snapshotStats([interface],
+                                  kinds=('ethtool',)).ethtoolStats(interface)
+
+    def phcGet(self, interface):
+        """There are no PHCs in a network namespace"""
+        raise NameError('phcGet: {0} has no PHC'.format(interface))
+
+    def phcSet(self, interface, seconds):
+        """There are no PHCs in a network namespace"""
+        raise NameError('phcSet: {0} has no PHC'.format(interface))
+
+
+if __name__ == '__main__':
+    countPackets(sys.argv[1:])
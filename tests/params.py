@@ -3,6 +3,11 @@ import argparse
 import ConfigParser
 import sys
 
+import tracing
+
+# The objects told of the results of the tests, see addResultHook()
+RESULT_HOOKS = []
+
 
 class dotdict(dict):
     """dot.notation access to dictionary attributes"""
@@ -51,6 +56,18 @@ def readConfig(filename, fourPorts=True):
         config['ptp'] = parser.get('sut', 'ptp')
     except:
         config['ptp'] = None
+    try:
+        config['persistent'] = parser.getboolean('sut', 'persistent')
+    except:
+        config['persistent'] = False
+    try:
+        config['agent'] = parser.getboolean('sut', 'agent')
+    except:
+        config['agent'] = False
+    try:
+        config['netns'] = parser.get('sut', 'netns')
+    except:
+        config['netns'] = None
 
     return dotdict(config)
 
@@ -77,6 +94,100 @@ def params():
                         default=False, action='store_true')
     parser.add_argument("--vlanfiltering",
                         default=False, action='store_true')
+    parser.add_argument("--broker",
+                        help="Unix socket of the session broker to use",
+                        default=None)
+    parser.add_argument("--trace",
+                        help="Save a trace of where the time goes to a file",
+                        default=None)
+    parser.add_argument("--capture",
+                        help="When to save packet captures",
+                        choices=('off', 'always', 'on-failure', 'ports'),
+                        default='on-failure')
+    parser.add_argument("--capture-ports",
+                        help="Comma separated host interfaces to capture on",
+                        default=None)
+    parser.add_argument("--capture-filter",
+                        help="BPF filter applied to the saved captures",
+                        default=None)
+    parser.add_argument("--capture-ring", type=int,
+                        help="Keep only the captures of the last N runs",
+                        default=0)
     args = parser.parse_args()
     del sys.argv[1:]
+    if args.trace:
+        tracing.start(args.trace)
+        addResultHook(tracing.TestSpans())
     return args
+
+
+def addResultHook(hook):
+    """Have the hook told of the results of the tests run by a
+       HookedRunner. The hook may have any of the TestResult methods
+       startTest, stopTest, addFailure and addError"""
+    RESULT_HOOKS.append(hook)
+
+
+class HookedResult(object):
+    """Passes the results on to the runner's result, and to the hooks"""
+
+    def __init__(self, result):
+        self.__dict__['result'] = result
+
+    def __getattr__(self, name):
+        return getattr(self.result, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.result, name, value)
+
+    def _hooks(self, name, *args):
+        """Call the method of each of the hooks which has it"""
+        for hook in RESULT_HOOKS:
+            method = getattr(hook, name, None)
+            if method:
+                method(*args)
+
+    def startTest(self, test):
+        """The test is about to be run"""
+        self._hooks('startTest', test)
+        self.result.startTest(test)
+
+    def stopTest(self, test):
+        """The test has been run"""
+        self.result.stopTest(test)
+        self._hooks('stopTest', test)
+
+    def addFailure(self, test, err):
+        """The test failed"""
+        self.result.addFailure(test, err)
+        self._hooks('addFailure', test, err)
+
+    def addError(self, test, err):
+        """The test raised an unexpected exception"""
+        self.result.addError(test, err)
+        self._hooks('addError', test, err)
+
+
+class HookedTest(object):
+    """A test suite run with a HookedResult"""
+
+    def __init__(self, test):
+        self.test = test
+
+    def __getattr__(self, name):
+        return getattr(self.test, name)
+
+    def __call__(self, result):
+        return self.test(HookedResult(result))
+
+
+class HookedRunner(object):
+    """Wraps a test runner, so that the result hooks are told of the
+       results of the tests it runs"""
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def run(self, test):
+        """Run the test suite"""
+        return self.runner.run(HookedTest(test))
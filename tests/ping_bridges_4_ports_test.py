@@ -7,6 +7,7 @@ import time
 import unittest2
 import xmlrunner
 
+import broker
 import host
 import params
 import sut
@@ -29,22 +30,23 @@ class ping_bridges_4_ports_test(unittest2.TestCase):
 
     def test_00_setup_sut(self):
         """Setup IP addresses on the SUT interfaces"""
-        # Ensure all the interfaces are up
-        self.sut.up(self.config.SUT_MASTER)
-        self.sut.up(self.config.SUT_LAN0)
-        self.sut.up(self.config.SUT_LAN1)
-        self.sut.up(self.config.SUT_LAN2)
-        self.sut.up(self.config.SUT_LAN3)
-
-        self.sut.addAddress(self.config.SUT_LAN0, '192.168.10.2/24')
-        self.sut.addAddress(self.config.SUT_LAN1, '192.168.11.2/24')
-        self.sut.addAddress(self.config.SUT_LAN2, '192.168.12.2/24')
-        self.sut.addAddress(self.config.SUT_LAN3, '192.168.13.2/24')
-
-        self.sut.addAddress(self.config.SUT_LAN0, 'fd42:4242:10::2/64')
-        self.sut.addAddress(self.config.SUT_LAN1, 'fd42:4242:11::2/64')
-        self.sut.addAddress(self.config.SUT_LAN2, 'fd42:4242:12::2/64')
-        self.sut.addAddress(self.config.SUT_LAN3, 'fd42:4242:13::2/64')
+        with self.sut.batch():
+            # Ensure all the interfaces are up
+            self.sut.up(self.config.SUT_MASTER)
+            self.sut.up(self.config.SUT_LAN0)
+            self.sut.up(self.config.SUT_LAN1)
+            self.sut.up(self.config.SUT_LAN2)
+            self.sut.up(self.config.SUT_LAN3)
+
+            self.sut.addAddress(self.config.SUT_LAN0, '192.168.10.2/24')
+            self.sut.addAddress(self.config.SUT_LAN1, '192.168.11.2/24')
+            self.sut.addAddress(self.config.SUT_LAN2, '192.168.12.2/24')
+            self.sut.addAddress(self.config.SUT_LAN3, '192.168.13.2/24')
+
+            self.sut.addAddress(self.config.SUT_LAN0, 'fd42:4242:10::2/64')
+            self.sut.addAddress(self.config.SUT_LAN1, 'fd42:4242:11::2/64')
+            self.sut.addAddress(self.config.SUT_LAN2, 'fd42:4242:12::2/64')
+            self.sut.addAddress(self.config.SUT_LAN3, 'fd42:4242:13::2/64')
 
         # Allow time for the interfaces to come up
         time.sleep(10)
@@ -99,8 +101,8 @@ class ping_bridges_4_ports_test(unittest2.TestCase):
         self.sut.addAddress('br0', '192.168.10.2/24')
         self.sut.addAddress('br0', 'fd42:4242:10::3/64')
 
-        # Wait the forwarding delay of the bridge
-        time.sleep(7)
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br0')
 
         self.assertTrue(self.host.ping('192.168.10.2'))
         self.assertTrue(self.host.ping('192.168.11.2'))
@@ -123,8 +125,8 @@ class ping_bridges_4_ports_test(unittest2.TestCase):
         self.sut.addAddress('br2', '192.168.12.2/24')
         self.sut.addAddress('br2', 'fd42:4242:12::3/64')
 
-        # Wait the forwarding delay of the bridge
-        time.sleep(5)
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br2')
 
         self.assertTrue(self.host.ping('192.168.10.2'))
         self.assertTrue(self.host.ping('192.168.11.2'))
@@ -147,8 +149,8 @@ class ping_bridges_4_ports_test(unittest2.TestCase):
         self.sut.addAddress('br3', '192.168.13.2/24')
         self.sut.addAddress('br3', 'fd42:4242:13::3/64')
 
-        # Wait the forwarding delay of the bridge
-        time.sleep(5)
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br3')
 
         self.assertTrue(self.host.ping('192.168.10.2'))
         self.assertTrue(self.host.ping('192.168.11.2'))
@@ -171,8 +173,8 @@ class ping_bridges_4_ports_test(unittest2.TestCase):
         self.sut.addAddress('br1', '192.168.11.2/24')
         self.sut.addAddress('br1', 'fd42:4242:11::3/64')
 
-        # Wait the forwarding delay of the bridge
-        time.sleep(5)
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br1')
 
         self.assertTrue(self.host.ping('192.168.10.2'))
         self.assertTrue(self.host.ping('192.168.11.2'))
@@ -279,9 +281,9 @@ class ping_bridges_4_ports_test(unittest2.TestCase):
 
 if __name__ == '__main__':
     args = params.params()
+    BROKER = broker.connect(args.broker) if args.broker else None
     CONFIG = params.readConfig(args.config)
-    SUT = sut.SUT(hostname=CONFIG.hostname, key=CONFIG.key,
-                  mgmt=CONFIG.SUT_MGMT)
+    SUT = sut.fromConfig(CONFIG, BROKER)
     SUT.cleanSystem()
     HOST = host.HOST()
 
@@ -292,5 +294,6 @@ if __name__ == '__main__':
         testRunner = unittest2.TextTestRunner(failfast=args.failfast,
                                               verbosity=args.verbose)
 
-    unittest2.main(buffer=False, testRunner=testRunner, exit=False)
+    unittest2.main(buffer=False, testRunner=params.HookedRunner(testRunner),
+                   exit=False)
     HOST.cleanSystem()
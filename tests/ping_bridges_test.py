@@ -7,6 +7,7 @@ import time
 import unittest2
 import xmlrunner
 
+import broker
 import host
 import params
 import sut
@@ -31,34 +32,35 @@ class ping_bridges_test(unittest2.TestCase):
 
     def test_00_setup_sut(self):
         """Setup IP addresses on the SUT interfaces"""
-        # Ensure all the interfaces are up
-        self.sut.up(self.config.SUT_MASTER)
-        self.sut.up(self.config.SUT_LAN0)
-        self.sut.up(self.config.SUT_LAN1)
-        self.sut.up(self.config.SUT_LAN2)
-        self.sut.up(self.config.SUT_LAN3)
-        self.sut.up(self.config.SUT_LAN4)
-        self.sut.up(self.config.SUT_LAN5)
-        self.sut.up(self.config.SUT_LAN6)
-        self.sut.up(self.config.SUT_OPTICAL3)
-
-        self.sut.addAddress(self.config.SUT_LAN0, '192.168.10.2/24')
-        self.sut.addAddress(self.config.SUT_LAN1, '192.168.11.2/24')
-        self.sut.addAddress(self.config.SUT_LAN2, '192.168.12.2/24')
-        self.sut.addAddress(self.config.SUT_LAN3, '192.168.13.2/24')
-        self.sut.addAddress(self.config.SUT_LAN4, '192.168.14.2/24')
-        self.sut.addAddress(self.config.SUT_LAN5, '192.168.15.2/24')
-        self.sut.addAddress(self.config.SUT_LAN6, '192.168.16.2/24')
-        self.sut.addAddress(self.config.SUT_OPTICAL3, '192.168.17.2/24')
-
-        self.sut.addAddress(self.config.SUT_LAN0, 'fd42:4242:10::2/64')
-        self.sut.addAddress(self.config.SUT_LAN1, 'fd42:4242:11::2/64')
-        self.sut.addAddress(self.config.SUT_LAN2, 'fd42:4242:12::2/64')
-        self.sut.addAddress(self.config.SUT_LAN3, 'fd42:4242:13::2/64')
-        self.sut.addAddress(self.config.SUT_LAN4, 'fd42:4242:14::2/64')
-        self.sut.addAddress(self.config.SUT_LAN5, 'fd42:4242:15::2/64')
-        self.sut.addAddress(self.config.SUT_LAN6, 'fd42:4242:16::2/64')
-        self.sut.addAddress(self.config.SUT_OPTICAL3, 'fd42:4242:17::2/64')
+        with self.sut.batch():
+            # Ensure all the interfaces are up
+            self.sut.up(self.config.SUT_MASTER)
+            self.sut.up(self.config.SUT_LAN0)
+            self.sut.up(self.config.SUT_LAN1)
+            self.sut.up(self.config.SUT_LAN2)
+            self.sut.up(self.config.SUT_LAN3)
+            self.sut.up(self.config.SUT_LAN4)
+            self.sut.up(self.config.SUT_LAN5)
+            self.sut.up(self.config.SUT_LAN6)
+            self.sut.up(self.config.SUT_OPTICAL3)
+
+            self.sut.addAddress(self.config.SUT_LAN0, '192.168.10.2/24')
+            self.sut.addAddress(self.config.SUT_LAN1, '192.168.11.2/24')
+            self.sut.addAddress(self.config.SUT_LAN2, '192.168.12.2/24')
+            self.sut.addAddress(self.config.SUT_LAN3, '192.168.13.2/24')
+            self.sut.addAddress(self.config.SUT_LAN4, '192.168.14.2/24')
+            self.sut.addAddress(self.config.SUT_LAN5, '192.168.15.2/24')
+            self.sut.addAddress(self.config.SUT_LAN6, '192.168.16.2/24')
+            self.sut.addAddress(self.config.SUT_OPTICAL3, '192.168.17.2/24')
+
+            self.sut.addAddress(self.config.SUT_LAN0, 'fd42:4242:10::2/64')
+            self.sut.addAddress(self.config.SUT_LAN1, 'fd42:4242:11::2/64')
+            self.sut.addAddress(self.config.SUT_LAN2, 'fd42:4242:12::2/64')
+            self.sut.addAddress(self.config.SUT_LAN3, 'fd42:4242:13::2/64')
+            self.sut.addAddress(self.config.SUT_LAN4, 'fd42:4242:14::2/64')
+            self.sut.addAddress(self.config.SUT_LAN5, 'fd42:4242:15::2/64')
+            self.sut.addAddress(self.config.SUT_LAN6, 'fd42:4242:16::2/64')
+            self.sut.addAddress(self.config.SUT_OPTICAL3, 'fd42:4242:17::2/64')
 
     def test_01_setup_host(self):
         """Setup IP addresses on the host device"""
@@ -135,8 +137,8 @@ class ping_bridges_test(unittest2.TestCase):
         self.sut.addAddress('br0', '192.168.10.2/24')
         self.sut.addAddress('br0', 'fd42:4242:10::2/64')
 
-        # Wait the forwarding delay of the bridge
-        time.sleep(5)
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br0')
 
         self.assertTrue(self.host.ping('192.168.10.2'))
         self.assertTrue(self.host.ping('192.168.11.2'))
@@ -168,8 +170,8 @@ class ping_bridges_test(unittest2.TestCase):
         self.sut.addAddress('br2', '192.168.12.2/24')
         self.sut.addAddress('br2', 'fd42:4242:12::2/64')
 
-        # Wait the forwarding delay of the bridge
-        time.sleep(5)
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br2')
 
         self.assertTrue(self.host.ping('192.168.10.2'))
         self.assertTrue(self.host.ping('192.168.11.2'))
@@ -201,8 +203,8 @@ class ping_bridges_test(unittest2.TestCase):
         self.sut.addAddress('br4', '192.168.14.2/24')
         self.sut.addAddress('br4', 'fd42:4242:14::2/64')
 
-        # Wait the forwarding delay of the bridge
-        time.sleep(5)
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br4')
 
         self.assertTrue(self.host.ping('192.168.10.2'))
         self.assertTrue(self.host.ping('192.168.11.2'))
@@ -234,8 +236,8 @@ class ping_bridges_test(unittest2.TestCase):
         self.sut.addAddress('br6', '192.168.16.2/24')
         self.sut.addAddress('br6', 'fd42:4242:16::2/64')
 
-        # Wait the forwarding delay of the bridge
-        time.sleep(5)
+        # Wait for the bridge ports to start forwarding
+        self.sut.waitBridgeForwarding('br6')
 
         self.assertTrue(self.host.ping('192.168.10.2'))
         self.assertTrue(self.host.ping('192.168.11.2'))
@@ -395,9 +397,9 @@ class ping_bridges_test(unittest2.TestCase):
 
 if __name__ == '__main__':
     args = params.params()
+    BROKER = broker.connect(args.broker) if args.broker else None
     CONFIG = params.readConfig(args.config, fourPorts=False)
-    SUT = sut.SUT(hostname=CONFIG.hostname, key=CONFIG.key,
-                  mgmt=CONFIG.SUT_MGMT)
+    SUT = sut.fromConfig(CONFIG, BROKER)
     SUT.cleanSystem()
     HOST = host.HOST()
 
@@ -408,5 +410,6 @@ if __name__ == '__main__':
         testRunner = unittest2.TextTestRunner(failfast=args.failfast,
                                               verbosity=args.verbose)
 
-    unittest2.main(buffer=False, testRunner=testRunner, exit=False)
+    unittest2.main(buffer=False, testRunner=params.HookedRunner(testRunner),
+                   exit=False)
     HOST.cleanSystem()
@@ -6,6 +6,7 @@ import time
 import unittest2
 import xmlrunner
 
+import broker
 import host
 import params
 import sut
@@ -33,25 +34,26 @@ class ping_individual_test(unittest2.TestCase):
     def test_00_setup_sut(self):
         """Setup IP addresses on the SUT interfaces"""
 
-        # Set a specific MAC address on one of the DSA ports
-        self.sut.setMacAddress(self.config.SUT_LAN2, "ce:00:11:22:33:44")
+        with self.sut.batch():
+            # Set a specific MAC address on one of the DSA ports
+            self.sut.setMacAddress(self.config.SUT_LAN2, "ce:00:11:22:33:44")
 
-        # Ensure all the interfaces are up
-        self.sut.up(self.config.SUT_MASTER)
-        self.sut.up(self.config.SUT_LAN0)
-        self.sut.up(self.config.SUT_LAN1)
-        self.sut.up(self.config.SUT_LAN2)
-        self.sut.up(self.config.SUT_LAN3)
+            # Ensure all the interfaces are up
+            self.sut.up(self.config.SUT_MASTER)
+            self.sut.up(self.config.SUT_LAN0)
+            self.sut.up(self.config.SUT_LAN1)
+            self.sut.up(self.config.SUT_LAN2)
+            self.sut.up(self.config.SUT_LAN3)
 
-        self.sut.addAddress(self.config.SUT_LAN0, '192.168.10.2/24')
-        self.sut.addAddress(self.config.SUT_LAN1, '192.168.11.2/24')
-        self.sut.addAddress(self.config.SUT_LAN2, '192.168.12.2/24')
-        self.sut.addAddress(self.config.SUT_LAN3, '192.168.13.2/24')
+            self.sut.addAddress(self.config.SUT_LAN0, '192.168.10.2/24')
+            self.sut.addAddress(self.config.SUT_LAN1, '192.168.11.2/24')
+            self.sut.addAddress(self.config.SUT_LAN2, '192.168.12.2/24')
+            self.sut.addAddress(self.config.SUT_LAN3, '192.168.13.2/24')
 
-        self.sut.addAddress(self.config.SUT_LAN0, 'fd42:4242:10::2/64')
-        self.sut.addAddress(self.config.SUT_LAN1, 'fd42:4242:11::2/64')
-        self.sut.addAddress(self.config.SUT_LAN2, 'fd42:4242:12::2/64')
-        self.sut.addAddress(self.config.SUT_LAN3, 'fd42:4242:13::2/64')
+            self.sut.addAddress(self.config.SUT_LAN0, 'fd42:4242:10::2/64')
+            self.sut.addAddress(self.config.SUT_LAN1, 'fd42:4242:11::2/64')
+            self.sut.addAddress(self.config.SUT_LAN2, 'fd42:4242:12::2/64')
+            self.sut.addAddress(self.config.SUT_LAN3, 'fd42:4242:13::2/64')
 
     def test_01_setup_host(self):
         """Setup IP addresses on the host device"""
@@ -130,9 +132,9 @@ class ping_individual_test(unittest2.TestCase):
 
 if __name__ == '__main__':
     args = params.params()
+    BROKER = broker.connect(args.broker) if args.broker else None
     CONFIG = params.readConfig(args.config)
-    SUT = sut.SUT(hostname=CONFIG.hostname, key=CONFIG.key,
-                  mgmt=CONFIG.SUT_MGMT)
+    SUT = sut.fromConfig(CONFIG, BROKER)
     SUT.cleanSystem()
     HOST = host.HOST()
 
@@ -143,5 +145,6 @@ if __name__ == '__main__':
         testRunner = unittest2.TextTestRunner(failfast=args.failfast,
                                               verbosity=args.verbose)
 
-    unittest2.main(buffer=False, testRunner=testRunner, exit=False)
+    unittest2.main(buffer=False, testRunner=params.HookedRunner(testRunner),
+                   exit=False)
     HOST.cleanSystem()
@@ -5,6 +5,7 @@ import time
 import unittest2
 import xmlrunner
 
+import broker
 import host
 import params
 import sut
@@ -27,34 +28,35 @@ class ping_individual_test(unittest2.TestCase):
 
     def test_00_setup_sut(self):
         """Setup IP addresses on the SUT interfaces"""
-        # Ensure all the interfaces are up
-        self.sut.up(self.config.SUT_MASTER)
-        self.sut.up(self.config.SUT_LAN0)
-        self.sut.up(self.config.SUT_LAN1)
-        self.sut.up(self.config.SUT_LAN2)
-        self.sut.up(self.config.SUT_LAN3)
-        self.sut.up(self.config.SUT_LAN4)
-        self.sut.up(self.config.SUT_LAN5)
-        self.sut.up(self.config.SUT_LAN6)
-        self.sut.up(self.config.SUT_OPTICAL3)
-
-        self.sut.addAddress(self.config.SUT_LAN0, '192.168.10.2/24')
-        self.sut.addAddress(self.config.SUT_LAN1, '192.168.11.2/24')
-        self.sut.addAddress(self.config.SUT_LAN2, '192.168.12.2/24')
-        self.sut.addAddress(self.config.SUT_LAN3, '192.168.13.2/24')
-        self.sut.addAddress(self.config.SUT_LAN4, '192.168.14.2/24')
-        self.sut.addAddress(self.config.SUT_LAN5, '192.168.15.2/24')
-        self.sut.addAddress(self.config.SUT_LAN6, '192.168.16.2/24')
-        self.sut.addAddress(self.config.SUT_OPTICAL3, '192.168.17.2/24')
-
-        self.sut.addAddress(self.config.SUT_LAN0, 'fd42:4242:10::2/64')
-        self.sut.addAddress(self.config.SUT_LAN1, 'fd42:4242:11::2/64')
-        self.sut.addAddress(self.config.SUT_LAN2, 'fd42:4242:12::2/64')
-        self.sut.addAddress(self.config.SUT_LAN3, 'fd42:4242:13::2/64')
-        self.sut.addAddress(self.config.SUT_LAN4, 'fd42:4242:14::2/64')
-        self.sut.addAddress(self.config.SUT_LAN5, 'fd42:4242:15::2/64')
-        self.sut.addAddress(self.config.SUT_LAN6, 'fd42:4242:16::2/64')
-        self.sut.addAddress(self.config.SUT_OPTICAL3, 'fd42:4242:17::2/64')
+        with self.sut.batch():
+            # Ensure all the interfaces are up
+            self.sut.up(self.config.SUT_MASTER)
+            self.sut.up(self.config.SUT_LAN0)
+            self.sut.up(self.config.SUT_LAN1)
+            self.sut.up(self.config.SUT_LAN2)
+            self.sut.up(self.config.SUT_LAN3)
+            self.sut.up(self.config.SUT_LAN4)
+            self.sut.up(self.config.SUT_LAN5)
+            self.sut.up(self.config.SUT_LAN6)
+            self.sut.up(self.config.SUT_OPTICAL3)
+
+            self.sut.addAddress(self.config.SUT_LAN0, '192.168.10.2/24')
+            self.sut.addAddress(self.config.SUT_LAN1, '192.168.11.2/24')
+            self.sut.addAddress(self.config.SUT_LAN2, '192.168.12.2/24')
+            self.sut.addAddress(self.config.SUT_LAN3, '192.168.13.2/24')
+            self.sut.addAddress(self.config.SUT_LAN4, '192.168.14.2/24')
+            self.sut.addAddress(self.config.SUT_LAN5, '192.168.15.2/24')
+            self.sut.addAddress(self.config.SUT_LAN6, '192.168.16.2/24')
+            self.sut.addAddress(self.config.SUT_OPTICAL3, '192.168.17.2/24')
+
+            self.sut.addAddress(self.config.SUT_LAN0, 'fd42:4242:10::2/64')
+            self.sut.addAddress(self.config.SUT_LAN1, 'fd42:4242:11::2/64')
+            self.sut.addAddress(self.config.SUT_LAN2, 'fd42:4242:12::2/64')
+            self.sut.addAddress(self.config.SUT_LAN3, 'fd42:4242:13::2/64')
+            self.sut.addAddress(self.config.SUT_LAN4, 'fd42:4242:14::2/64')
+            self.sut.addAddress(self.config.SUT_LAN5, 'fd42:4242:15::2/64')
+            self.sut.addAddress(self.config.SUT_LAN6, 'fd42:4242:16::2/64')
+            self.sut.addAddress(self.config.SUT_OPTICAL3, 'fd42:4242:17::2/64')
 
     def test_01_setup_host(self):
         """Setup IP addresses on the host device"""
@@ -134,9 +136,9 @@ class ping_individual_test(unittest2.TestCase):
 
 if __name__ == '__main__':
     args = params.params()
+    BROKER = broker.connect(args.broker) if args.broker else None
     CONFIG = params.readConfig(args.config, fourPorts=False)
-    SUT = sut.SUT(hostname=CONFIG.hostname, key=CONFIG.key,
-                  mgmt=CONFIG.SUT_MGMT)
+    SUT = sut.fromConfig(CONFIG, BROKER)
     SUT.cleanSystem()
     HOST = host.HOST()
 
@@ -147,5 +149,6 @@ if __name__ == '__main__':
         testRunner = unittest2.TextTestRunner(failfast=args.failfast,
                                               verbosity=args.verbose)
 
-    unittest2.main(buffer=False, testRunner=testRunner, exit=False)
+    unittest2.main(buffer=False, testRunner=params.HookedRunner(testRunner),
+                   exit=False)
     HOST.cleanSystem()
@@ -7,6 +7,7 @@ import time
 import unittest2
 import xmlrunner
 
+import broker
 import host
 import params
 import sut
@@ -48,7 +49,21 @@ class Ptp_master_slave_bridge_test(unittest2.TestCase):
                        config)
         self.sut_slave.sftpPut(filename, '/etc/ptp4l.conf')
 
-    def test_00_setup_master_l2(self):
+    def _check_slave(self):
+        """Check that the slave has a similar time to the master. Both
+           clocks are read at the same time"""
+        master_seconds, slave_seconds = sut.phcGetSimultaneous(
+            [(self.sut_master, self.config_master.SUT_LAN0),
+             (self.sut_slave, self.config_slave.SUT_LAN0)])
+
+        self.assertAlmostEqual(master_seconds, slave_seconds, places=0,
+                               msg='{0} != {1}'.format(
+                                   datetime.datetime.utcfromtimestamp(
+                                       master_seconds),
+                                   datetime.datetime.utcfromtimestamp(
+                                       slave_seconds)))
+
+    def _setup_master_l2(self):
         """Setup the interfaces on the PTP master"""
 
         # Ensure all the interfaces are up
@@ -63,7 +78,7 @@ class Ptp_master_slave_bridge_test(unittest2.TestCase):
         self._put_master_config('l2-ptp4l.conf')
         self.sut_master.serviceStart('ptp4l')
 
-    def test_01_setup_slave_l2(self):
+    def _setup_slave_l2(self):
         """Setup the interfaces on the PTP slave, add it to a bridge"""
 
         # Ensure all the interfaces are up
@@ -90,22 +105,17 @@ class Ptp_master_slave_bridge_test(unittest2.TestCase):
         self._put_slave_config('l2-ptp4l.conf')
         self.sut_slave.serviceStart('ptp4l')
 
+    def test_00_setup_l2(self):
+        """Setup the PTP master and slave at the same time"""
+        sut.concurrently(self._setup_master_l2, self._setup_slave_l2)
+
     def test_02_check_slave_l2(self):
         """Check that the slave has a similar time to the master"""
-        time.sleep(20)
+        self.sut_slave.waitPtpLocked()
 
-        master_seconds, _ = self.sut_master.phcGet(self.config_master.SUT_LAN0)
-        slave_seconds, _ = self.sut_slave.phcGet(self.config_slave.SUT_LAN0)
+        self._check_slave()
 
-        self.assertAlmostEqual(master_seconds, slave_seconds, places=0,
-                               msg='{0} != {1}'.format(
-                                   datetime.datetime.utcfromtimestamp(
-                                       master_seconds),
-                                   datetime.datetime.utcfromtimestamp(
-                                       slave_seconds)))
-
-    @unittest2.skipIf(PTP == 'l2', "IPv6 PTP not supported")
-    def test_03_setup_master_ipv6(self):
+    def _setup_master_ipv6(self):
         """Setup the interfaces on the PTP master, for L2 test"""
 
         self.sut_master.serviceStop('ptp4l')
@@ -114,8 +124,7 @@ class Ptp_master_slave_bridge_test(unittest2.TestCase):
         self._put_master_config('ipv6-ptp4l.conf')
         self.sut_master.serviceStart('ptp4l')
 
-    @unittest2.skipIf(PTP == 'l2', "IPv6 PTP not supported")
-    def test_04_setup_slave_ipv6(self):
+    def _setup_slave_ipv6(self):
         """Setup the interfaces on the PTP slave, for L2 test"""
 
         self.sut_slave.serviceStop('ptp4l')
@@ -133,42 +142,36 @@ class Ptp_master_slave_bridge_test(unittest2.TestCase):
         self._put_slave_config('ipv6-ptp4l')
         self.sut_slave.serviceStart('ptp4l')
 
+    @unittest2.skipIf(PTP == 'l2', "IPv6 PTP not supported")
+    def test_03_setup_ipv6(self):
+        """Setup the PTP master and slave at the same time, for IPv6"""
+        sut.concurrently(self._setup_master_ipv6, self._setup_slave_ipv6)
+
     @unittest2.skipIf(PTP == 'l2', "IPv6 PTP not supported")
     def test_05_check_slave_ipv6(self):
         """Check that the slave has a similar time to the master"""
-        time.sleep(30)
-
-        master_seconds, _ = self.sut_master.phcGet(self.config_master.SUT_LAN0)
-        slave_seconds, _ = self.sut_slave.phcGet(self.config_slave.SUT_LAN0)
+        self.sut_slave.waitPtpLocked()
 
-        self.assertAlmostEqual(master_seconds, slave_seconds, places=0,
-                               msg='{0} != {1}'.format(
-                                   datetime.datetime.utcfromtimestamp(
-                                       master_seconds),
-                                   datetime.datetime.utcfromtimestamp(
-                                       slave_seconds)))
+        self._check_slave()
 
     def test_99_cleanup(self):
         """Stop the daemons"""
-        self.sut_slave.serviceStop('ptp4l')
-        self.sut_master.serviceStop('ptp4l')
+        sut.concurrently(lambda: self.sut_slave.serviceStop('ptp4l'),
+                         lambda: self.sut_master.serviceStop('ptp4l'))
 
 
 if __name__ == '__main__':
     ARGS = params.params()
+    BROKER = broker.connect(ARGS.broker) if ARGS.broker else None
     PTP = ARGS.ptp
 
     CONFIG_SLAVE = params.readConfig(ARGS.config)
-    SUT_SLAVE = sut.SUT(hostname=CONFIG_SLAVE.hostname,
-                        key=CONFIG_SLAVE.key,
-                        mgmt=CONFIG_SLAVE.SUT_MGMT)
+    SUT_SLAVE = sut.fromConfig(CONFIG_SLAVE, BROKER)
     SUT_SLAVE.cleanSystem()
 
     CONFIG_MASTER = params.readConfig(ARGS.config_master)
     MASTER_INTERFACE = ARGS.config_master_interface
-    SUT_MASTER = sut.SUT(hostname=CONFIG_MASTER.hostname,
-                         key=CONFIG_MASTER.key,
-                         mgmt=CONFIG_MASTER.SUT_MGMT)
+    SUT_MASTER = sut.fromConfig(CONFIG_MASTER, BROKER)
 
     SUT_MASTER.cleanSystem()
     HOST = host.HOST()
@@ -180,5 +183,6 @@ if __name__ == '__main__':
         TEST_RUNNER = unittest2.TextTestRunner(failfast=ARGS.failfast,
                                                verbosity=ARGS.verbose)
 
-    unittest2.main(buffer=False, testRunner=TEST_RUNNER, exit=False)
+    unittest2.main(buffer=False, testRunner=params.HookedRunner(TEST_RUNNER),
+                   exit=False)
     HOST.cleanSystem()
@@ -7,6 +7,7 @@ import time
 import unittest2
 import xmlrunner
 
+import broker
 import host
 import params
 import sut
@@ -48,8 +49,8 @@ class Ptp_master_slave_test(unittest2.TestCase):
                        config)
         self.sut_slave.sftpPut(filename, '/etc/ptp4l.conf')
 
-    def test_00_setup_master_ipv4(self):
-        """Setup the interfaces on the PTP master, for UDP test"""
+    def _setup_master_interfaces(self):
+        """Setup the interfaces on the PTP master"""
 
         # Ensure all the interfaces are up
         self.sut_master.up(self.config_master.SUT_MASTER)
@@ -57,51 +58,61 @@ class Ptp_master_slave_test(unittest2.TestCase):
         self.sut_master.addAddress(self.config_master_interface,
                                    '192.168.10.1/24')
 
-        if PTP == 'l2':
-            return
-
-        self.sut_master.serviceStop('ptp4l')
-        self.sut_master.phcSet(self.config_master_interface, 0)
-
-        self._put_master_config('ipv4-ptp4l')
-        self.sut_master.serviceStart('ptp4l')
-
-    def test_01_setup_slave_ipv4(self):
-        """Setup the interfaces on the PTP slave, for UDP test"""
+    def _setup_slave_interfaces(self):
+        """Setup the interfaces on the PTP slave"""
 
         # Ensure all the interfaces are up
         self.sut_slave.up(self.config_slave.SUT_MASTER)
         self.sut_slave.up(self.config_slave.SUT_LAN0)
         self.sut_slave.addAddress(self.config_slave.SUT_LAN0, '192.168.10.2/24')
 
-        if PTP == 'l2':
-            return
+    def _set_phc(self, board, interface, ptp_master):
+        """Stop ptp4l and set the PHC. The PTP master starts from zero,
+           the PTP slave from the beginning of 2018, so it has to
+           synchronise"""
+        board.serviceStop('ptp4l')
 
-        self.sut_slave.serviceStop('ptp4l')
+        if ptp_master:
+            board.phcSet(interface, 0)
+            return
 
         beginning = datetime.datetime(2018, 1, 1)
         seconds = time.mktime(beginning.timetuple())
-        self.sut_slave.phcSet(self.config_slave.SUT_LAN0, seconds)
-        phc_seconds, _ = self.sut_slave.phcGet(self.config_slave.SUT_LAN0)
+        board.phcSet(interface, seconds)
+        phc_seconds, _ = board.phcGet(interface)
         self.assertAlmostEqual(seconds, phc_seconds, places=0,
                                msg='{0} != {1}'.format(
                                    (beginning),
                                    datetime.datetime.utcfromtimestamp(
                                        phc_seconds)))
 
-        self._put_slave_config('ipv4-ptp4l')
-        self.sut_slave.serviceStart('ptp4l')
-
-    def test_02_check_slave_ipv4(self):
-        """Check that the slave has a similar time to the master"""
+    def _start_master(self, config, ptp_master):
+        """(Re)start ptp4l on SUT_MASTER with the given configuration"""
+        self._set_phc(self.sut_master, self.config_master_interface,
+                      ptp_master)
+        self._put_master_config(config)
+        self.sut_master.serviceStart('ptp4l')
 
-        if PTP == 'l2':
-            return
+    def _start_slave(self, config, ptp_master):
+        """(Re)start ptp4l on SUT_SLAVE with the given configuration"""
+        self._set_phc(self.sut_slave, self.config_slave.SUT_LAN0,
+                      ptp_master)
+        self._put_slave_config(config)
+        self.sut_slave.serviceStart('ptp4l')
 
-        time.sleep(20)
+    def _start(self, config, reversed_roles=False):
+        """Start ptp4l on both SUTs at the same time. Normally SUT_MASTER
+           is the PTP master, unless reversed_roles"""
+        sut.concurrently(
+            lambda: self._start_master(config, not reversed_roles),
+            lambda: self._start_slave(config, reversed_roles))
 
-        master_seconds, _ = self.sut_master.phcGet(self.config_master_interface)
-        slave_seconds, _ = self.sut_slave.phcGet(self.config_slave.SUT_LAN0)
+    def _check_slave(self):
+        """Check that the slave has a similar time to the master. Both
+           clocks are read at the same time"""
+        master_seconds, slave_seconds = sut.phcGetSimultaneous(
+            [(self.sut_master, self.config_master_interface),
+             (self.sut_slave, self.config_slave.SUT_LAN0)])
 
         self.assertAlmostEqual(master_seconds, slave_seconds, places=0,
                                msg='{0} != {1}'.format(
@@ -110,38 +121,35 @@ class Ptp_master_slave_test(unittest2.TestCase):
                                    datetime.datetime.utcfromtimestamp(
                                        slave_seconds)))
 
-    def test_03_setup_master_reversed_ipv4(self):
-        """Setup the PTP master - reversed - UDP"""
+    def test_00_setup_ipv4(self):
+        """Setup the interfaces on the PTP master and slave, and start
+           them, for UDP test"""
+
+        sut.concurrently(self._setup_master_interfaces,
+                         self._setup_slave_interfaces)
 
         if PTP == 'l2':
             return
 
-        self.sut_slave.serviceStop('ptp4l')
-        self.sut_slave.phcSet(self.config_slave.SUT_LAN0, 0)
-        self._put_slave_config('ipv4-reversed-ptp4l')
-        self.sut_slave.serviceStart('ptp4l')
+        self._start('ipv4-ptp4l')
 
-    def test_04_setup_slave_reversed_ipv4(self):
-        """Setup the PTP slave - reversed - UDP"""
+    def test_02_check_slave_ipv4(self):
+        """Check that the slave has a similar time to the master"""
 
         if PTP == 'l2':
             return
 
-        self.sut_master.serviceStop('ptp4l')
+        self.sut_slave.waitPtpLocked()
 
-        beginning = datetime.datetime(2018, 1, 1)
-        seconds = time.mktime(beginning.timetuple())
-        self.sut_master.phcSet(self.config_master_interface, seconds)
-        phc_seconds, _ = self.sut_master.phcGet(self.config_master_interface)
-        self.assertAlmostEqual(seconds, phc_seconds, places=0,
-                               msg='{0} != {1}'.format(
-                                   beginning,
-                                   datetime.datetime.utcfromtimestamp(
-                                       phc_seconds)))
+        self._check_slave()
 
+    def test_03_setup_reversed_ipv4(self):
+        """Setup the PTP master and slave - reversed - UDP"""
 
-        self._put_master_config('ipv4-reversed-ptp4l')
-        self.sut_master.serviceStart('ptp4l')
+        if PTP == 'l2':
+            return
+
+        self._start('ipv4-reversed-ptp4l', reversed_roles=True)
 
     def test_05_check_slave_reversed_ipv4(self):
         """Check that the slave has a similar time to the master"""
@@ -149,87 +157,28 @@ class Ptp_master_slave_test(unittest2.TestCase):
         if PTP == 'l2':
             return
 
-        time.sleep(20)
-
-        master_seconds, _ = self.sut_master.phcGet(self.config_master_interface)
-        slave_seconds, _ = self.sut_slave.phcGet(self.config_slave.SUT_LAN0)
-
-        self.assertAlmostEqual(master_seconds, slave_seconds, places=0,
-                               msg='{0} != {1}'.format(
-                                   datetime.datetime.utcfromtimestamp(
-                                       master_seconds),
-                                   datetime.datetime.utcfromtimestamp(
-                                       slave_seconds)))
-
-    def test_06_setup_master_l2(self):
-        """Setup the interfaces on the PTP master, for L2 test"""
+        self.sut_master.waitPtpLocked()
 
-        self.sut_master.serviceStop('ptp4l')
-        self.sut_master.phcSet(self.config_master_interface, 0)
+        self._check_slave()
 
-        self._put_master_config('l2-ptp4l')
-        self.sut_master.serviceStart('ptp4l')
-
-    def test_07_setup_slave_l2(self):
-        """Setup the interfaces on the PTP slave, for L2 test"""
-
-        self.sut_slave.serviceStop('ptp4l')
-
-        beginning = datetime.datetime(2018, 1, 1)
-        seconds = time.mktime(beginning.timetuple())
-        self.sut_slave.phcSet(self.config_slave.SUT_LAN0, seconds)
-        phc_seconds, _ = self.sut_slave.phcGet(self.config_slave.SUT_LAN0)
-        self.assertAlmostEqual(seconds, phc_seconds, places=0,
-                               msg='{0} != {1}'.format(
-                                   (beginning),
-                                   datetime.datetime.utcfromtimestamp(
-                                       phc_seconds)))
+    def test_06_setup_l2(self):
+        """Setup the PTP master and slave, for L2 test"""
 
-        self._put_slave_config('l2-ptp4l')
-        self.sut_slave.serviceStart('ptp4l')
+        self._start('l2-ptp4l')
 
     def test_08_check_slave_l2(self):
         """Check that the slave has a similar time to the master"""
-        time.sleep(20)
-
-        master_seconds, _ = self.sut_master.phcGet(self.config_master_interface)
-        slave_seconds, _ = self.sut_slave.phcGet(self.config_slave.SUT_LAN0)
-
-        self.assertAlmostEqual(master_seconds, slave_seconds, places=0,
-                               msg='{0} != {1}'.format(
-                                   datetime.datetime.utcfromtimestamp(
-                                       master_seconds),
-                                   datetime.datetime.utcfromtimestamp(
-                                       slave_seconds)))
-
-    def test_09_setup_master_ipv6(self):
-        """Setup the interfaces on the PTP master, for L2 test"""
-
-        if PTP == 'l2':
-            return
-
-        self.sut_master.serviceStop('ptp4l')
-        self.sut_master.phcSet(self.config_master_interface, 0)
+        self.sut_slave.waitPtpLocked()
 
-        self._put_master_config('ipv6-ptp4l')
-        self.sut_master.serviceStart('ptp4l')
+        self._check_slave()
 
-    def test_10_setup_slave_ipv6(self):
-        """Setup the interfaces on the PTP slave, for L2 test"""
+    def test_09_setup_ipv6(self):
+        """Setup the PTP master and slave, for IPv6 test"""
 
         if PTP == 'l2':
             return
 
-        self.sut_slave.serviceStop('ptp4l')
-
-        beginning = datetime.datetime(2018, 1, 1)
-        seconds = time.mktime(beginning.timetuple())
-        self.sut_slave.phcSet(self.config_slave.SUT_LAN0, seconds)
-        phc_seconds, _ = self.sut_slave.phcGet(self.config_slave.SUT_LAN0)
-        self.assertAlmostEqual(seconds, phc_seconds, places=0)
-
-        self._put_slave_config('ipv6-ptp4l')
-        self.sut_slave.serviceStart('ptp4l')
+        self._start('ipv6-ptp4l')
 
     def test_11_check_slave_ipv6(self):
         """Check that the slave has a similar time to the master"""
@@ -237,34 +186,28 @@ class Ptp_master_slave_test(unittest2.TestCase):
         if PTP == 'l2':
             return
 
-        time.sleep(20)
-
-        master_seconds, _ = self.sut_master.phcGet(self.config_master_interface)
-        slave_seconds, _ = self.sut_slave.phcGet(self.config_slave.SUT_LAN0)
+        self.sut_slave.waitPtpLocked()
 
-        self.assertAlmostEqual(master_seconds, slave_seconds, places=0)
+        self._check_slave()
 
     def test_99_cleanup(self):
         """Stop the daemons"""
-        self.sut_slave.serviceStop('ptp4l')
-        self.sut_master.serviceStop('ptp4l')
+        sut.concurrently(lambda: self.sut_slave.serviceStop('ptp4l'),
+                         lambda: self.sut_master.serviceStop('ptp4l'))
 
 
 if __name__ == '__main__':
     ARGS = params.params()
+    BROKER = broker.connect(ARGS.broker) if ARGS.broker else None
 
     CONFIG_SLAVE = params.readConfig(ARGS.config)
-    SUT_SLAVE = sut.SUT(hostname=CONFIG_SLAVE.hostname,
-                        key=CONFIG_SLAVE.key,
-                        mgmt=CONFIG_SLAVE.SUT_MGMT)
+    SUT_SLAVE = sut.fromConfig(CONFIG_SLAVE, BROKER)
     SUT_SLAVE.cleanSystem()
     PTP = CONFIG_SLAVE.ptp
 
     CONFIG_MASTER = params.readConfig(ARGS.config_master)
     MASTER_INTERFACE = ARGS.config_master_interface
-    SUT_MASTER = sut.SUT(hostname=CONFIG_MASTER.hostname,
-                         key=CONFIG_MASTER.key,
-                         mgmt=CONFIG_MASTER.SUT_MGMT)
+    SUT_MASTER = sut.fromConfig(CONFIG_MASTER, BROKER)
 
     SUT_MASTER.cleanSystem()
     HOST = host.HOST()
@@ -276,5 +219,6 @@ if __name__ == '__main__':
         TEST_RUNNER = unittest2.TextTestRunner(failfast=ARGS.failfast,
                                                verbosity=ARGS.verbose)
 
-    unittest2.main(buffer=False, testRunner=TEST_RUNNER, exit=False)
+    unittest2.main(buffer=False, testRunner=params.HookedRunner(TEST_RUNNER),
+                   exit=False)
     HOST.cleanSystem()
@@ -1,10 +1,24 @@
 #!/usr/bin/env python
 """Model the System Under Test"""
+import collections
+import contextlib
+import copy
 import datetime
+import functools
+import inspect
+import json
+import os
 import pprint
 import re
+import select
+import tempfile
+import threading
+import time
+import uuid
 import paramiko
 
+import tracing
+
 DEBUG = False
 STATS_FILES = ['collisions', 'multicast', 'rx_compressed',
                'rx_crc_errors', 'rx_dropped', 'rx_errors', 'rx_fifo_errors',
@@ -13,6 +27,44 @@ STATS_FILES = ['collisions', 'multicast', 'rx_compressed',
                'tx_carrier_errors', 'tx_compressed',
                'tx_dropped', 'tx_errors', 'tx_fifo_errors',
                'tx_heartbeat_errors', 'tx_packets', 'tx_window_errors']
+SHELL_RECV_SIZE = 32768
+AGENT_PATH = '/tmp/sut_agent.py'
+FDB_BATCH_PATH = '/tmp/fdb.batch'
+# How often to poll the SUT when waiting for a condition
+POLL_INTERVAL = 0.1
+BRIDGE_FORWARDING_TIMEOUT = 30
+PTP_LOCK_TIMEOUT = 60
+MDB_TIMEOUT = 30
+# The SUT methods which only query it, and so can be made by AsyncSUT
+ASYNC_PREFIXES = ('get', 'snapshot', 'phcGet', 'wait')
+# Offset from the master, in ns, and the number of consecutive samples
+# within it, for the slave to be considered locked
+PTP_OFFSET_THRESHOLD = 1000
+PTP_LOCKED_SAMPLES = 5
+# Query the port state and offset from the master of the local ptp4l.
+# A failed service is reported, so there is no need to wait for it
+PTP_STATUS = ("systemctl is-failed --quiet ptp4l && echo 'ptp4l failed'; "
+              "pmc -u -b 0 'GET PORT_DATA_SET' 'GET TIME_STATUS_NP'")
+# Read all the records in the kernel log, without blocking at the end
+KMSG_READ = 'dd if=/dev/kmsg bs=8192 iflag=nonblock 2>/dev/null'
+
+KmsgRecord = collections.namedtuple('KmsgRecord',
+                                    ['seq', 'timestamp', 'message'])
+# A KmsgRecord, plus the host time it was received
+KmsgEvent = collections.namedtuple('KmsgEvent',
+                                   KmsgRecord._fields + ('received',))
+AGENT_COMMAND = '$(command -v python3 || command -v python) {0}'
+# The state cleanSystem() needs, as one JSON document: every link with
+# its addresses, and the FDB
+SYSTEM_STATE = ("printf '{\"links\": '; ip -json -details addr show; "
+                "printf ', \"fdb\": '; bridge -json fdb show; printf '}'")
+# The ATU statistics of every mv88e6xxx switch and FID, each line
+# prefixed with the file name
+ATU_STATS = "grep -H '' /sys/kernel/debug/mv88e6xxx/sw*/atu/*-stats"
+# Repeatedly read the ATU statistics, each time after a line with the
+# SUT's time
+ATU_SAMPLE = ('while true; do echo "sample $(date +%s.%N)"; {0}; '
+              'sleep {1}; done')
 
 
 def dbg_print(args):
@@ -21,24 +73,590 @@ def dbg_print(args):
         print(args)
 
 
+class Future(object):
+    """The result of a call being made in its own thread"""
+
+    def __init__(self, call):
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(call,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, call):
+        """Make the call, keeping its result or exception"""
+        try:
+            self.value = call()
+        except BaseException as error:
+            self.error = error
+
+    def wait(self):
+        """Wait for the call to complete"""
+        self.thread.join()
+
+    def result(self):
+        """Wait for the call to complete, and return its result, or raise
+           its exception"""
+        self.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def gather(*futures):
+    """Wait for all the Futures to complete. Return a list of their
+       results, in the same order. If any raised an exception, the first
+       is re-raised"""
+    for future in futures:
+        future.wait()
+    return [future.result() for future in futures]
+
+
+def concurrently(*calls):
+    """Call each of the functions at the same time, each in its own
+       thread, and wait for them all to complete. This is intended for
+       driving a number of SUTs, each having its own SSH connection.
+       Return a list of the results, in the same order as the calls. If
+       any raised an exception, the first is re-raised"""
+    return gather(*[Future(call) for call in calls])
+
+
+def phcGetSimultaneous(readings):
+    """Get the time from the Precision Hardware Counters of a number of
+       SUTs, at nearly the same instant. readings is a list of tuples
+       of (sut, interface). The requests are released together once
+       all the threads are ready. Each time is then corrected to the
+       instant of release, assuming the counter was read halfway
+       through the request. Return a list of seconds"""
+    ready = threading.Semaphore(0)
+    gate = threading.Event()
+    released = []
+
+    def _release():
+        """Release the requests once all the threads are waiting"""
+        for _ in readings:
+            ready.acquire()
+        released.append(time.time())
+        gate.set()
+
+    def _read(board, interface):
+        """Read one PHC once released"""
+        ready.release()
+        gate.wait()
+        start = time.time()
+        seconds, _ = board.phcGet(interface)
+        return seconds - ((start + time.time()) / 2 - released[0])
+
+    results = concurrently(_release, *[functools.partial(_read, board,
+                                                         interface)
+                                       for board, interface in readings])
+    return results[1:]
+
+
+def parseKmsg(line):
+    """Parse a /dev/kmsg record, 'prio,seq,timestamp,flags;message'"""
+    header, message = line.split(';', 1)
+    fields = header.split(',')
+    return KmsgRecord(int(fields[1]), int(fields[2]) / 1e6, message)
+
+
+def parseAtuStats(lines, stats=None):
+    """Parse lines of ATU_STATS output into a dictionary indexed by
+       switch, and then file name, in the same form the agent returns.
+       Each file is a list of rows, each row a list of fields, numbers
+       converted to integers"""
+    if stats is None:
+        stats = {}
+    for line in lines:
+        if ':' not in line:
+            continue
+        path, contents = line.split(':', 1)
+        parts = path.split('/')
+        if len(parts) < 3:
+            continue
+        switch, filename = parts[-3], parts[-1]
+        rows = stats.setdefault(switch, {}).setdefault(filename, [])
+        rows.append([int(field) if field.isdigit() else field
+                     for field in contents.split()])
+    return stats
+
+
+class KmsgWatcher(object):
+    """Tails /dev/kmsg on the SUT, using a channel started with
+       start_ssh(), in a background thread. Records after the cursor are
+       kept as KmsgEvents, and passed to the callbacks and waiters whose
+       regex matches. Callbacks are called in the background thread"""
+
+    def __init__(self, channel, cursor):
+        self.channel = channel
+        self.cursor = cursor
+        self.events = []
+        self.callbacks = []
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        """Receive and dispatch records until the channel is closed"""
+        buf = ''
+        while True:
+            data = self.channel.recv(SHELL_RECV_SIZE)
+            if not data:
+                break
+            buf += data
+            lines = buf.split('\n')
+            buf = lines.pop()
+            received = time.time()
+            events = []
+            for line in lines:
+                # Continuation lines start with a space
+                if ';' not in line or line.startswith(' '):
+                    continue
+                record = parseKmsg(line)
+                if record.seq > self.cursor:
+                    events.append(KmsgEvent(*(record + (received,))))
+            if not events:
+                continue
+            with self.condition:
+                self.events.extend(events)
+                self.condition.notify_all()
+                callbacks = list(self.callbacks)
+            for event in events:
+                for pattern, callback in callbacks:
+                    if pattern.search(event.message):
+                        callback(event)
+
+    def addCallback(self, regex, callback):
+        """Call callback with each KmsgEvent whose message matches regex"""
+        with self.condition:
+            self.callbacks.append((re.compile(regex), callback))
+
+    def waitFor(self, regex, timeout, cursor=None):
+        """Wait for a record after the cursor whose message matches
+           regex. Return the KmsgEvent, or None if timeout seconds
+           pass first"""
+        pattern = re.compile(regex)
+        deadline = time.time() + timeout
+        index = 0
+        with self.condition:
+            while True:
+                for event in self.events[index:]:
+                    if (cursor is None or event.seq > cursor) and \
+                       pattern.search(event.message):
+                        return event
+                index = len(self.events)
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.thread.is_alive():
+                    return None
+                self.condition.wait(remaining)
+
+    def close(self):
+        """Stop watching. A closed channel wakes up the thread, but do
+           not hang the test if the SUT has gone away"""
+        self.channel.close()
+        self.thread.join(5)
+
+
+class AtuSampler(object):
+    """Samples the ATU statistics in the background, on a channel
+       started with start_ssh() running ATU_SAMPLE, so that the
+       occupancy of the ATU can be followed during a test. samples is
+       a list of (SUT time, AtuStats) tuples"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.samples = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        """Receive samples until the channel is closed"""
+        buf = ''
+        timestamp = None
+        lines = []
+        while True:
+            data = self.channel.recv(SHELL_RECV_SIZE)
+            if not data:
+                break
+            buf += data
+            received = buf.split('\n')
+            buf = received.pop()
+            for line in received:
+                if not line.startswith('sample '):
+                    lines.append(line)
+                    continue
+                if timestamp is not None:
+                    self._addSample(timestamp, lines)
+                timestamp = float(line.split()[1])
+                lines = []
+
+    def _addSample(self, timestamp, lines):
+        """Parse and keep one sample"""
+        stats = AtuStats(parseAtuStats(lines))
+        with self.lock:
+            self.samples.append((timestamp, stats))
+
+    def series(self, switch='sw0', fid=0, port='all', column=0):
+        """Return a list of (time, counter) tuples, with the time in
+           seconds since the first sample"""
+        with self.lock:
+            samples = list(self.samples)
+        if not samples:
+            return []
+        start = samples[0][0]
+        return [(timestamp - start, stats.lookup(switch, fid, port)[column])
+                for timestamp, stats in samples
+                if stats.lookup(switch, fid, port)]
+
+    def rate(self, switch='sw0', fid=0, port='all', column=0):
+        """Return the average change in the counter per second over the
+           samples, e.g. the fill rate of the ATU, or None"""
+        series = self.series(switch, fid, port, column)
+        if len(series) < 2 or series[-1][0] == series[0][0]:
+            return None
+        return (float(series[-1][1] - series[0][1]) /
+                (series[-1][0] - series[0][0]))
+
+    def close(self):
+        """Stop sampling"""
+        self.channel.close()
+        self.thread.join(5)
+
+
+class RemoteShell(object):
+    """A long lived shell running on the SUT. Commands are written to
+       its stdin, and the output and exit code of each command is
+       framed with a unique sentinel. This avoids the cost of opening
+       a new channel for every command."""
+
+    def __init__(self, transport):
+        self.channel = transport.open_session()
+        self.channel.exec_command('/bin/sh')
+        self.stdout = ''
+        self.stderr = ''
+
+    def close(self):
+        """Terminate the shell"""
+        self.channel.close()
+
+    def _recv(self):
+        """Wait for more output from the shell, and append it to the
+           buffers"""
+        select.select([self.channel], [], [])
+        if self.channel.recv_ready():
+            self.stdout += self.channel.recv(SHELL_RECV_SIZE)
+        elif self.channel.recv_stderr_ready():
+            self.stderr += self.channel.recv_stderr(SHELL_RECV_SIZE)
+        elif self.channel.closed or self.channel.exit_status_ready():
+            raise NameError('Remote shell exited')
+
+    def execute(self, command):
+        """Execute a command in the shell. Return a tuple of
+           (stdout, stderr, exit code)"""
+        sentinel = uuid.uuid4().hex
+        out_pattern = re.compile('\n{0} ([0-9]+)\n'.format(sentinel))
+        err_marker = '\n{0}\n'.format(sentinel)
+        dbg_print('shell: {0}'.format(command))
+        self.channel.sendall(
+            '( {0}\n) </dev/null\n'
+            'printf \'\\n%s %d\\n\' {1} $?\n'
+            'printf \'\\n%s\\n\' {1} >&2\n'.format(command, sentinel))
+
+        match = out_pattern.search(self.stdout)
+        while not match or err_marker not in self.stderr:
+            self._recv()
+            match = out_pattern.search(self.stdout)
+
+        results = self.stdout[:match.start()]
+        self.stdout = self.stdout[match.end():]
+        error, self.stderr = self.stderr.split(err_marker, 1)
+        return results, error, int(match.group(1))
+
+
+class Batch(object):
+    """Commands queued by SUT methods, to be executed on the SUT as
+       one script"""
+
+    def __init__(self):
+        self.commands = []
+        self.exit_codes = []
+
+    def pending(self):
+        """Return the commands which have not yet been executed"""
+        return self.commands[len(self.exit_codes):]
+
+
+class SUTAgent(object):
+    """Client of the agent running on the SUT, sut_agent.py. Requests
+       and replies are newline delimited JSON, over the SSH channel the
+       agent was started on"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.buffer = ''
+        self.request_id = 0
+        reply = json.loads(self._readLine())
+        if reply.get('result') != 'ready':
+            raise NameError('SUT agent failed to start: {0}'.format(reply))
+
+    def close(self):
+        """Terminate the agent"""
+        self.channel.close()
+
+    def _readLine(self):
+        """Return the next line the agent writes"""
+        while '\n' not in self.buffer:
+            data = self.channel.recv(SHELL_RECV_SIZE)
+            if not data:
+                error = ''
+                while self.channel.recv_stderr_ready():
+                    error += self.channel.recv_stderr(SHELL_RECV_SIZE)
+                raise NameError('SUT agent exited\n{0}'.format(error))
+            self.buffer += data
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line
+
+    def call(self, method, **params):
+        """Make a request of the agent, and return the result"""
+        self.request_id += 1
+        request = {'id': self.request_id, 'method': method,
+                   'params': params}
+        dbg_print(request)
+        self.channel.sendall(json.dumps(request) + '\n')
+        reply = {}
+        while reply.get('id') != self.request_id:
+            reply = json.loads(self._readLine())
+        dbg_print(reply)
+        if 'error' in reply:
+            raise NameError('SUT agent {0}: {1}'.format(method,
+                                                        reply['error']))
+        return reply['result']
+
+
+class FdbTable(object):
+    """The bridge FDB of the SUT, indexed by MAC address. Each entry is
+       a dict using the field names of 'bridge -json fdb show': mac,
+       ifname, vlan, master, flags and state. flags is a list which may
+       contain self, master, offload and extern_learn"""
+
+    def __init__(self, entries):
+        self.entries = collections.defaultdict(list)
+        self.ports = collections.defaultdict(set)
+        for entry in entries:
+            entry = self._normalise(entry)
+            self.entries[entry['mac']].append(entry)
+            self.ports[entry['ifname']].add(entry['mac'])
+
+    def _normalise(self, entry):
+        """Ensure all the fields are present, and strings are str"""
+        return {
+            'mac': str(entry['mac']).lower(),
+            'ifname': str(entry['ifname']),
+            'vlan': entry.get('vlan'),
+            'master': str(entry['master']) if entry.get('master') else None,
+            'flags': [str(flag) for flag in entry.get('flags', [])],
+            'state': str(entry.get('state', '')),
+        }
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, mac):
+        return mac.lower() in self.entries
+
+    def lookup(self, mac):
+        """Return the list of entries for the MAC address"""
+        return self.entries.get(mac.lower(), [])
+
+    def macs(self, interface=None, flag=None):
+        """Return the set of MAC addresses, optionally only those on the
+           interface, and/or only those with the flag, e.g. 'self' for
+           the entries in the hardware. As in getFdb(), the 'self'
+           entries with a VLAN are left out"""
+        if interface is not None:
+            macs = self.ports.get(interface, set())
+        else:
+            macs = set(self.entries.keys())
+        if flag is None:
+            return set(macs)
+        return set(mac for mac in macs
+                   for entry in self.entries[mac]
+                   if flag in entry['flags'] and
+                   (flag != 'self' or entry['vlan'] is None) and
+                   (interface is None or entry['ifname'] == interface))
+
+    def interfaces(self, mac):
+        """Return the set of interfaces the MAC address is on"""
+        return set(entry['ifname'] for entry in self.lookup(mac))
+
+
+class AtuStats(object):
+    """The mv88e6xxx ATU statistics of all the switches of the SUT. The
+       counters are indexed by switch, e.g. sw0, FID, and port, which is
+       'all' for the totals of the FID. Any header line of the
+       statistics gives the names of the counters"""
+
+    def __init__(self, stats):
+        self.counters = {}
+        self.columns = {}
+        for switch, files in stats.items():
+            for rows in files.values():
+                self._parseRows(str(switch), rows)
+
+    def _parseRows(self, switch, rows):
+        """Parse the rows of one statistics file"""
+        header = None
+        for row in rows:
+            if len(row) < 3 or not isinstance(row[0], int):
+                header = [str(field) for field in row]
+                continue
+            fid = row[0]
+            port = row[1] if isinstance(row[1], int) else str(row[1])
+            self.counters[(switch, fid, port)] = tuple(row[2:])
+            if header:
+                self.columns[(switch, fid)] = header[-len(row[2:]):]
+
+    def __len__(self):
+        return len(self.counters)
+
+    def switches(self):
+        """Return the sorted list of switches"""
+        return sorted(set(key[0] for key in self.counters))
+
+    def fids(self, switch):
+        """Return the sorted list of FIDs of the switch"""
+        return sorted(set(key[1] for key in self.counters
+                          if key[0] == switch))
+
+    def ports(self, switch, fid):
+        """Return the ports with counters for the FID, excluding 'all'"""
+        return sorted(key[2] for key in self.counters
+                      if key[:2] == (switch, fid) and key[2] != 'all')
+
+    def lookup(self, switch='sw0', fid=0, port='all'):
+        """Return the tuple of counters, or None"""
+        return self.counters.get((switch, fid, port))
+
+    def named(self, switch='sw0', fid=0, port='all'):
+        """Return the counters as a dictionary indexed by the names from
+           the header, or by position if there was no header"""
+        counters = self.lookup(switch, fid, port)
+        if counters is None:
+            return None
+        columns = self.columns.get((switch, fid), range(len(counters)))
+        return dict(zip(columns, counters))
+
+    def total(self, column=0):
+        """Return the sum of a counter over the 'all' row of every FID
+           of every switch"""
+        return sum(counters[column]
+                   for key, counters in self.counters.items()
+                   if key[2] == 'all' and len(counters) > column)
+
+
+class FdbBatchResult(object):
+    """The result of applying a bridge batch file of FDB commands.
+       failures is a dict of index into entries to the error message"""
+
+    def __init__(self, entries, failures, seconds):
+        self.entries = entries
+        self.failures = failures
+        self.seconds = seconds
+
+    @property
+    def rate(self):
+        """The number of entries programmed per second"""
+        if not self.seconds:
+            return None
+        return (len(self.entries) - len(self.failures)) / self.seconds
+
+    def succeeded(self):
+        """Return the entries which were programmed"""
+        return [entry for index, entry in enumerate(self.entries)
+                if index not in self.failures]
+
+    def report(self):
+        """Return a description of the failed entries, one per line"""
+        return '\n'.join('{0} {1}: {2}'.format(
+            self.entries[index][0], self.entries[index][1],
+            self.failures[index]) for index in sorted(self.failures))
+
+
+class StatsSnapshot(object):
+    """The statistics of a number of interfaces, collected from the SUT
+       at one point in time. stats is indexed by the kind of statistics,
+       'ethtool' or 'class', and then by interface name"""
+
+    def __init__(self):
+        self.stats = {'ethtool': {}, 'class': {}}
+
+    def ethtoolStats(self, interface):
+        """Return the Ethtool statistics of the interface"""
+        return self.stats['ethtool'][interface]
+
+    def classStats(self, interface):
+        """Return the interface class statistics of the interface"""
+        return self.stats['class'][interface]
+
+
 class SUT(object):
     """Class representing the System Under Test"""
 
-    def __init__(self, hostname, key, mgmt):
+    def __init__(self, hostname, key, mgmt, persistent=False, verify=False,
+                 agent=False, broker=None):
+        """Connect to the SUT. If persistent is True, commands are
+           executed in one long lived shell, rather than a new SSH
+           channel per command. If verify is True, the interface
+           inventory is checked against the SUT after every change. If
+           agent is True, the SUT agent is started, and information is
+           retrieved from it, rather than by running commands. If a
+           broker is given, commands and file copies use the session
+           the broker keeps open to the SUT"""
         self.mgmt = mgmt
-        self.sshClient = paramiko.SSHClient()
-        self.sshClient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.sshClient.connect(hostname, username='root', key_filename=key)
-        self.sftpClient = self.sshClient.open_sftp()
+        self.hostname = hostname
+        self.key = key
+        self.sshClient = None
+        self.sftpClient = None
+        self.session = None
+        self.shell = None
+        if broker:
+            self.session = broker.sut(hostname, key)
+        else:
+            self._connect()
+            if persistent:
+                self.shell = RemoteShell(self.sshClient.get_transport())
         self.exit_code = None
         self.error = ""
-        self.interfaces = self.getInterfaces()
+        self.batched = None
+        self.verify = verify
+        self.links = None
+        self.kmsg_watcher = None
+        self.atu_sampler = None
+        self.agent = None
+        if agent:
+            self.startAgent()
+        self.getInterfaces()
         self.fdb = []
 
+    def _connect(self):
+        """Make our own SSH connection to the SUT, if not yet made"""
+        if self.sshClient:
+            return
+        self.sshClient = paramiko.SSHClient()
+        self.sshClient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.sshClient.connect(self.hostname, username='root',
+                               key_filename=self.key)
+        self.sftpClient = self.sshClient.open_sftp()
+
     def start_ssh(self, command):
         """Start a command running on the SUT, which is expected
            to be long running. Return a handle to it, so it can later
-           be killed/close"""
+           be killed/close. When using a broker, this needs our own SSH
+           connection, which is made on first use"""
+        self._connect()
         transport = self.sshClient.get_transport()
         channel = transport.open_session()
         channel.exec_command(command)
@@ -50,20 +668,132 @@ class SUT(object):
            start_ssh()."""
         channel.close()
 
-    def ssh(self, command):
-        """Execute a command on the SUT, using SSH"""
-        self.exit_code = None
+    def startAgent(self):
+        """Upload the agent to the SUT and start it running"""
+        if self.agent:
+            return
+        src = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'sut_agent.py')
+        self.sftpPut(src, AGENT_PATH)
+        self.agent = SUTAgent(self.start_ssh(AGENT_COMMAND.format(
+            AGENT_PATH)))
+
+    def stopAgent(self):
+        """Stop the agent running on the SUT"""
+        if self.agent:
+            self.stop_ssh(self.agent.channel)
+            self.agent = None
+
+    @tracing.traced('sut')
+    def _agentCall(self, method, **params):
+        """Make a request of the agent. Any commands queued in a batch
+           are executed first, so the results reflect them"""
+        if self.batched:
+            self._flushBatch()
+        return self.agent.call(method, **params)
+
+    def _execute(self, command):
+        """Execute a command on the SUT, either in the persistent shell,
+           or on a new SSH channel. Return a tuple of
+           (stdout, stderr, exit code)"""
+        if self.session:
+            return self.session.execute(command)
+        if self.shell:
+            return self.shell.execute(command)
+
+        exit_code = None
         pattern = re.compile('exit code ([a-z0-9]+)')
         _, stdout, stderr = self.sshClient.exec_command(
             command + '; echo exit code $? ; exit\n')
         results = stdout.read()
-        self.error = stderr.read()
-        dbg_print(results)
+        error = stderr.read()
         match = pattern.search(results)
         if match:
-            self.exit_code = int(match.group(1))
+            exit_code = int(match.group(1))
+        return results, error, exit_code
+
+    @tracing.traced('sut')
+    def ssh(self, command):
+        """Execute a command on the SUT, using SSH. Any commands queued
+           in a batch are executed first, so the results reflect them"""
+        if self.batched:
+            self._flushBatch()
+        self.exit_code = None
+        results, self.error, self.exit_code = self._execute(command)
+        dbg_print(results)
         return results
 
+    def _check_call(self, command, code=0):
+        """Execute a command on the SUT and check it exits with the
+           given code. A code of None means any exit code is
+           accepted. Within a batch, the command is only queued"""
+        if self.batched:
+            method = inspect.currentframe().f_back.f_code.co_name
+            self.batched.commands.append((method, command, code))
+            return
+        self.ssh(command)
+        if code is not None:
+            self.checkExitCode(code)
+
+    def _flushBatch(self):
+        """Execute the pending commands of the batch as one script.
+           Execution stops at the first command which does not exit
+           with the expected code, and an exception is raised naming
+           the method which queued it"""
+        pending = self.batched.pending()
+        if not pending:
+            return
+        sentinel = uuid.uuid4().hex
+        script = []
+        for index, (_, command, code) in enumerate(pending):
+            script.append(command)
+            script.append('rc=$? ; echo {0} {1} $rc'.format(sentinel, index))
+            if code is not None:
+                script.append('[ $rc -eq {0} ] || exit 1'.format(code))
+        results, self.error, _ = self._execute('\n'.join(script))
+        dbg_print(results)
+
+        pattern = re.compile('^{0} [0-9]+ ([0-9]+)$'.format(sentinel),
+                             re.MULTILINE)
+        exit_codes = [int(code) for code in pattern.findall(results)]
+        self.batched.exit_codes.extend(exit_codes)
+        if exit_codes:
+            self.exit_code = exit_codes[-1]
+        for index, (method, command, code) in enumerate(pending):
+            if index >= len(exit_codes):
+                exit_code = None
+            elif code is None or exit_codes[index] == code:
+                continue
+            else:
+                exit_code = exit_codes[index]
+            del self.batched.commands[len(self.batched.exit_codes):]
+            raise NameError('{0}: exit code mismatch {1} != {2}\n{3}\n{4}'.
+                            format(method, exit_code, code, command,
+                                   self.error))
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Queue the commands issued by SUT methods within the block, and
+           execute them on the SUT as one script when the block exits.
+           Methods which need results from the SUT execute the commands
+           queued so far first. If the block raises an exception, any
+           still queued commands are discarded. Yields the Batch, whose
+           exit_codes lists the exit code of each executed command."""
+        if self.batched:
+            yield self.batched
+            return
+        self.batched = Batch()
+        try:
+            yield self.batched
+            self._flushBatch()
+        except Exception:
+            # The inventory was updated for commands which did not run
+            self.invalidateLinks()
+            raise
+        finally:
+            self.batched = None
+        self._linksChanged()
+
     def checkExitCode(self, code):
         """Check the exit code is the expected value"""
         if self.exit_code != code:
@@ -74,82 +804,188 @@ class SUT(object):
         """Return the recent kernel messages"""
         return self.ssh('dmesg')
 
+    def getKmsgCursor(self):
+        """Return a cursor for the kernel log, the sequence number of the
+           most recent record. Pass it to getKmsg() to retrieve the
+           records logged since"""
+        if self.agent:
+            return self._agentCall('kmsg_cursor')
+        results = self.ssh(KMSG_READ +
+                           " | awk -F, '/^[0-9]/ {seq=$2} END {print seq+0}'")
+        return int(results.strip())
+
+    def getKmsg(self, cursor):
+        """Return a list of KmsgRecords logged since the cursor was
+           taken. Only the new records are transferred from the SUT"""
+        if self.agent:
+            return [KmsgRecord(seq, timestamp, message)
+                    for seq, timestamp, message
+                    in self._agentCall('kmsg', since=cursor)]
+        results = self.ssh(KMSG_READ +
+                           " | awk -F, -v seq={0} '/^[0-9]/ && $2 > seq'".
+                           format(cursor))
+        return [parseKmsg(line) for line in results.splitlines()
+                if ';' in line]
+
+    def kmsgContains(self, cursor, string):
+        """Return True if a kernel log record logged since the cursor was
+           taken contains the string"""
+        for record in self.getKmsg(cursor):
+            if string in record.message:
+                return True
+        return False
+
+    def startKmsgWatcher(self):
+        """Start watching the kernel log for new records in the
+           background"""
+        if self.kmsg_watcher:
+            return
+        cursor = self.getKmsgCursor()
+        self.kmsg_watcher = KmsgWatcher(self.start_ssh('cat /dev/kmsg'),
+                                        cursor)
+
+    def stopKmsgWatcher(self):
+        """Stop watching the kernel log"""
+        if self.kmsg_watcher:
+            self.kmsg_watcher.close()
+            self.kmsg_watcher = None
+
+    def addKernelEventCallback(self, regex, callback):
+        """Call callback with a KmsgEvent for each new kernel log record
+           matching regex. It is called from the watcher's thread"""
+        self.startKmsgWatcher()
+        self.kmsg_watcher.addCallback(regex, callback)
+
+    def waitForKernelEvent(self, regex, timeout, cursor=None):
+        """Wait for a kernel log record matching regex to be logged, and
+           return it as a KmsgEvent as soon as it is. Records logged
+           before the cursor are ignored. Without a cursor, only records
+           after the watcher started are considered. Return None if no
+           such record is logged within timeout seconds"""
+        self.startKmsgWatcher()
+        if cursor is not None and cursor < self.kmsg_watcher.cursor:
+            # Logged before the watcher started
+            pattern = re.compile(regex)
+            for record in self.getKmsg(cursor):
+                if record.seq <= self.kmsg_watcher.cursor and \
+                   pattern.search(record.message):
+                    return KmsgEvent(*(record + (time.time(),)))
+        event = self.kmsg_watcher.waitFor(regex, timeout, cursor)
+        dbg_print('kernel event {0}'.format(event))
+        return event
+
+    def _parseLinks(self, results):
+        """Parse the output of 'ip -json -details link show' into an
+           interface inventory, a dict of interface name to the kind of
+           interface and its master"""
+        return self._linksInventory(json.loads(results))
+
+    def _linksInventory(self, links_json):
+        """Make the interface inventory from the decoded JSON of 'ip
+           -json -details link show', or 'addr show'"""
+        links = collections.OrderedDict()
+        for link in links_json:
+            kind = link.get('linkinfo', {}).get('info_kind')
+            master = link.get('master')
+            links[str(link['ifname'])] = {
+                'kind': str(kind) if kind else None,
+                'master': str(master) if master else None,
+            }
+        return links
+
     def getInterfaces(self):
-        """Return a list of network interface names"""
-        interfaces = []
-        results = self.ssh('ip link show')
-        pattern = re.compile('[0-9]+: ([a-z0-9_]+)')
-        for line in results.splitlines():
-            match = pattern.match(line)
-            if match:
-                interfaces.append(match.group(1))
-                self.interfaces = interfaces
-                self.checkExitCode(0)
-        return interfaces
+        """Return a list of network interface names. This refreshes the
+           interface inventory from the SUT"""
+        if self.agent:
+            links = collections.OrderedDict()
+            for link in self._agentCall('links'):
+                links[str(link['ifname'])] = {
+                    'kind': link['kind'] and str(link['kind']),
+                    'master': link['master'] and str(link['master']),
+                }
+            self.links = links
+            return list(self.links.keys())
+
+        results = self.ssh('ip -json -details link show')
+        self.checkExitCode(0)
+        self.links = self._parseLinks(results)
+        return list(self.links.keys())
+
+    def _getLinks(self):
+        """Return the interface inventory, refreshing it from the SUT if
+           it has been invalidated"""
+        if self.links is None:
+            self.getInterfaces()
+        return self.links
+
+    @property
+    def interfaces(self):
+        """The list of network interface names in the inventory"""
+        return list(self._getLinks().keys())
+
+    def invalidateLinks(self):
+        """Discard the interface inventory, so that it is refreshed from
+           the SUT when next needed. Use this after changing interfaces
+           other than via the SUT methods"""
+        self.links = None
+
+    def verifyLinks(self):
+        """Check the interface inventory matches the SUT"""
+        cached = self.links
+        self.getInterfaces()
+        if cached is not None and dict(cached) != dict(self.links):
+            raise NameError('Interface inventory mismatch\n{0}\n{1}'.format(
+                pprint.pformat(dict(cached)),
+                pprint.pformat(dict(self.links))))
+
+    def _linksChanged(self):
+        """The interface inventory has been updated to reflect a change
+           made on the SUT. Verify it, if requested"""
+        if self.verify and not self.batched:
+            self.verifyLinks()
 
     def getBridges(self):
         """Return a list of bridge interface names"""
-        bridges = []
-        interfaces = self.getInterfaces()
-        for interface in interfaces:
-            if interface.startswith('br'):
-                bridges.append(interface)
-        return bridges
+        return [name for name, link in self._getLinks().items()
+                if link['kind'] == 'bridge']
 
     def getBonds(self):
         """Return a list of bond interface names"""
-        bonds = []
-        interfaces = self.getInterfaces()
-        for interface in interfaces:
-            if interface.startswith('bond'):
-                bonds.append(interface)
-        return bonds
+        return [name for name, link in self._getLinks().items()
+                if link['kind'] == 'bond']
 
     def up(self, interface):
         """Set an interface up"""
         if interface not in self.interfaces:
             raise NameError('Up called for unknown interface')
-        result = self.ssh('ip link set {0} up'.format(interface))
-        if 'RTNETLINK answers' in result:
-            raise NameError('Up failed')
-        if 'Cannot find device' in result:
-            raise NameError('Up failed, no such device')
-        self.checkExitCode(0)
+        self._check_call('ip link set {0} up'.format(interface))
 
     def down(self, interface):
         """Set an interface down"""
         if interface not in self.interfaces:
             raise NameError('Down called for unknown interface')
-        result = self.ssh('ip link set {0} down'.format(interface))
-        if 'RTNETLINK answers' in result:
-            raise NameError('Down failed')
-        if 'Cannot find device' in result:
-            raise NameError('Down failed, no such device')
-        self.checkExitCode(0)
+        self._check_call('ip link set {0} down'.format(interface))
 
     def addAddress(self, interface, address):
         """Add an address to an interface"""
         if interface not in self.interfaces:
             raise NameError('addAddress called for unknown interface')
-        self.ssh('ip addr add {0} dev {1}'.format(
+        self._check_call('ip addr add {0} dev {1}'.format(
             address, interface))
-        self.checkExitCode(0)
 
     def delAddress(self, interface, address):
         """Delete an address from an interface"""
         if interface not in self.interfaces:
             raise NameError('addAddress called for unknown interface')
-        self.ssh('ip addr del {0} dev {1}'.format(
+        self._check_call('ip addr del {0} dev {1}'.format(
             address, interface))
-        self.checkExitCode(0)
 
     def setMacAddress(self, interface, address):
         """Set the MAC address on an interface"""
         if interface not in self.interfaces:
             raise NameError('setMacAddress called for unknown interface')
-        self.ssh('ip link set address {0} dev {1}'.format(
+        self._check_call('ip link set address {0} dev {1}'.format(
             address, interface))
-        self.checkExitCode(0)
 
     def getMacAddress(self, interface):
         """Get the MAC address on an interface"""
@@ -169,8 +1005,7 @@ class SUT(object):
         """Remove all addresses from an interface"""
         if interface not in self.interfaces:
             raise NameError('flushAddresses called for unknown interface')
-        self.ssh('ip addr flush dev {0}'.format(interface))
-        self.checkExitCode(0)
+        self._check_call('ip addr flush dev {0}'.format(interface))
 
 
     def deleteBridge(self, bridge):
@@ -180,9 +1015,13 @@ class SUT(object):
         if bridge not in self.getBridges():
             raise NameError('deleteBridge called for unknown bridge')
         self.down(bridge)
-        self.ssh('brctl delbr {0}'.format(bridge))
-        self.getInterfaces()
-        self.checkExitCode(0)
+        self._check_call('brctl delbr {0}'.format(bridge))
+        links = self._getLinks()
+        del links[bridge]
+        for link in links.values():
+            if link['master'] == bridge:
+                link['master'] = None
+        self._linksChanged()
 
     def addBridge(self, bridge):
         """Create the given bridge. Set the forwarding delay to 1 second, so
@@ -192,19 +1031,20 @@ class SUT(object):
             raise NameError('addBridge called for known interface')
         if bridge in self.getBridges():
             raise NameError('addBridge called for known bridge')
-        self.ssh('brctl addbr {0}'.format(bridge))
-        self.getInterfaces()
-        self.checkExitCode(0)
-        self.ssh('brctl setfd {0} 2'.format(bridge))
-        self.checkExitCode(0)
+        self._check_call('brctl addbr {0}'.format(bridge))
+        self._getLinks()[bridge] = {'kind': 'bridge', 'master': None}
+        self._linksChanged()
+        self._check_call('brctl setfd {0} 2'.format(bridge))
 
     def addBridgeIgmpQuerier(self, bridge):
         """Enable the bridge to perform IGMP queries"""
         if bridge not in self.getBridges():
             raise NameError('addBridgeIgmpQuerier called for unknown bridge')
-        self.ssh('ip link set {0} type bridge mcast_querier 1'.format(bridge))
-        self.ssh("ip link set {0} type bridge mcast_querier_interval 600".
-                 format(bridge))
+        self._check_call('ip link set {0} type bridge mcast_querier 1'.
+                         format(bridge), code=None)
+        self._check_call('ip link set {0} type bridge '
+                         'mcast_querier_interval 600'.format(bridge),
+                         code=None)
 
     def addBridgeInterface(self, bridge, interface):
         """Add an interface to a bridge"""
@@ -214,8 +1054,9 @@ class SUT(object):
             raise NameError('addBridgeInterface called for unknown bridge')
         if interface not in self.interfaces:
             raise NameError('addBridgeInterface called for unknown interface')
-        self.ssh('brctl addif {0} {1}'.format(bridge, interface))
-        self.checkExitCode(0)
+        self._check_call('brctl addif {0} {1}'.format(bridge, interface))
+        self._getLinks()[interface]['master'] = bridge
+        self._linksChanged()
 
     def deleteBridgeInterface(self, bridge, interface):
         """Delete an interface from a bridge"""
@@ -226,8 +1067,39 @@ class SUT(object):
         if interface not in self.interfaces:
             raise NameError(
                 'deleteBridgeInterface called for unknown interface')
-        self.ssh('brctl delif {0} {1}'.format(bridge, interface))
-        self.checkExitCode(0)
+        self._check_call('brctl delif {0} {1}'.format(bridge, interface))
+        self._getLinks()[interface]['master'] = None
+        self._linksChanged()
+
+    def waitBridgeForwarding(self, bridge, ports=None,
+                             timeout=BRIDGE_FORWARDING_TIMEOUT):
+        """Wait until the ports of the bridge have carrier and are in
+           the forwarding state. By default, all the ports of the bridge
+           are waited for. Return the number of seconds it took"""
+        if bridge not in self.getBridges():
+            raise NameError('waitBridgeForwarding called for unknown bridge')
+        if ports is None:
+            ports = [name for name, link in self._getLinks().items()
+                     if link['master'] == bridge]
+        start = time.time()
+        while True:
+            results = self.ssh('bridge -json link show')
+            self.checkExitCode(0)
+            waiting = set(ports)
+            for link in json.loads(results):
+                if link.get('master') == bridge and \
+                   link.get('state') == 'forwarding' and \
+                   'LOWER_UP' in link.get('flags', []):
+                    waiting.discard(link['ifname'])
+            elapsed = time.time() - start
+            if not waiting:
+                dbg_print('{0} forwarding after {1:.1f}s'.format(bridge,
+                                                                 elapsed))
+                return elapsed
+            if elapsed > timeout:
+                raise NameError('Ports {0} of {1} not forwarding'.format(
+                    ', '.join(sorted(waiting)), bridge))
+            tracing.sleep(POLL_INTERVAL)
 
     def bridgeEnableVlanFiltering(self, bridge):
         """Enable VLAN filtering on the bridge"""
@@ -235,9 +1107,8 @@ class SUT(object):
             raise NameError('deleteBridgeInterface called for unknown bridge')
         if bridge not in self.getBridges():
             raise NameError('deleteBridgeInterface called for unknown bridge')
-        self.ssh('echo 1 >/sys/class/net/{0}/bridge/vlan_filtering'.format(
-            bridge))
-        self.checkExitCode(0)
+        self._check_call(
+            'echo 1 >/sys/class/net/{0}/bridge/vlan_filtering'.format(bridge))
 
     def bridgeDisableVlanFiltering(self, bridge):
         """Disable VLAN filtering on the bridge"""
@@ -245,14 +1116,65 @@ class SUT(object):
             raise NameError('deleteBridgeInterface called for unknown bridge')
         if bridge not in self.getBridges():
             raise NameError('deleteBridgeInterface called for unknown bridge')
-        self.ssh('echo 0 >/sys/class/net/{0}/bridge/vlan_filtering'.format(
-            bridge))
+        self._check_call(
+            'echo 0 >/sys/class/net/{0}/bridge/vlan_filtering'.format(bridge))
+
+    def getMdb(self, bridge=None):
+        """Return a list of the MDB entries, optionally only those of the
+           given bridge. Each entry is a dictionary with at least the
+           'dev', 'port' and 'grp' of 'bridge -json mdb show'"""
+        if self.agent:
+            entries = self._agentCall('mdb')
+        else:
+            results = self.ssh('bridge -json mdb show')
+            self.checkExitCode(0)
+            entries = []
+            for table in json.loads(results):
+                entries.extend(table.get('mdb', []))
+        if bridge:
+            entries = [entry for entry in entries if entry['dev'] == bridge]
+        return entries
+
+    def waitMdb(self, bridge, group, ports, timeout=MDB_TIMEOUT, since=None):
+        """Wait until the bridge has MDB entries for the group on all
+           the given ports. Return a dictionary of how many seconds it
+           took for each port to join, counted from since, by default
+           when called"""
+        if bridge not in self.getBridges():
+            raise NameError('waitMdb called for unknown bridge')
+        if since is None:
+            since = time.time()
+        joined = {}
+        while True:
+            for entry in self.getMdb(bridge):
+                if entry['grp'] == group and entry['port'] in ports and \
+                   entry['port'] not in joined:
+                    joined[entry['port']] = time.time() - since
+            if len(joined) == len(set(ports)):
+                dbg_print('{0} joined {1}'.format(group, joined))
+                return joined
+            if time.time() - since > timeout:
+                raise NameError('Ports {0} of {1} did not join {2}'.format(
+                    ', '.join(sorted(set(ports) - set(joined))), bridge,
+                    group))
+            tracing.sleep(POLL_INTERVAL)
+
+    def getFdbTable(self):
+        """Return an FdbTable of all the FDB entries, on all interfaces"""
+        if self.agent:
+            return FdbTable(self._agentCall('fdb'))
+        results = self.ssh('bridge -json fdb show')
         self.checkExitCode(0)
+        return FdbTable(json.loads(results))
 
     def getFdb(self, interface):
         """Return a list of fdb entries on the given interface"""
         if interface not in self.interfaces:
             raise NameError('getFdb called for unknown interface')
+        if self.agent:
+            return [str(entry['mac'])
+                    for entry in self._agentCall('fdb', interface=interface)
+                    if 'self' in entry['flags'] and 'vlan' not in entry]
         macs = []
         results = self.ssh('bridge fdb show dev {0}'.format(interface))
         pattern = re.compile('((?:[a-f0-9][a-f0-9]:){5}[a-f0-9][a-f0-9]) self')
@@ -266,41 +1188,115 @@ class SUT(object):
         """Add a static fdb entry on the interface"""
         if interface not in self.interfaces:
             raise NameError('addFdb called for unknown interface')
-        self.ssh('bridge fdb add {0} dev {1}'.format(address, interface))
-        self.checkExitCode(0)
+        self._check_call('bridge fdb add {0} dev {1}'.format(address,
+                                                             interface))
         self.fdb.append((interface, address))
 
     def delFdb(self, interface, address):
         """Add a static fdb entry on the interface"""
         if interface not in self.interfaces:
             raise NameError('addFdb called for unknown interface')
-        self.ssh('bridge fdb del {0} dev {1}'.format(address, interface))
-        self.checkExitCode(0)
+        self._check_call('bridge fdb del {0} dev {1}'.format(address,
+                                                             interface))
         self.fdb.remove((interface, address))
 
-    def flushFdb(self):
-        """Flush all static fdb entries"""
-        for entry in self.fdb:
-            interface = entry[0]
-            address = entry[1]
-            self.ssh('bridge fdb del {0} dev {1}'.format(address, interface))
-        self.checkExitCode(0)
-        self.fdb = []
+    def _fdbBatch(self, command, entries):
+        """Upload a bridge batch file which performs the command, add or
+           del, for each of the (interface, address) entries, and apply
+           it. Return an FdbBatchResult"""
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.batch',
+                                         delete=False) as batch:
+            for interface, address in entries:
+                batch.write('fdb {0} {1} dev {2}\n'.format(command, address,
+                                                           interface))
+        try:
+            self.sftpPut(batch.name, FDB_BATCH_PATH)
+        finally:
+            os.unlink(batch.name)
 
-    def getFdbStats(self):
-        """Get the ATU statistics"""
-        pattern = re.compile(
-            ' +0 +all +([0-9]+) +([0-9]+) +([0-9]+) +([0-9]+) +([0-9]+)')
-        results = self.ssh('cat /sys/kernel/debug/mv88e6xxx/sw0/atu/0-stats')
-        for line in results.splitlines():
+        start = time.time()
+        self.ssh('bridge -force -batch {0}'.format(FDB_BATCH_PATH))
+        seconds = time.time() - start
+
+        # bridge reports the error, followed by the failed line number
+        failures = {}
+        message = []
+        pattern = re.compile('Command failed .*:([0-9]+)$')
+        for line in self.error.splitlines():
             match = pattern.match(line)
             if match:
-                return (int(match.group(1)),
-                        int(match.group(2)),
-                        int(match.group(3)),
-                        int(match.group(4)),
-                        int(match.group(5)))
-        return None
+                failures[int(match.group(1)) - 1] = ' '.join(message)
+                message = []
+            else:
+                message.append(line.strip())
+        if self.exit_code != 0 and not failures:
+            raise NameError('bridge batch failed\n{0}'.format(self.error))
+        result = FdbBatchResult(entries, failures, seconds)
+        dbg_print('fdb {0}: {1} entries in {2:.3f}s'.format(
+            command, len(entries), seconds))
+        return result
+
+    def addFdbBulk(self, entries):
+        """Add static fdb entries, a list of (interface, address). They
+           are programmed using one bridge batch file. If any fail,
+           those which were added are deleted again, and an exception
+           listing the failures is raised. Return an FdbBatchResult,
+           whose rate is the entries programmed per second"""
+        for interface, _ in entries:
+            if interface not in self.interfaces:
+                raise NameError('addFdbBulk called for unknown interface')
+        result = self._fdbBatch('add', entries)
+        if result.failures:
+            self._fdbBatch('del', result.succeeded())
+            raise NameError('addFdbBulk: {0} of {1} entries failed\n{2}'.
+                            format(len(result.failures), len(entries),
+                                   result.report()))
+        self.fdb.extend(entries)
+        return result
+
+    def flushFdb(self):
+        """Flush all static fdb entries, using one bridge batch file.
+           Return an FdbBatchResult"""
+        if not self.fdb:
+            return FdbBatchResult([], {}, 0)
+        result = self._fdbBatch('del', self.fdb)
+        self.fdb = [entry for index, entry in enumerate(self.fdb)
+                    if index in result.failures]
+        if result.failures:
+            raise NameError('flushFdb: {0} entries failed\n{1}'.format(
+                len(result.failures), result.report()))
+        return result
+
+    def getAtuStats(self):
+        """Get the ATU statistics of all the switches as AtuStats"""
+        if self.agent:
+            return AtuStats(self._agentCall('atu_stats'))
+        results = self.ssh(ATU_STATS)
+        return AtuStats(parseAtuStats(results.splitlines()))
+
+    def getFdbStats(self):
+        """Get the ATU statistics totals of FID 0 of the first switch"""
+        counters = self.getAtuStats().lookup('sw0', 0, 'all')
+        if counters is None or len(counters) < 5:
+            return None
+        return counters[:5]
+
+    def startAtuSampler(self, interval=1):
+        """Start sampling the ATU statistics every interval seconds in
+           the background. Return the AtuSampler"""
+        self.stopAtuSampler()
+        self.atu_sampler = AtuSampler(self.start_ssh(
+            ATU_SAMPLE.format(ATU_STATS, interval)))
+        return self.atu_sampler
+
+    def stopAtuSampler(self):
+        """Stop sampling the ATU statistics. Return the AtuSampler, whose
+           samples remain available, or None if none was running"""
+        sampler = self.atu_sampler
+        if sampler:
+            sampler.close()
+            self.atu_sampler = None
+        return sampler
 
     def _statsCheckRange(self, before, after, _range, unittest):
         """Perform the check that the statistics are within range"""
@@ -368,69 +1364,140 @@ class SUT(object):
                 self._statsCheckRangeFail(key, delta[key], range1, range2,
                                           unittest)
 
+    def _parseEthtoolStats(self, lines):
+        """Parse the output of 'ethtool -S' into a dict"""
+        stats = {}
+        pattern = re.compile('(.+): ([0-9]+)')
+        for line in lines:
+            match = pattern.match(line)
+            if match:
+                key = match.group(1).strip()
+                value = int(match.group(2))
+                stats[key] = value
+        return stats
+
+    def _parseClassStats(self, lines):
+        """Parse the output of grep over the interface class statistics
+           files into a dict"""
+        stats = dict((stat, None) for stat in STATS_FILES)
+        pattern = re.compile('([a-z_]+):([0-9]+)')
+        for line in lines:
+            match = pattern.match(line)
+            if match:
+                stats[match.group(1)] = int(match.group(2))
+        return stats
+
+    def snapshotStats(self, interfaces, kinds=('ethtool', 'class')):
+        """Collect the statistics of all the interfaces, using one
+           command on the SUT. kinds lists the statistics wanted,
+           'ethtool' and/or 'class'. Return a StatsSnapshot"""
+        for interface in interfaces:
+            if interface not in self.interfaces:
+                raise NameError('snapshotStats called for unknown interface')
+        snapshot = StatsSnapshot()
+        if self.agent:
+            stats = self._agentCall('stats', interfaces=list(interfaces),
+                                    kinds=list(kinds))
+            snapshot.stats['ethtool'].update(stats['ethtool'])
+            snapshot.stats['class'].update(stats['class'])
+            return snapshot
+
+        sentinel = uuid.uuid4().hex
+        script = []
+        for interface in interfaces:
+            if 'ethtool' in kinds:
+                script.append('echo {0} ethtool {1} ; ethtool -S {1}'.format(
+                    sentinel, interface))
+            if 'class' in kinds:
+                script.append('echo {0} class {1} ; '
+                              '( cd /sys/class/net/{1}/statistics && '
+                              'grep . {2} )'.format(sentinel, interface,
+                                                    ' '.join(STATS_FILES)))
+        results = self.ssh('\n'.join(script))
+
+        sections = results.split(sentinel + ' ')
+        for section in sections[1:]:
+            lines = section.splitlines()
+            kind, interface = lines[0].split()
+            if kind == 'ethtool':
+                stats = self._parseEthtoolStats(lines[1:])
+            else:
+                stats = self._parseClassStats(lines[1:])
+            snapshot.stats[kind][interface] = stats
+        return snapshot
+
+    def _statsFor(self, stats, kind, interface):
+        """Return the statistics of the interface, if stats is a
+           StatsSnapshot. Otherwise stats is already a dict of
+           statistics for the interface"""
+        if isinstance(stats, StatsSnapshot):
+            return stats.stats[kind][interface]
+        return stats
+
     def getEthtoolStats(self, interface):
         """Get the Ethtool statistics from an interface.
 
            NOTE: These statistics are not standardised in any way. The
            names will differ from driver to driver. It is best to use
            these for information only."""
-        stats = {}
-        pattern = re.compile('(.+): ([0-9]+)')
         if interface not in self.interfaces:
             raise NameError(
                 'getEthtoolStats called for unknown interface')
+        if self.agent:
+            return self._agentCall('ethtool_stats', interface=interface)
         results = self.ssh('ethtool -S {0}'.format(interface))
-        for line in results.splitlines():
-            match = pattern.match(line)
-            if match:
-                key = match.group(1).strip()
-                value = int(match.group(2))
-                stats[key] = value
-        return stats
+        return self._parseEthtoolStats(results.splitlines())
 
-    def checkEthtoolStatsRange(self, interface, before, _range, unittest):
-        """Check that the stats have incremented within the expect range."""
-        after = self.getEthtoolStats(interface)
+    def checkEthtoolStatsRange(self, interface, before, _range, unittest,
+                               after=None):
+        """Check that the stats have incremented within the expect range.
+           before and after can be StatsSnapshots. If after is not
+           given, the current statistics are used."""
+        before = self._statsFor(before, 'ethtool', interface)
+        if after is None:
+            after = self.getEthtoolStats(interface)
+        after = self._statsFor(after, 'ethtool', interface)
         self._statsCheckRange(before, after, _range, unittest)
 
     def checkEthtoolStatsRangeOr(self, interface, before, range1, range2,
-                                 unittest):
+                                 unittest, after=None):
         """Check that the stats have incremented within one of the expect
-           ranges."""
-        after = self.getEthtoolStats(interface)
+           ranges. before and after can be StatsSnapshots. If after is
+           not given, the current statistics are used."""
+        before = self._statsFor(before, 'ethtool', interface)
+        if after is None:
+            after = self.getEthtoolStats(interface)
+        after = self._statsFor(after, 'ethtool', interface)
         self._statsCheckRangeOr(before, after, range1, range2, unittest)
 
-    def _getNumberContents(self, filename):
-        """Return the contents of the file"""
-        pattern = re.compile('([a-z0-9]+).*')
-        result = self.ssh('cat {0}'.format(filename))
-        match = pattern.match(result)
-        if match:
-            return int(match.group(1))
-        return None
-
     def getClassStats(self, interface):
         """Get the interface class stats.
 
            These values are standardized, so should be portable
            between drivers. We will see..."""
-        stats = {}
         if interface not in self.interfaces:
             raise NameError(
                 'getClassStats called for unknown interface')
-        for stat in STATS_FILES:
-            value = self._getNumberContents(
-                '/sys/class/net/{0}/statistics/{1}'.format(interface, stat))
-            stats[stat] = value
-        return stats
+        snapshot = self.snapshotStats([interface], kinds=('class',))
+        return snapshot.classStats(interface)
 
-    def checkClassStatsRange(self, interface, before, _range, unittest):
-        """Check that the stats have incremented within the expect range."""
-        after = self.getClassStats(interface)
+    def checkClassStatsRange(self, interface, before, _range, unittest,
+                             after=None):
+        """Check that the stats have incremented within the expect range.
+           before and after can be StatsSnapshots. If after is not
+           given, the current statistics are used."""
+        before = self._statsFor(before, 'class', interface)
+        if after is None:
+            after = self.getClassStats(interface)
+        after = self._statsFor(after, 'class', interface)
         self._statsCheckRange(before, after, _range, unittest)
 
     def phcGet(self, interface):
         """Get the time from a Precision Hardware Counter"""
+        if self.agent:
+            phc = self._agentCall('phc_time', interface=interface)
+            date = datetime.datetime.strptime(phc['date'], "%c")
+            return phc['seconds'], date
         results = self.ssh('phc_ctl {0} get'.format(interface))
         self.checkExitCode(0)
         pattern = re.compile('phc_ctl\[.*\]: clock time is ([0-9]*.[0-9]*) or (.*)$')
@@ -444,44 +1511,293 @@ class SUT(object):
     def phcSet(self, interface, seconds):
         """Set the time on a Precision Hardware Counter"""
         if seconds:
-            self.ssh('phc_ctl {0} set {1}'.format(interface, seconds))
+            self._check_call('phc_ctl {0} set {1}'.format(interface, seconds))
         else:
-            self.ssh('phc_ctl {0} set'.format(interface))
-        self.checkExitCode(0)
+            self._check_call('phc_ctl {0} set'.format(interface))
+
+    def _parsePtpStatus(self, results):
+        """Parse the output of PTP_STATUS into a dictionary. The port
+           states are returned as a list, there is one per port"""
+        status = {'failed': False, 'portState': []}
+        for line in results.splitlines():
+            if line == 'ptp4l failed':
+                status['failed'] = True
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                continue
+            name, value = fields
+            if name == 'portState':
+                status['portState'].append(value)
+            elif name in ('master_offset', 'ingress_time'):
+                status[name] = int(value)
+            elif name == 'gmPresent':
+                status[name] = value == 'true'
+        return status
+
+    def waitPtpLocked(self, threshold=PTP_OFFSET_THRESHOLD,
+                      samples=PTP_LOCKED_SAMPLES, timeout=PTP_LOCK_TIMEOUT):
+        """Wait for ptp4l on the SUT, acting as a slave, to lock to its
+           master. It is locked when a port is in the SLAVE state,
+           which ptp4l only enters once the servo has locked, and the
+           offset from the master has stayed within threshold ns for the
+           given number of sync messages. Return the number of seconds
+           it took. A faulty port or failed ptp4l raises NameError
+           without waiting for the timeout"""
+        start = time.time()
+        locked = 0
+        ingress_time = None
+        while True:
+            status = self._parsePtpStatus(self.ssh(PTP_STATUS))
+            if status['failed']:
+                raise NameError('ptp4l failed')
+            if 'FAULTY' in status['portState']:
+                raise NameError('ptp4l port is FAULTY')
+            if 'SLAVE' not in status['portState'] or \
+               not status.get('gmPresent'):
+                locked = 0
+            elif status.get('ingress_time') != ingress_time:
+                # A new sync message, so a new offset sample
+                ingress_time = status['ingress_time']
+                if abs(status['master_offset']) <= threshold:
+                    locked += 1
+                else:
+                    locked = 0
+            elapsed = time.time() - start
+            if locked >= samples:
+                dbg_print('PTP locked after {0:.1f}s'.format(elapsed))
+                return elapsed
+            if elapsed > timeout:
+                raise NameError('PTP not locked after {0}s: {1}'.format(
+                    timeout, status))
+            tracing.sleep(POLL_INTERVAL)
 
     def serviceStart(self, service):
         """Start a systemd service running on the SUT"""
-        self.ssh('systemctl start {0}'.format(service))
-        self.checkExitCode(0)
+        self._check_call('systemctl start {0}'.format(service))
 
     def serviceStop(self, service):
         """Start a systemd service running on the SUT"""
-        self.ssh('systemctl stop {0}'.format(service))
+        self._check_call('systemctl stop {0}'.format(service), code=None)
 
+    @tracing.traced('sut')
     def sftpPut(self, src, dst):
         """Copy the src file to the sut"""
+        if self.session:
+            self.session.put(os.path.abspath(src), dst)
+            return
         self.sftpClient.put(src, dst)
 
-    def cleanSystem(self):
-        """Clean the system i.e. remove all bridges, check there are no bonds,
-           put all interfaces down"""
-        bonds = self.getBonds()
+    def deleteBond(self, bond):
+        """Destroy the given bond, releasing its slaves"""
+        if bond not in self.getBonds():
+            raise NameError('deleteBond called for unknown bond')
+        self._check_call('ip link del {0}'.format(bond))
+        links = self._getLinks()
+        del links[bond]
+        for link in links.values():
+            if link['master'] == bond:
+                link['master'] = None
+        self._linksChanged()
+
+    def _isTestInterface(self, interface):
+        """Is the interface one of the ports the tests use"""
+        return (interface.startswith('lan') or
+                interface.startswith('optical') or
+                interface.startswith('net') or
+                interface.startswith('port') or
+                interface.startswith('eth_cu')) and \
+            not interface.startswith(self.mgmt)
+
+    def _getSystemState(self):
+        """Fetch the SYSTEM_STATE document, refreshing the interface
+           inventory from it"""
+        results = self.ssh(SYSTEM_STATE)
+        self.checkExitCode(0)
+        state = json.loads(results)
+        self.links = self._linksInventory(state['links'])
+        return state
+
+    def cleanSystem(self, keep_up=()):
+        """Clean the system i.e. remove all bridges and bonds, the static
+           fdb entries added by addFdb(), and put all interfaces down
+           without addresses, other than those in keep_up which are left
+           up. The state of the SUT is fetched at once, and only the
+           commands needed to clean it are executed, as one batch. So a
+           clean SUT costs one round trip"""
+        state = self._getSystemState()
         bridges = self.getBridges()
-        interfaces = self.getInterfaces()
-        interfaces = [interface for interface in interfaces if
-                      (interface.startswith('lan') or
-                       interface.startswith('optical') or
-                       interface.startswith('net') or
-                       interface.startswith('port') or
-                       interface.startswith('eth_cu')) and
-                      not interface.startswith(self.mgmt)]
-
-        if len(bonds):
-            #  Todo: Implement cleanup of bonds
-            raise NameError('SUT has some bonds: {0}'.format(bonds))
-        self.flushFdb()
-        for bridge in bridges:
-            self.deleteBridge(bridge)
-        for interface in interfaces:
-            self.flushAddresses(interface)
-            self.down(interface)
+        bonds = self.getBonds()
+        added = set((interface, address.lower())
+                    for interface, address in self.fdb)
+
+        with self.batch():
+            for entry in state['fdb']:
+                if entry.get('state') != 'static' or \
+                   entry.get('master') in bridges or \
+                   (str(entry['ifname']), str(entry['mac']).lower()) \
+                   not in added:
+                    continue
+                command = 'bridge fdb del {0} dev {1}'.format(
+                    entry['mac'], entry['ifname'])
+                if entry.get('vlan'):
+                    command += ' vlan {0}'.format(entry['vlan'])
+                if 'master' in entry.get('flags', []):
+                    command += ' master'
+                self._check_call(command)
+            self.fdb = []
+            for bridge in bridges:
+                self.deleteBridge(bridge)
+            for bond in bonds:
+                self.deleteBond(bond)
+            for link in state['links']:
+                interface = str(link['ifname'])
+                if not self._isTestInterface(interface):
+                    continue
+                if link.get('addr_info'):
+                    self.flushAddresses(interface)
+                if 'UP' in link.get('flags', []) and \
+                   interface not in keep_up:
+                    self.down(interface)
+
+    def applyTopology(self, topology):
+        """Converge the SUT to the topology, a dictionary of:
+
+           up: list of interfaces to set up
+           bridges: dictionary of bridge name to a dictionary of
+               interfaces: list of interfaces to add to the bridge
+               vlan_filtering: True to enable VLAN filtering
+               igmp_querier: True to make the bridge an IGMP querier
+           addresses: dictionary of interface to a list of addresses
+           fdb: list of (interface, address) static fdb entries
+
+           All keys are optional. Bridges are set up. Whatever else is
+           configured is cleaned, as by cleanSystem(), but interfaces
+           which are to be up are not set down first. The cleaning and
+           configuration are executed as one batch, then the SUT state
+           is read back once and checked against the topology"""
+        up = topology.get('up', [])
+        bridges = topology.get('bridges', {})
+        with self.batch():
+            self.cleanSystem(keep_up=up)
+            for interface in up:
+                self.up(interface)
+            for bridge, config in sorted(bridges.items()):
+                self.addBridge(bridge)
+                if config.get('igmp_querier'):
+                    self.addBridgeIgmpQuerier(bridge)
+                if config.get('vlan_filtering'):
+                    self.bridgeEnableVlanFiltering(bridge)
+                self.up(bridge)
+                for interface in config.get('interfaces', []):
+                    self.addBridgeInterface(bridge, interface)
+            for interface, addresses in sorted(
+                    topology.get('addresses', {}).items()):
+                for address in addresses:
+                    self.addAddress(interface, address)
+            for interface, address in topology.get('fdb', []):
+                self.addFdb(interface, address)
+        self._verifyTopology(topology)
+
+    def _verifyTopology(self, topology):
+        """Read the state of the SUT, and check it matches the
+           topology"""
+        state = self._getSystemState()
+        links = dict((link['ifname'], link) for link in state['links'])
+        errors = []
+        bridges = topology.get('bridges', {})
+        for interface in topology.get('up', []) + list(bridges):
+            if 'UP' not in links.get(interface, {}).get('flags', []):
+                errors.append('{0} is not up'.format(interface))
+        for bridge, config in bridges.items():
+            info = links.get(bridge, {}).get('linkinfo', {})
+            if info.get('info_kind') != 'bridge':
+                errors.append('{0} is not a bridge'.format(bridge))
+            elif config.get('vlan_filtering') and \
+                    not info.get('info_data', {}).get('vlan_filtering'):
+                errors.append('{0} is not VLAN filtering'.format(bridge))
+            for interface in config.get('interfaces', []):
+                if links.get(interface, {}).get('master') != bridge:
+                    errors.append('{0} is not in {1}'.format(interface,
+                                                             bridge))
+        for interface, addresses in topology.get('addresses', {}).items():
+            present = set('{0}/{1}'.format(addr['local'], addr['prefixlen'])
+                          for addr in links.get(interface, {}).get(
+                              'addr_info', []))
+            for address in addresses:
+                if address.lower() not in present:
+                    errors.append('{0} does not have {1}'.format(
+                        interface, address))
+        fdb = FdbTable(state['fdb'])
+        for interface, address in topology.get('fdb', []):
+            if interface not in fdb.interfaces(address):
+                errors.append('{0} not in the fdb of {1}'.format(
+                    address, interface))
+        if errors:
+            raise NameError('Topology not applied:\n{0}'.format(
+                '\n'.join(errors)))
+
+
+def fromConfig(config, broker=None):
+    """Return the SUT described by the configuration, read by
+       params.readConfig(). If it names a network namespace, the SUT is
+       simulated in it on this machine"""
+    if config.netns:
+        import netns_sut
+        return netns_sut.NetnsSUT(config, agent=config.agent)
+    return SUT(hostname=config.hostname, key=config.key,
+               mgmt=config.SUT_MGMT,
+               persistent=config.persistent,
+               agent=config.agent,
+               broker=broker)
+
+
+class AsyncSUT(object):
+    """Makes the calls of the SUT asynchronous. Each method returns a
+       Future straight away, and the command it runs is sent on its own
+       channel of the SSH connection, so a number of calls can be
+       outstanding at once. For example:
+
+       stats = gather(*[async_sut.getEthtoolStats(interface)
+                        for interface in interfaces])
+
+       takes about one round trip to the SUT, rather than one each.
+       When using a broker, the commands are still serialised by it.
+
+       Only the queries, whose names start with one of ASYNC_PREFIXES,
+       can be made asynchronously. Changes to the SUT must be made on
+       the SUT itself, which keeps its inventory up to date"""
+
+    def __init__(self, sut):
+        self.sut = sut
+        if not sut.session:
+            sut._connect()
+
+    def _worker(self):
+        """Return a copy of the SUT which makes each call on a new SSH
+           channel, rather than sharing the persistent shell or agent"""
+        if self.sut.batched:
+            self.sut._flushBatch()
+        worker = copy.copy(self.sut)
+        worker.shell = None
+        worker.agent = None
+        worker.batched = None
+        # So that refreshing the inventory in the worker does not race
+        # with the SUT changing it
+        worker.links = copy.deepcopy(self.sut.links)
+        worker.fdb = list(self.sut.fdb)
+        return worker
+
+    def __getattr__(self, name):
+        attr = getattr(self.sut, name)
+        if not callable(attr):
+            return attr
+        if not name.startswith(ASYNC_PREFIXES):
+            raise NameError('{0} cannot be called asynchronously'.format(
+                name))
+
+        def call(*args, **kwargs):
+            """Start the call, returning a Future"""
+            return Future(functools.partial(getattr(self._worker(), name),
+                                            *args, **kwargs))
+        return call
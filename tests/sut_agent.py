@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+"""Agent which runs on the System Under Test. It is uploaded and
+   started by the SUT class, and answers requests on stdin with
+   replies on stdout, both as newline delimited JSON. Each request is
+   an object {"id": n, "method": name, "params": {...}}, and each
+   reply is {"id": n, "result": ...} or {"id": n, "error": message}.
+
+   The information is gathered directly from sysfs, debugfs, ioctl()s
+   and netlink, rather than by running ip, bridge, ethtool etc. This
+   must run with both python 2 and 3, using only the standard library,
+   since that is all we can expect to find on the board."""
+import array
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import json
+import os
+import socket
+import struct
+import sys
+import time
+
+SYS_CLASS_NET = '/sys/class/net'
+DEBUGFS_MV88E6XXX = '/sys/kernel/debug/mv88e6xxx'
+
+SIOCETHTOOL = 0x8946
+ETHTOOL_GDRVINFO = 0x03
+ETHTOOL_GSTRINGS = 0x1b
+ETHTOOL_GSTATS = 0x1d
+ETHTOOL_GET_TS_INFO = 0x41
+ETH_SS_STATS = 1
+ETH_GSTRING_LEN = 32
+# Offset of n_stats in struct ethtool_drvinfo, and its size
+DRVINFO_N_STATS = 180
+DRVINFO_LEN = 196
+TS_INFO_LEN = 44
+IFREQ_LEN = 40
+
+NETLINK_ROUTE = 0
+AF_BRIDGE = 7
+RTM_NEWNEIGH = 28
+RTM_GETNEIGH = 30
+RTM_NEWMDB = 84
+RTM_GETMDB = 86
+NLM_F_REQUEST = 0x01
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NDA_LLADDR = 2
+NDA_VLAN = 5
+NDA_MASTER = 9
+MDBA_MDB = 1
+MDBA_MDB_ENTRY = 1
+MDBA_MDB_ENTRY_INFO = 1
+NLA_TYPE_MASK = 0x3fff
+
+NTF_FLAGS = [(0x02, 'self'), (0x04, 'master'), (0x10, 'extern_learn'),
+             (0x20, 'offload')]
+NUD_STATES = [(0x80, 'permanent'), (0x40, 'static'), (0x04, 'stale')]
+MDB_STATES = {0: 'temp', 1: 'permanent'}
+
+KMSG_RECORD_LEN = 8192
+
+CLOCKFD = 3
+CLOCK_TIMESPEC = ctypes.c_long * 2
+
+
+def _readFile(filename):
+    """Return the stripped contents of a file, or None if it cannot be
+       read"""
+    try:
+        with open(filename) as _file:
+            return _file.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _readNumber(filename):
+    """Return the contents of a file as an integer, or None"""
+    value = _readFile(filename)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _ifindexes():
+    """Return a dict mapping interface index to interface name"""
+    indexes = {}
+    for interface in os.listdir(SYS_CLASS_NET):
+        index = _readNumber(os.path.join(SYS_CLASS_NET, interface,
+                                         'ifindex'))
+        if index is not None:
+            indexes[index] = interface
+    return indexes
+
+
+def _ethtool(interface, data):
+    """Perform a SIOCETHTOOL ioctl on the interface. data is the
+       command structure, which is updated in place"""
+    buf = array.array('B', data)
+    address, _ = buf.buffer_info()
+    ifreq = struct.pack('16sP', interface.encode('ascii'), address)
+    ifreq += b'\0' * (IFREQ_LEN - len(ifreq))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        fcntl.ioctl(sock.fileno(), SIOCETHTOOL, ifreq)
+    finally:
+        sock.close()
+    return buf.tostring() if sys.version_info[0] < 3 else buf.tobytes()
+
+
+def _netlinkDump(msg_type, family_header):
+    """Perform a netlink dump request, and return a list of the
+       (type, payload) of the messages received"""
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    messages = []
+    try:
+        request = struct.pack('=IHHII', 16 + len(family_header), msg_type,
+                              NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+        sock.send(request + family_header)
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset < len(data):
+                length, _type, _, _, _ = struct.unpack_from('=IHHII', data,
+                                                            offset)
+                if _type == NLMSG_DONE:
+                    return messages
+                if _type == NLMSG_ERROR:
+                    error, = struct.unpack_from('=i', data, offset + 16)
+                    if error:
+                        raise OSError(-error, os.strerror(-error))
+                else:
+                    messages.append((_type,
+                                     data[offset + 16:offset + length]))
+                offset += (length + 3) & ~3
+    finally:
+        sock.close()
+
+
+def _attributes(data, offset=0):
+    """Parse netlink attributes. Return a list of (type, payload)"""
+    attributes = []
+    while offset + 4 <= len(data):
+        length, _type = struct.unpack_from('=HH', data, offset)
+        if length < 4:
+            break
+        attributes.append((_type & NLA_TYPE_MASK,
+                           data[offset + 4:offset + length]))
+        offset += (length + 3) & ~3
+    return attributes
+
+
+def _flagNames(value, names):
+    """Return the names of the bits set in value"""
+    return [name for bit, name in names if value & bit]
+
+
+class Agent(object):
+    """Dispatch requests to the methods named rpc_<method>"""
+
+    def rpc_ping(self):
+        """Check the agent is alive"""
+        return 'pong'
+
+    def rpc_links(self):
+        """Return the network interfaces, with their kind, master and
+           state"""
+        links = []
+        for interface in sorted(os.listdir(SYS_CLASS_NET)):
+            path = os.path.join(SYS_CLASS_NET, interface)
+            kind = None
+            uevent = _readFile(os.path.join(path, 'uevent')) or ''
+            for line in uevent.splitlines():
+                if line.startswith('DEVTYPE='):
+                    kind = line.split('=', 1)[1]
+            master = None
+            if os.path.islink(os.path.join(path, 'master')):
+                master = os.path.basename(
+                    os.readlink(os.path.join(path, 'master')))
+            links.append({
+                'ifname': interface,
+                'ifindex': _readNumber(os.path.join(path, 'ifindex')),
+                'kind': kind,
+                'master': master,
+                'operstate': _readFile(os.path.join(path, 'operstate')),
+                'carrier': _readNumber(os.path.join(path, 'carrier')),
+                'mtu': _readNumber(os.path.join(path, 'mtu')),
+                'address': _readFile(os.path.join(path, 'address')),
+            })
+        return links
+
+    def rpc_ethtool_stats(self, interface):
+        """Return the Ethtool statistics of the interface, as a dict"""
+        drvinfo = struct.pack('=I', ETHTOOL_GDRVINFO) + \
+            b'\0' * (DRVINFO_LEN - 4)
+        try:
+            drvinfo = _ethtool(interface, drvinfo)
+        except (IOError, OSError) as exc:
+            if exc.errno == errno.EOPNOTSUPP:
+                return {}
+            raise
+        n_stats, = struct.unpack_from('=I', drvinfo, DRVINFO_N_STATS)
+        if not n_stats:
+            return {}
+
+        strings = struct.pack('=III', ETHTOOL_GSTRINGS, ETH_SS_STATS,
+                              n_stats)
+        strings = _ethtool(interface, strings +
+                           b'\0' * (n_stats * ETH_GSTRING_LEN))
+        values = struct.pack('=II', ETHTOOL_GSTATS, n_stats)
+        values = _ethtool(interface, values + b'\0' * (n_stats * 8))
+
+        stats = {}
+        for index in range(n_stats):
+            start = 12 + index * ETH_GSTRING_LEN
+            name = strings[start:start + ETH_GSTRING_LEN]
+            name = name.split(b'\0', 1)[0].decode('ascii').strip()
+            value, = struct.unpack_from('=Q', values, 8 + index * 8)
+            stats[name] = value
+        return stats
+
+    def rpc_class_stats(self, interface):
+        """Return the interface class statistics, as a dict"""
+        path = os.path.join(SYS_CLASS_NET, interface, 'statistics')
+        stats = {}
+        for stat in os.listdir(path):
+            stats[stat] = _readNumber(os.path.join(path, stat))
+        return stats
+
+    def rpc_stats(self, interfaces, kinds):
+        """Return the statistics of a number of interfaces, indexed by
+           kind, 'ethtool' or 'class', and then interface"""
+        stats = {'ethtool': {}, 'class': {}}
+        for interface in interfaces:
+            if 'ethtool' in kinds:
+                stats['ethtool'][interface] = self.rpc_ethtool_stats(
+                    interface)
+            if 'class' in kinds:
+                stats['class'][interface] = self.rpc_class_stats(interface)
+        return stats
+
+    def rpc_fdb(self, interface=None):
+        """Return the bridge FDB entries, optionally only those of one
+           interface. The fields are named as 'bridge -json fdb show'"""
+        indexes = _ifindexes()
+        header = struct.pack('=BBHiHBB', AF_BRIDGE, 0, 0, 0, 0, 0, 0)
+        entries = []
+        for _type, payload in _netlinkDump(RTM_GETNEIGH, header):
+            if _type != RTM_NEWNEIGH:
+                continue
+            _, _, _, ifindex, state, flags, _ = struct.unpack_from(
+                '=BBHiHBB', payload)
+            ifname = indexes.get(ifindex)
+            if interface and ifname != interface:
+                continue
+            entry = {'ifname': ifname,
+                     'flags': _flagNames(flags, NTF_FLAGS),
+                     'state': ' '.join(_flagNames(state, NUD_STATES))}
+            for attr, value in _attributes(payload, 12):
+                if attr == NDA_LLADDR:
+                    entry['mac'] = ':'.join(
+                        '{0:02x}'.format(byte)
+                        for byte in bytearray(value))
+                elif attr == NDA_VLAN:
+                    entry['vlan'], = struct.unpack('=H', value[:2])
+                elif attr == NDA_MASTER:
+                    master, = struct.unpack('=i', value[:4])
+                    entry['master'] = indexes.get(master)
+            entries.append(entry)
+        return entries
+
+    def rpc_mdb(self):
+        """Return the bridge MDB entries. The fields are named as
+           'bridge -json mdb show'"""
+        indexes = _ifindexes()
+        header = struct.pack('=BxxxI', AF_BRIDGE, 0)
+        entries = []
+        for _type, payload in _netlinkDump(RTM_GETMDB, header):
+            if _type != RTM_NEWMDB:
+                continue
+            _, bridge = struct.unpack_from('=BxxxI', payload)
+            for attr, mdb in _attributes(payload, 8):
+                if attr != MDBA_MDB:
+                    continue
+                for attr, entry in _attributes(mdb):
+                    if attr != MDBA_MDB_ENTRY:
+                        continue
+                    for attr, info in _attributes(entry):
+                        if attr == MDBA_MDB_ENTRY_INFO:
+                            entries.append(self._mdbEntry(
+                                indexes, bridge, info))
+        return entries
+
+    def _mdbEntry(self, indexes, bridge, info):
+        """Decode a struct br_mdb_entry"""
+        ifindex, state, flags, vid = struct.unpack_from('=IBBH', info)
+        proto, = struct.unpack_from('!H', info, 24)
+        if proto == 0x0800:
+            group = socket.inet_ntop(socket.AF_INET, info[8:12])
+        else:
+            group = socket.inet_ntop(socket.AF_INET6, info[8:24])
+        return {'dev': indexes.get(bridge),
+                'port': indexes.get(ifindex),
+                'grp': group,
+                'state': MDB_STATES.get(state, state),
+                'flags': flags,
+                'vid': vid}
+
+    def rpc_atu_stats(self):
+        """Return the mv88e6xxx ATU statistics from debugfs, indexed by
+           switch and then file name. Each file is a list of rows, each
+           row a list of fields, numbers converted to integers"""
+        stats = {}
+        if not os.path.isdir(DEBUGFS_MV88E6XXX):
+            return stats
+        for switch in sorted(os.listdir(DEBUGFS_MV88E6XXX)):
+            path = os.path.join(DEBUGFS_MV88E6XXX, switch, 'atu')
+            if not os.path.isdir(path):
+                continue
+            stats[switch] = {}
+            for filename in sorted(os.listdir(path)):
+                if not filename.endswith('-stats'):
+                    continue
+                rows = []
+                contents = _readFile(os.path.join(path, filename)) or ''
+                for line in contents.splitlines():
+                    rows.append([int(field) if field.isdigit() else field
+                                 for field in line.split()])
+                stats[switch][filename] = rows
+        return stats
+
+    def _kmsg(self):
+        """Return a list of the records in the kernel log, each a list
+           of sequence number, timestamp in seconds and message"""
+        records = []
+        fd = os.open('/dev/kmsg', os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            while True:
+                try:
+                    record = os.read(fd, KMSG_RECORD_LEN)
+                except OSError as exc:
+                    if exc.errno == errno.EPIPE:
+                        # The record was overwritten, carry on
+                        continue
+                    if exc.errno == errno.EAGAIN:
+                        break
+                    raise
+                header, message = record.decode(
+                    'utf-8', 'replace').split(';', 1)
+                fields = header.split(',')
+                records.append([int(fields[1]), int(fields[2]) / 1e6,
+                                message.split('\n', 1)[0]])
+        finally:
+            os.close(fd)
+        return records
+
+    def rpc_kmsg_cursor(self):
+        """Return the sequence number of the most recent kernel log
+           record"""
+        records = self._kmsg()
+        return records[-1][0] if records else 0
+
+    def rpc_kmsg(self, since):
+        """Return the kernel log records with a sequence number after
+           since"""
+        return [record for record in self._kmsg() if record[0] > since]
+
+    def rpc_phc_time(self, interface):
+        """Return the time of the PTP Hardware Clock of the interface,
+           as seconds, and as a date formatted in the same way as
+           phc_ctl"""
+        ts_info = struct.pack('=I', ETHTOOL_GET_TS_INFO) + \
+            b'\0' * (TS_INFO_LEN - 4)
+        ts_info = _ethtool(interface, ts_info)
+        phc_index, = struct.unpack_from('=i', ts_info, 8)
+        if phc_index < 0:
+            raise OSError(errno.ENODEV, 'No PHC for {0}'.format(interface))
+
+        fd = os.open('/dev/ptp{0}'.format(phc_index), os.O_RDONLY)
+        try:
+            clock = ((~fd) << 3) | CLOCKFD
+            libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                               use_errno=True)
+            timespec = CLOCK_TIMESPEC()
+            if libc.clock_gettime(clock, ctypes.byref(timespec)):
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error))
+        finally:
+            os.close(fd)
+        seconds = timespec[0] + timespec[1] / 1e9
+        return {'seconds': seconds,
+                'date': time.strftime('%c', time.localtime(timespec[0]))}
+
+    def handle(self, line):
+        """Handle one request line, and return the reply"""
+        try:
+            request = json.loads(line)
+        except ValueError as exc:
+            return {'id': None, 'error': 'Bad request: {0}'.format(exc)}
+        reply = {'id': request.get('id')}
+        method = getattr(self, 'rpc_' + str(request.get('method')), None)
+        if method is None:
+            reply['error'] = 'Unknown method {0}'.format(
+                request.get('method'))
+            return reply
+        params = dict((str(key), value) for key, value in
+                      request.get('params', {}).items())
+        try:
+            reply['result'] = method(**params)
+        except Exception as exc:  # pylint: disable=broad-except
+            reply['error'] = '{0}: {1}'.format(type(exc).__name__, exc)
+        return reply
+
+
+def main():
+    """Answer requests until stdin is closed"""
+    agent = Agent()
+    sys.stdout.write(json.dumps({'id': None, 'result': 'ready'}) + '\n')
+    sys.stdout.flush()
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        sys.stdout.write(json.dumps(agent.handle(line)) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""Optional tracing of where the time of a test run goes: test methods,
+   SSH commands to the SUT, commands on the host, drone RPCs, capture
+   saving and sleeps. Spans are recorded per thread, nested by time,
+   and saved in the Chrome trace event format, which can be loaded
+   into chrome://tracing or https://ui.perfetto.dev. A summary of the
+   biggest consumers of time is printed at exit.
+
+   Tracing is started by passing --trace FILE to a test. When it is
+   not started, spans cost a single test of TRACER. Test methods are
+   recorded by the TestSpans result hook, and sleeps only where sleep()
+   is used instead of time.sleep()."""
+from __future__ import print_function
+
+import atexit
+import collections
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+TRACER = None
+# Longest argument to record in a span
+ARG_LEN = 200
+
+
+class Tracer(object):
+    """Records spans, as trace events with a start and duration"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def add(self, name, category, start, end, args):
+        """Record a span which ran from start until end"""
+        event = {'name': name,
+                 'cat': category,
+                 'ph': 'X',
+                 'ts': (start - self.start) * 1e6,
+                 'dur': (end - start) * 1e6,
+                 'pid': os.getpid(),
+                 'tid': threading.current_thread().ident,
+                 'args': args}
+        with self.lock:
+            self.events.append(event)
+
+    def save(self):
+        """Write the trace events to the file"""
+        with self.lock:
+            events = list(self.events)
+        with open(self.filename, 'w') as trace:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                      trace)
+
+    def _selfTimes(self):
+        """Return a list of (event, self time in us), the self time
+           being the duration not spent in spans nested within it"""
+        with self.lock:
+            events = list(self.events)
+        threads = collections.defaultdict(list)
+        for event in events:
+            threads[event['tid']].append(event)
+        times = []
+        for thread_events in threads.values():
+            thread_events.sort(key=lambda event: (event['ts'], -event['dur']))
+            stack = []
+            for event in thread_events:
+                entry = [event, event['dur']]
+                while stack and stack[-1][0]['ts'] + stack[-1][0]['dur'] <= \
+                        event['ts']:
+                    stack.pop()
+                if stack:
+                    stack[-1][1] -= event['dur']
+                stack.append(entry)
+                times.append(entry)
+        return times
+
+    def summary(self, top=20):
+        """Return a table of the span names taking the most time,
+           excluding the time of the spans nested within them"""
+        totals = collections.defaultdict(lambda: [0, 0, 0])
+        for event, self_time in self._selfTimes():
+            total = totals[(event['cat'], event['name'])]
+            total[0] += self_time
+            total[1] += event['dur']
+            total[2] += 1
+        lines = ['{0:>10} {1:>10} {2:>6}  {3}'.format(
+            'self (s)', 'total (s)', 'count', 'span')]
+        ranked = sorted(totals.items(), key=lambda item: -item[1][0])
+        for (category, name), (self_time, total, count) in ranked[:top]:
+            lines.append('{0:10.3f} {1:10.3f} {2:6}  {3}: {4}'.format(
+                self_time / 1e6, total / 1e6, count, category, name))
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    """Record the time spent in the with block as a span"""
+    tracer = TRACER
+    if tracer is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        tracer.add(name, category, start, time.time(), args)
+
+
+def traced(category):
+    """Decorator recording each call of a method as a span named after
+       the category and the method, with its arguments"""
+    def decorator(method):
+        """Wrap the method"""
+        name = '{0}.{1}'.format(category, method.__name__)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            """Call the method within a span"""
+            if TRACER is None:
+                return method(self, *args, **kwargs)
+            with span(name, category,
+                      args=[str(arg)[:ARG_LEN] for arg in args]):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracedDrone(object):
+    """Stands in for a DroneProxy, recording each RPC as a span"""
+
+    def __init__(self, drone):
+        self.drone = drone
+
+    def __getattr__(self, name):
+        attr = getattr(self.drone, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            """Make the RPC within a span"""
+            with span('drone.' + name, 'drone'):
+                return attr(*args, **kwargs)
+        return call
+
+
+def traceDrone(drone):
+    """Return the drone, wrapped to record its RPCs if tracing"""
+    if TRACER is None:
+        return drone
+    return TracedDrone(drone)
+
+
+def sleep(seconds):
+    """time.sleep(), recorded as a span"""
+    with span('sleep', 'sleep', seconds=seconds):
+        time.sleep(seconds)
+
+
+class TestSpans(object):
+    """A test result hook, see params.addResultHook(), recording each
+       test method as a span"""
+
+    def __init__(self):
+        self.starts = {}
+
+    def startTest(self, test):
+        """Note when the test started"""
+        self.starts[test] = time.time()
+
+    def stopTest(self, test):
+        """Record the test as a span"""
+        start_time = self.starts.pop(test, None)
+        tracer = TRACER
+        if tracer is not None and start_time is not None:
+            tracer.add(test.id(), 'test', start_time, time.time(), {})
+
+
+def start(filename):
+    """Start tracing. At exit, the trace is saved to filename and a
+       summary printed"""
+    global TRACER
+
+    if TRACER is not None:
+        return
+    TRACER = Tracer(filename)
+    atexit.register(stop)
+
+
+def stop():
+    """Stop tracing, save the trace and print the summary"""
+    global TRACER
+    tracer = TRACER
+    if tracer is None:
+        return
+    TRACER = None
+    tracer.save()
+    print('Trace saved to {0}'.format(tracer.filename), file=sys.stderr)
+    print(tracer.summary(), file=sys.stderr)
@@ -2,10 +2,20 @@
 """Create streams and receive packets"""
 # pylint: disable=E1101
 
+import atexit
+import collections
+import gzip
 import inspect
+import json
+import os
 import pprint
+import Queue
+import shutil
+import subprocess
 import sys
+import threading
 import time
+import weakref
 import ipaddress
 import netaddr
 from ostinato.core import ost_pb, DroneProxy
@@ -17,7 +27,25 @@ from ostinato.protocols.udp_pb2 import udp
 from ostinato.protocols.igmp_pb2 import igmp
 from ostinato.protocols.sign_pb2 import sign
 
+import params
+import tracing
+
 IGMPv2_REQUEST = 0x16
+# Polling for the end of transmission, once the streams should be done
+TX_POLL_INTERVAL = 0.02
+# How long transmission may overrun the expected time before giving up
+TX_TIMEOUT = 10
+# Time for the last packets to cross the SUT and be received, once
+# transmission has finished
+TX_SETTLE = 0.2
+# When packets are captured and the captures saved. on-failure only
+# saves the captures of the last run of a test which fails. ports always
+# saves, but only captures on the selected ports
+CAPTURE_MODES = ('off', 'always', 'on-failure', 'ports')
+# Captures are saved in a directory per run below this one
+CAPTURE_DIR = 'captures'
+# Threads compressing and writing the captures
+CAPTURE_WORKERS = 4
 
 DEBUG = False
 PP = pprint.PrettyPrinter(indent=4)
@@ -44,11 +72,145 @@ def get_class_from_frame(frame):
     return None
 
 
+class CapturePolicy(object):
+    """When to capture received packets, on which ports, and which of the
+       saved captures to keep"""
+    def __init__(self, mode='always', ports=None, capture_filter=None,
+                 ring=0):
+        """ports is a list of host interface names to capture on, all of
+           them if None. The saved captures are filtered by the BPF
+           capture_filter, if given. Only the captures of the last ring
+           runs are kept, or all of them if 0"""
+        if mode not in CAPTURE_MODES:
+            raise NameError('Unknown capture mode {0}'.format(mode))
+        if mode == 'ports' and not ports:
+            raise NameError('Capture mode ports needs a list of ports')
+        self.mode = mode
+        self.ports = ports
+        self.capture_filter = capture_filter
+        self.ring = ring
+
+    def capturing(self, interface_name):
+        """Should packets received on the interface be captured"""
+        if self.mode == 'off':
+            return False
+        return not self.ports or interface_name in self.ports
+
+    def saveEachRun(self):
+        """Should the captures be saved after every run"""
+        return self.mode in ('always', 'ports')
+
+
+def capturePolicy(args):
+    """Return the capture policy given by the command line arguments"""
+    ports = args.capture_ports.split(',') if args.capture_ports else None
+    return CapturePolicy(mode=args.capture, ports=ports,
+                         capture_filter=args.capture_filter,
+                         ring=args.capture_ring)
+
+
+class CaptureOnFailure(object):
+    """A test result hook, see params.addResultHook(), saving the
+       captures of the last traffic run of each test which fails"""
+
+    def __init__(self, traffic):
+        self.traffic = weakref.ref(traffic)
+        self.runs = None
+
+    def startTest(self, _test):
+        """Note how many runs there were before the test"""
+        traffic = self.traffic()
+        self.runs = traffic.runs if traffic is not None else None
+
+    def _save(self):
+        """Save the captures, if the test made a run"""
+        traffic = self.traffic()
+        if traffic is not None and self.runs is not None and \
+                traffic.runs > self.runs:
+            traffic.saveCaptures()
+
+    def addFailure(self, _test, _err):
+        """The test failed"""
+        self._save()
+
+    def addError(self, _test, _err):
+        """The test raised an unexpected exception"""
+        self._save()
+
+
+class CaptureWriter(object):
+    """A pool of threads writing captures in the background, so that
+       the next run need not wait for them"""
+    def __init__(self, workers=CAPTURE_WORKERS):
+        self.jobs = Queue.Queue()
+        self.errors = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+
+    def _worker(self):
+        """Do the jobs, remembering any exceptions for wait()"""
+        while True:
+            call, args = self.jobs.get()
+            try:
+                with tracing.span('capture.' + call.__name__, 'traffic'):
+                    call(*args)
+            except Exception as exception:
+                self.errors.append(exception)
+            finally:
+                self.jobs.task_done()
+
+    def submit(self, call, *args):
+        """Call call(*args) in one of the threads"""
+        self.jobs.put((call, args))
+
+    def wait(self):
+        """Wait for all the jobs to finish. Raise the first exception
+           they raised, if any"""
+        self.jobs.join()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise NameError('Saving captures failed: {0}'.format(errors[0]))
+
+
+def _writeCapture(filename, buff, capture_filter):
+    """Write the capture buffer compressed, filtered by the BPF filter
+       if given"""
+    if capture_filter:
+        raw = filename + '.raw'
+        filtered = filename + '.filtered'
+        with open(raw, 'wb') as capture:
+            capture.write(buff)
+        try:
+            with open(os.devnull, 'w') as null:
+                subprocess.check_call(['tcpdump', '-r', raw, '-w', filtered,
+                                       capture_filter], stderr=null)
+            with open(filtered, 'rb') as capture:
+                buff = capture.read()
+        finally:
+            for temporary in (raw, filtered):
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+    capture = gzip.open(filename, 'wb')
+    try:
+        capture.write(buff)
+    finally:
+        capture.close()
+
+
 class Traffic(object):
     """Class for traffic streams"""
-    def __init__(self):
-        self.drone = DroneProxy('127.0.0.1')
-        self.drone.connect()
+    def __init__(self, broker=None, capture=None):
+        """Connect to the drone. If a broker is given, the connection the
+           broker keeps open to the drone is used. capture is the
+           CapturePolicy, by default capturing and saving everything"""
+        if broker:
+            self.drone = broker.sharedDrone()
+        else:
+            self.drone = DroneProxy('127.0.0.1')
+            self.drone.connect()
+        self.drone = tracing.traceDrone(self.drone)
 
         self.port_id_list = self.drone.getPortIdList()
         self.port_config_list = self.drone.getPortConfig(self.port_id_list)
@@ -62,9 +224,20 @@ class Traffic(object):
         self.port_config = ost_pb.PortConfigList()
         self.port_config_ports = 0
         self.guid = 0
+        self.capture = capture or CapturePolicy()
+        self.capture_port = ost_pb.PortIdList()
+        self.capturedInterfaces = []
+        self.runs = 0
+        self.last_run = None
+        self.saved = collections.deque()
+        self.writer = CaptureWriter()
+        atexit.register(self.writer.wait)
+        if self.capture.mode == 'on-failure':
+            params.addResultHook(CaptureOnFailure(self))
 
     def __del__(self):
-        """Cleanup the streams"""
+        """Cleanup the streams. The captures being written are waited
+           for at exit"""
         for interface in self.interfaces:
             for stream_id_list in interface['stream_id_list_list']:
                 self.drone.deleteStream(stream_id_list)
@@ -84,21 +257,20 @@ class Traffic(object):
                 'stream_id_list_list': [],
                 'stream_cfg': stream_cfg,
                 'stream_id': 1,
+                'registry': {},
+                'streams': [],
+                'wanted': [],
+                'signatures': {},
             }
             interfaces.append(interface)
         return interfaces
 
     def _cleanupRun(self):
-        """Delete all current streams, so that we can create new
-           once for the next run"""
+        """Forget which streams the run wanted. The streams are left on
+           the drone, to be reused or disabled by the next run"""
         for interface in self.interfaces:
-            port_id = interface['port_id_id']
-            for stream_id_list in interface['stream_id_list_list']:
-                self.drone.deleteStream(stream_id_list)
-            stream_cfg = ost_pb.StreamConfigList()
-            stream_cfg.port_id.id = port_id
-            interface['stream_cfg'] = stream_cfg
-            interface['stream_id'] = 1
+            interface['wanted'] = []
+            interface['signatures'] = {}
 
     def _getInterfaceByName(self, interface_name):
         """Return the interface dict for a given interface name"""
@@ -139,6 +311,9 @@ class Traffic(object):
         self.port_config.port[self.port_config_ports] \
                         .is_tracking_stream_stats = True
         self.port_config_ports += 1
+        if self.capture.capturing(interface_name):
+            self.capture_port.port_id.add().id = port_id
+            self.capturedInterfaces.append(interface_name)
 
     def _getInterfaceMacAddress(self, interface):
         """Return the MAC address of an interface"""
@@ -224,13 +399,21 @@ class Traffic(object):
         """Add an IGMP Request header to a stream"""
         self._addIGMPHeader(stream, IGMPv2_REQUEST, group)
 
-    def _addStream(self, stream_cfg, interface, num_packets, packets_per_sec):
-        """Add a stream to an interface, and return it"""
-        stream_id_list = ost_pb.StreamIdList()
-        stream_id_list.stream_id.add().id = interface['stream_id']
-        stream_id_list.port_id.id = interface['port_id_id']
-        self.drone.addStream(stream_id_list)
-        interface['stream_id_list_list'].append(stream_id_list)
+    def _addStream(self, stream_cfg, interface, num_packets, packets_per_sec,
+                   signature):
+        """Add a stream to an interface, and return it. The stream is only
+           staged locally, it is sent to the drone by _commitStreams().
+           If a previous run made a stream with the same signature, it is
+           reused and None is returned"""
+        # The same stream may be wanted more than once in a run
+        count = interface['signatures'].get(signature, 0)
+        interface['signatures'][signature] = count + 1
+        signature = signature + (count,)
+        if signature in interface['registry']:
+            interface['wanted'].append(interface['registry'][signature])
+            return None
+        interface['registry'][signature] = interface['stream_id']
+        interface['wanted'].append(interface['stream_id'])
         stream = stream_cfg.stream.add()
         stream.stream_id.id = interface['stream_id']
         interface['stream_id'] = interface['stream_id'] + 1
@@ -287,8 +470,11 @@ class Traffic(object):
         src_interface = self._getInterfaceByName(src_interface_name)
         dst_interface = self._getInterfaceByName(dst_interface_name)
         stream_cfg = src_interface['stream_cfg']
+        signature = ('udp', dst_interface_name, num_packets, packets_per_sec)
         stream = self._addStream(stream_cfg, src_interface, num_packets,
-                                 packets_per_sec)
+                                 packets_per_sec, signature)
+        if stream is None:
+            return
         src_mac = self._getInterfaceMacAddress(src_interface)
         dst_mac = self._getInterfaceMacAddress(dst_interface)
         src_ip = self._getInterfaceIPv4Address(src_interface)
@@ -296,7 +482,6 @@ class Traffic(object):
 
         self._addUDPv4PacketStream(stream, src_mac, 0, 1, dst_mac, src_ip,
                                    dst_ip)
-        self.drone.modifyStream(stream_cfg)
 
     def addUDPv6Stream(self, src_interface_name, dst_interface_name,
                        num_packets, packets_per_sec):
@@ -309,8 +494,12 @@ class Traffic(object):
         src_interface = self._getInterfaceByName(src_interface_name)
         dst_interface = self._getInterfaceByName(dst_interface_name)
         stream_cfg = src_interface['stream_cfg']
+        signature = ('udpv6', dst_interface_name, num_packets,
+                     packets_per_sec)
         stream = self._addStream(stream_cfg, src_interface, num_packets,
-                                 packets_per_sec)
+                                 packets_per_sec, signature)
+        if stream is None:
+            return
         src_mac = self._getInterfaceMacAddress(src_interface)
         dst_mac = self._getInterfaceMacAddress(dst_interface)
         src_ip = self._getInterfaceIPv6Address(src_interface)
@@ -318,7 +507,6 @@ class Traffic(object):
 
         self._addUDPv6PacketStream(stream, src_mac, 0, 1, dst_mac,
                                    src_ip, dst_ip)
-        self.drone.modifyStream(stream_cfg)
 
     def addUDPMacIncStream(self, src_interface_name, dst_interface_name,
                            src_mac, num_packets, packets_per_sec,
@@ -336,15 +524,18 @@ class Traffic(object):
         src_interface = self._getInterfaceByName(src_interface_name)
         dst_interface = self._getInterfaceByName(dst_interface_name)
         stream_cfg = src_interface['stream_cfg']
+        signature = ('udp', dst_interface_name, num_packets, packets_per_sec,
+                     src_mac, src_mac_count, src_mac_step)
         stream = self._addStream(stream_cfg, src_interface, num_packets,
-                                 packets_per_sec)
+                                 packets_per_sec, signature)
+        if stream is None:
+            return
         dst_mac = self._getInterfaceMacAddress(dst_interface)
         src_ip = self._getInterfaceIPv4Address(src_interface)
         dst_ip = self._getInterfaceIPv4Address(dst_interface)
 
         self._addUDPv4PacketStream(stream, src_mac, src_mac_count,
                                    src_mac_step, dst_mac, src_ip, dst_ip)
-        self.drone.modifyStream(stream_cfg)
 
     def addUDPBroadcastStream(self, src_interface_name, num_packets,
                               packets_per_sec):
@@ -356,15 +547,17 @@ class Traffic(object):
                          packets_per_sec))
         src_interface = self._getInterfaceByName(src_interface_name)
         stream_cfg = src_interface['stream_cfg']
+        signature = ('broadcast', num_packets, packets_per_sec)
         stream = self._addStream(stream_cfg, src_interface, num_packets,
-                                 packets_per_sec)
+                                 packets_per_sec, signature)
+        if stream is None:
+            return
         src_mac = self._getInterfaceMacAddress(src_interface)
         src_ip = self._getInterfaceIPv4Address(src_interface)
         dst_mac = 0xffffffffffff
         dst_ip = 0xc0a82aff
         self._addUDPv4PacketStream(stream, src_mac, 0, 1, dst_mac,
                                    src_ip, dst_ip)
-        self.drone.modifyStream(stream_cfg)
 
     def addUDPMulticastStream(self, src_interface_name, group_str, num_packets,
                               packets_per_sec):
@@ -377,8 +570,11 @@ class Traffic(object):
                          packets_per_sec))
         src_interface = self._getInterfaceByName(src_interface_name)
         stream_cfg = src_interface['stream_cfg']
+        signature = ('multicast', group_str, num_packets, packets_per_sec)
         stream = self._addStream(stream_cfg, src_interface, num_packets,
-                                 packets_per_sec)
+                                 packets_per_sec, signature)
+        if stream is None:
+            return
         src_mac = self._getInterfaceMacAddress(src_interface)
         group = ipaddress.ip_address(group_str.decode())
         dst_mac = 0x01005e000000 + (int(group) & 0x07fffff)
@@ -387,7 +583,6 @@ class Traffic(object):
 
         self._addUDPv4PacketStream(stream, src_mac, 0, 1, dst_mac,
                                    src_ip, dst_ip)
-        self.drone.modifyStream(stream_cfg)
 
     def addIGMPRequestStream(self, src_interface_name, group, num_packets,
                              packets_per_sec):
@@ -397,8 +592,11 @@ class Traffic(object):
                   format(src_interface_name, group, num_packets))
         src_interface = self._getInterfaceByName(src_interface_name)
         stream_cfg = src_interface['stream_cfg']
+        signature = ('igmp', group, num_packets, packets_per_sec)
         stream = self._addStream(stream_cfg, src_interface, num_packets,
-                                 packets_per_sec)
+                                 packets_per_sec, signature)
+        if stream is None:
+            return
         src_mac = self._getInterfaceMacAddress(src_interface)
         dst_mac = 0x01005e00001
         src_ip = self._getInterfaceIPv4Address(src_interface)
@@ -410,8 +608,6 @@ class Traffic(object):
         self._addIPv4Header(stream, src_ip=src_ip, dst_ip=dst_ip)
         self._addIGMPRequestHeader(stream, group)
 
-        self.drone.modifyStream(stream_cfg)
-
     def learningStream(self, interface_name):
         """Create a stream on the interface for bridge learning. Two broadcast
            packets will be sent, so allowing the switch to learn the source
@@ -430,42 +626,175 @@ class Traffic(object):
         test = get_class_from_frame(frame).__name__
         self._run(test, method)
 
-    def _saveCapture(self, testname, methodname, interface_name):
-        """Save the capture file for one interface"""
-        filename = "{0}-{1}-{2}.pcap".format(testname, methodname,
-                                             interface_name)
+    def _commitStreams(self):
+        """Update the streams on the drone for this run, with at most one
+           addStream and one modifyStream per port. New streams are added,
+           and only the streams whose enabled state or position changes
+           since the previous run are modified. The drone sends the
+           streams of a port in the order of their ordinal, which is set
+           to the order the run added them"""
+        for interface in self.interfaces:
+            port_id = interface['port_id_id']
+            stream_cfg = interface['stream_cfg']
+            if stream_cfg.stream:
+                stream_id_list = ost_pb.StreamIdList()
+                stream_id_list.port_id.id = port_id
+                for stream in stream_cfg.stream:
+                    stream_id_list.stream_id.add().id = stream.stream_id.id
+                self.drone.addStream(stream_id_list)
+                interface['stream_id_list_list'].append(stream_id_list)
+            ordinals = dict((stream_id, ordinal) for ordinal, stream_id
+                            in enumerate(interface['wanted']))
+            changed = ost_pb.StreamConfigList()
+            changed.port_id.id = port_id
+            for stream in interface['streams']:
+                enabled = stream.stream_id.id in ordinals
+                ordinal = ordinals.get(stream.stream_id.id,
+                                       stream.core.ordinal)
+                if stream.core.is_enabled != enabled or \
+                        stream.core.ordinal != ordinal:
+                    stream.core.is_enabled = enabled
+                    stream.core.ordinal = ordinal
+                    changed.stream.add().CopyFrom(stream)
+            for stream in stream_cfg.stream:
+                stream.core.ordinal = ordinals[stream.stream_id.id]
+                changed.stream.add().CopyFrom(stream)
+                committed = ost_pb.Stream()
+                committed.CopyFrom(stream)
+                interface['streams'].append(committed)
+            if changed.stream:
+                self.drone.modifyStream(changed)
+            stream_cfg = ost_pb.StreamConfigList()
+            stream_cfg.port_id.id = port_id
+            interface['stream_cfg'] = stream_cfg
+
+    def _transmitTime(self):
+        """Return the number of seconds the streams of this run are
+           expected to take. The streams of a port are sent one after
+           the other, while the ports transmit in parallel"""
+        longest = 0
+        for interface in self.interfaces:
+            seconds = 0
+            for stream in interface['streams']:
+                if stream.stream_id.id not in interface['wanted']:
+                    continue
+                if stream.control.packets_per_sec:
+                    seconds += (stream.control.num_packets /
+                                float(stream.control.packets_per_sec))
+            longest = max(longest, seconds)
+        return longest
+
+    def _transmittingPorts(self):
+        """Return the names of the ports still transmitting"""
+        tx_stats = self.drone.getStats(self.tx_port)
+        return [self._getInterfaceByPortId(port_stats.port_id.id)['name']
+                for port_stats in tx_stats.port_stats
+                if port_stats.state.is_transmit_on]
+
+    def _waitTransmit(self):
+        """Sleep for the expected transmit time, then poll until all the
+           ports have finished transmitting"""
+        expected = self._transmitTime()
+        dbg_print('_waitTransmit: expected {0}s'.format(expected))
+        tracing.sleep(expected)
+        end = time.time() + TX_TIMEOUT
+        while True:
+            transmitting = self._transmittingPorts()
+            if not transmitting:
+                return
+            if time.time() > end:
+                self.drone.stopTransmit(self.tx_port)
+                self._stopCapture()
+                self._cleanupRun()
+                raise NameError('Ports still transmitting after {0}s: {1}'.
+                                format(expected + TX_TIMEOUT,
+                                       ', '.join(transmitting)))
+            tracing.sleep(TX_POLL_INTERVAL)
+
+    def _startCapture(self):
+        """Start capturing on the ports the policy selects"""
+        if self.capture_port.port_id:
+            self.drone.startCapture(self.capture_port)
+
+    def _stopCapture(self):
+        """Stop capturing on the ports the policy selects"""
+        if self.capture_port.port_id:
+            self.drone.stopCapture(self.capture_port)
+
+    def _saveCapture(self, directory, interface_name):
+        """Fetch the capture buffer of one interface, and have it written
+           in the background. Return the name of the file"""
+        filename = '{0}.pcap.gz'.format(interface_name)
         interface = self._getInterfaceByName(interface_name)
+        # The drone connection is not thread safe, and the buffer is lost
+        # when the next run starts capturing, so fetch it now
         buff = self.drone.getCaptureBuffer(interface['port_id'])
-        self.drone.saveCaptureBuffer(buff, filename)
+        self.writer.submit(_writeCapture, os.path.join(directory, filename),
+                           buff, self.capture.capture_filter)
+        return filename
 
+    @tracing.traced('traffic')
     def _saveCaptures(self, testname, methodname):
-        """Save the capture files, using the test name as a prefix"""
-        for interface_name in self.addedInterfaces:
-            self._saveCapture(testname, methodname, interface_name)
-
+        """Save the capture files in a directory for the run, with an
+           index.json describing them. They are compressed and written in
+           the background. Only the captures of the last runs the
+           policy's ring allows are kept"""
+        directory = os.path.join(CAPTURE_DIR, '{0:04}-{1}-{2}'.format(
+            self.runs, testname, methodname))
+        if directory in self.saved:
+            return
+        # Left behind by a previous session of the tests
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        captures = dict((interface_name,
+                         self._saveCapture(directory, interface_name))
+                        for interface_name in self.capturedInterfaces)
+        with open(os.path.join(directory, 'index.json'), 'w') as index:
+            json.dump({'test': testname,
+                       'method': methodname,
+                       'run': self.runs,
+                       'filter': self.capture.capture_filter,
+                       'captures': captures}, index, indent=4)
+        self.saved.append(directory)
+        if self.capture.ring and len(self.saved) > self.capture.ring:
+            # Do not remove a directory still being written
+            self.writer.wait()
+            while len(self.saved) > self.capture.ring:
+                shutil.rmtree(self.saved.popleft(), ignore_errors=True)
+
+    def waitCaptures(self):
+        """Wait for the captures being saved to be written"""
+        self.writer.wait()
+
+    def saveCaptures(self):
+        """Save the captures of the last run, whatever the policy. They
+           stay on the drone until the next run starts capturing"""
+        if self.last_run is None or not self.capturedInterfaces:
+            return
+        self._saveCaptures(*self.last_run)
+
+    @tracing.traced('traffic')
     def _run(self, test, method):
         """Do the real work"""
+        self._commitStreams()
         self.drone.modifyPort(self.port_config)
         self.drone.clearStats(self.tx_port)
         self.drone.clearStats(self.rx_port)
         self.drone.clearStreamStats(self.guids)
-        self.drone.startCapture(self.rx_port)
+        self._startCapture()
         self.drone.startTransmit(self.tx_port)
-
-        done = False
-        while not done:
-            done = True
-            tx_stats = self.drone.getStats(self.tx_port)
-            for port_stats in tx_stats.port_stats:
-                if port_stats.state.is_transmit_on:
-                    done = False
-            time.sleep(1)
+        self._waitTransmit()
+        tracing.sleep(TX_SETTLE)
 
         self.drone.stopTransmit(self.tx_port)
-        self.drone.stopCapture(self.rx_port)
+        self._stopCapture()
         self.tx_stats = self.drone.getStats(self.tx_port)
         self.stream_stats = self.drone.getStreamStatsDict(self.guids)
-        self._saveCaptures(test, method)
+        self.runs += 1
+        self.last_run = (test, method)
+        if self.capture.saveEachRun():
+            self._saveCaptures(test, method)
         self._cleanupRun()
 
         dbg_print('stream_stats: {0}'.format(self.stream_stats))